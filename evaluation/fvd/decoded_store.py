@@ -0,0 +1,136 @@
+import glob
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import DataLoader
+
+from opensora.utils.file_utils import atomic_write
+
+'''
+decode-once store of generated videos: the decoded uint8 frames (T,H,W,C) are appended to memory-mapped .npy shards,
+keyed by the md5 of the video file, so that all evaluation passes (and later runs) read the frames w/o decoding the mp4 again.
+Each shard `shard_<uuid>.npy` (flat uint8) has an index `shard_<uuid>.json`: {file md5: [offset, shape]},
+shards are only appended (by any process/rank), and the index is written after its shard, so a partial shard is never read.
+'''
+
+DEFAULT_DECODED_STORE_DIR = os.getenv(
+    "DECODED_VIDEO_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "opensora", "decoded_videos")
+)
+
+
+def file_md5(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def read_video_uint8(path):
+    video, _, _ = torchvision.io.read_video(path, pts_unit='sec', output_format="THWC") # uint8 in [0,255]
+    return video
+
+
+class _DecodeDataset:
+    def __init__(self, video_paths):
+        self.video_paths = video_paths
+
+    def __len__(self):
+        return len(self.video_paths)
+
+    def __getitem__(self, idx):
+        return read_video_uint8(self.video_paths[idx]).numpy()
+
+
+class DecodedVideoStore:
+    def __init__(self, store_dir=None, shard_bytes=1 << 30):
+        self.store_dir = DEFAULT_DECODED_STORE_DIR if store_dir is None else store_dir
+        self.shard_bytes = shard_bytes
+        self.path_to_md5 = dict() # (path, size, mtime) -> md5, to hash each file only once
+        self._shards = dict() # opened (memory-mapped) shards of this process
+        self.reload()
+
+    def __getstate__(self):
+        # e.g., pickled to DataLoader workers, the memory-mapped shards are re-opened in each worker
+        state = self.__dict__.copy()
+        state["_shards"] = dict()
+        return state
+
+    def reload(self):
+        self.index = dict() # md5 -> (shard name, offset, shape)
+        for index_path in sorted(glob.glob(os.path.join(self.store_dir, "shard_*.json"))):
+            shard_name = os.path.basename(index_path)[:-len(".json")]
+            with open(index_path, "r") as f:
+                for md5, (offset, shape) in json.load(f).items():
+                    self.index[md5] = (shard_name, offset, tuple(shape))
+
+    def hash(self, path):
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.path_to_md5:
+            self.path_to_md5[key] = file_md5(path)
+        return self.path_to_md5[key]
+
+    def __contains__(self, path):
+        return self.hash(path) in self.index
+
+    def get(self, path):
+        '''
+        Returns:
+            uint8 tensor (T,H,W,C), or None if `path` is not in the store
+        '''
+        entry = self.index.get(self.hash(path))
+        if entry is None:
+            return None
+        shard_name, offset, shape = entry
+        if shard_name not in self._shards:
+            self._shards[shard_name] = np.load(os.path.join(self.store_dir, shard_name + ".npy"), mmap_mode="r")
+        num_bytes = int(np.prod(shape))
+        return torch.from_numpy(np.array(self._shards[shard_name][offset:offset + num_bytes]).reshape(shape))
+
+    def build(self, video_paths, num_workers=4, print_fn=print):
+        '''decode the videos that are not in the store (by a DataLoader w/ `num_workers`), and append them to new shards'''
+        missing = dict()
+        for path in video_paths:
+            md5 = self.hash(path)
+            if md5 not in self.index:
+                missing.setdefault(md5, path) # the same content maybe saved to multiple files
+        print_fn(f"decoded video store: {len(video_paths) - len(missing)} videos in {self.store_dir}, {len(missing)} videos to decode")
+        if len(missing) == 0:
+            return
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        dataloader = DataLoader(
+            _DecodeDataset(list(missing.values())),
+            batch_size=None,
+            shuffle=False,
+            num_workers=num_workers,
+        )
+        buffer, shard_index, num_bytes = [], dict(), 0
+        for md5, video in zip(missing.keys(), dataloader):
+            video = video.numpy() if isinstance(video, torch.Tensor) else video
+            shard_index[md5] = [num_bytes, list(video.shape)]
+            buffer.append(video.reshape(-1))
+            num_bytes += video.size
+            if num_bytes >= self.shard_bytes:
+                self._write_shard(buffer, shard_index)
+                buffer, shard_index, num_bytes = [], dict(), 0
+        if len(buffer) > 0:
+            self._write_shard(buffer, shard_index)
+        self.reload()
+
+    def _write_shard(self, buffer, shard_index):
+        shard_name = f"shard_{uuid.uuid4().hex}"
+        shard_path = os.path.join(self.store_dir, shard_name + ".npy")
+        index_path = os.path.join(self.store_dir, shard_name + ".json")
+        atomic_write(shard_path, lambda tmp_path: np.save(tmp_path, np.concatenate(buffer)), ignore_errors=False)
+
+        def write_index(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(shard_index, f)
+        atomic_write(index_path, write_index, ignore_errors=False)
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+from opensora.utils.file_utils import atomic_write, json_md5
+
+'''
+on-disk cache of per-clip I3D features, content-addressed by (clip identity, frame indices, preprocessing, I3D variant),
+so that repeated evaluations (e.g., of different checkpoints against the same gt clips) only extract features for new clips
+'''
+
+DEFAULT_FEATURE_CACHE_DIR = os.getenv(
+    "I3D_FEATURE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "opensora", "i3d_feats")
+)
+
+
+class I3DFeatureCache:
+    def __init__(self, cache_dir=None, preprocess_tag="", i3d_tag=""):
+        '''
+        Args:
+            preprocess_tag (str): describes the transforms applied on the clips before I3D, e.g., `repr(dataset.transforms)`
+            i3d_tag (str): describes the I3D variant, e.g., method name and the weights file
+        '''
+        self.cache_dir = DEFAULT_FEATURE_CACHE_DIR if cache_dir is None else cache_dir
+        self.preprocess_tag = preprocess_tag
+        self.i3d_tag = i3d_tag
+
+    def key(self, clip_key, frame_ids=None):
+        '''
+        Args:
+            clip_key: json serializable identity of the clip, e.g., [video path, size, mtime] or the list of frame paths
+            frame_ids: frame indices in the clip that are fed to I3D, None for all frames
+        '''
+        frame_ids = None if frame_ids is None else [int(i) for i in frame_ids]
+        key = dict(clip=clip_key, frame_ids=frame_ids, preprocess=self.preprocess_tag, i3d=self.i3d_tag)
+        return json_md5(key)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            return None # e.g., a partially written file of a killed run
+
+    def put(self, key, feat):
+        # errors are ignored (e.g., read-only cache dir), the evaluation is still correct without cache
+        atomic_write(self._path(key), lambda tmp_path: np.save(tmp_path, np.asarray(feat)))
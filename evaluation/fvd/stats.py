@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+from scipy.linalg import sqrtm
+
+'''
+streaming (mean, covariance) of I3D features for FVD, so that the features are not kept in memory, i.e., O(d^2) instead of O(N*d).
+Batches are merged by Chan et al.'s parallel algorithm, which is also used to merge the stats of different workers/ranks
+'''
+
+class FrechetStats:
+    def __init__(self, dim=None):
+        self.n = 0
+        self.mean = None if dim is None else np.zeros(dim, dtype=np.float64)
+        self.m2 = None if dim is None else np.zeros((dim, dim), dtype=np.float64) # sum of (x - mean)(x - mean)^T
+
+    def update(self, feats):
+        '''feats: (N, d), np.ndarray or torch.Tensor'''
+        if isinstance(feats, torch.Tensor):
+            feats = feats.detach().cpu().numpy()
+        feats = np.asarray(feats, dtype=np.float64).reshape(len(feats), -1)
+        if len(feats) == 0:
+            return self
+        mean = feats.mean(axis=0)
+        centered = feats - mean
+        return self.merge_(len(feats), mean, centered.T @ centered)
+
+    def merge_(self, n, mean, m2):
+        if n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = n, mean.copy(), m2.copy()
+            return self
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + np.outer(delta, delta) * (self.n * n / total)
+        self.n = total
+        return self
+
+    def merge(self, other):
+        return self.merge_(other.n, other.mean, other.m2)
+
+    @property
+    def cov(self):
+        # unbiased, the same as `np.cov(feats, rowvar=False)`
+        return self.m2 / (self.n - 1)
+
+    def state_dict(self):
+        return dict(n=self.n, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        stats = cls()
+        stats.n, stats.mean, stats.m2 = state_dict["n"], state_dict["mean"], state_dict["m2"]
+        return stats
+
+
+def all_gather_stats(stats: FrechetStats, group=None) -> FrechetStats:
+    '''merge the stats of all ranks (each rank extracts the feats of its own shard), the result is the same on all ranks'''
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size(group) == 1:
+        return stats
+    state_dicts = [None] * dist.get_world_size(group)
+    dist.all_gather_object(state_dicts, stats.state_dict(), group=group) # (n, d, d*d) per rank, this is small
+    merged = FrechetStats()
+    for state_dict in state_dicts:
+        merged.merge(FrechetStats.from_state_dict(state_dict))
+    return merged
+
+
+def frechet_distance_from_stats(stats_fake: FrechetStats, stats_real: FrechetStats) -> float:
+    '''the same as `frechet_distance` in `evaluation/fvd/styleganv/fvd.py`, computed from the streaming stats'''
+    m = np.square(stats_fake.mean - stats_real.mean).sum()
+    if stats_fake.n > 1:
+        sigma_fake, sigma_real = stats_fake.cov, stats_real.cov
+        s, _ = sqrtm(np.dot(sigma_fake, sigma_real), disp=False) # pylint: disable=no-member
+        fid = np.real(m + np.trace(sigma_fake + sigma_real - s * 2))
+    else:
+        fid = np.real(m)
+    return float(fid)
@@ -7,6 +7,7 @@ Usage:
 """
 
 import argparse
+import functools
 import importlib
 import os
 import subprocess
@@ -19,16 +20,19 @@ import spaces
 import torch
 
 import gradio as gr
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
 import datetime
 
 
 
-MODEL_TYPES = ["v1.1-stage2", "v1.1-stage3"]
+MODEL_TYPES = ["v1.1-stage2", "v1.1-stage3", "causal-stdit2"]
 CONFIG_MAP = {
     "v1.1-stage2": "configs/opensora-v1-1/inference/sample-ref.py",
     "v1.1-stage3": "configs/opensora-v1-1/inference/sample-ref.py",
+    "causal-stdit2": "configs/causal_stdit/infer_SkyTimelapse_withKVcache.py",
 }
+CAUSAL_FPS = 8  # the same as `validation_visualize`
 HF_STDIT_MAP = {
     "v1.1-stage2": "hpcai-tech/OpenSora-STDiT-v2-stage2",
     "v1.1-stage3": "hpcai-tech/OpenSora-STDiT-v2-stage3",
@@ -95,6 +99,36 @@ def collect_references_batch(reference_paths, vae, image_size):
     return refs_x
 
 
+def decode_latents(vae, z, stream=None, ready=None):
+    '''
+    runs in the decoding thread of `run_inference`, on a side CUDA `stream`, so that the decoding kernels overlap with the
+    sampling kernels of the next loop (on the default stream). `ready` is recorded on the default stream after `z` is sampled
+    '''
+    # inference_mode & the current stream are thread-local
+    with torch.inference_mode(), torch.cuda.stream(stream):
+        if ready is not None:
+            stream.wait_event(ready)
+        video = vae.decode(z)
+    if stream is not None:
+        stream.synchronize()  # the result is used by the main thread on the default stream
+    return video
+
+
+def iter_inference_mode(iterator):
+    '''
+    resume `iterator` in inference_mode at each step. inference_mode is thread-local, and the gradio generators are
+    resumed in different threads, so it can not be entered once around the loop
+    '''
+    iterator = iter(iterator)
+    while True:
+        with torch.inference_mode():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
 def process_mask_strategy(mask_strategy):
     mask_batch = []
     mask_strategy = mask_strategy.split(";")
@@ -263,11 +297,6 @@ def build_models(model_type, config, enable_optimization=False):
         trust_remote_code=True,
     ).cuda()
 
-    # build scheduler
-    from opensora.registry import SCHEDULERS
-
-    scheduler = build_module(config.scheduler, SCHEDULERS)
-
     # hack for classifier-free guidance
     text_encoder.y_embedder = stdit.y_embedder
 
@@ -278,7 +307,58 @@ def build_models(model_type, config, enable_optimization=False):
 
     # clear cuda
     torch.cuda.empty_cache()
-    return vae, text_encoder, stdit, scheduler
+    return vae, text_encoder, stdit
+
+
+def build_causal_models(config, train_config, ckpt_path):
+    """
+    Build the CausalSTDiT2 (w/ kv-cache) and its vae & text encoder from the training config, the same as `scripts/inference.py`.
+    """
+    from opensora.registry import MODELS, build_module
+
+    # the inference config can over-write the vae/text_encoder/prefix_perturb_t of the training config
+    for k in ["vae", "text_encoder", "prefix_perturb_t"]:
+        if k not in config:
+            config[k] = train_config.get(k, None)
+    dtype = to_torch_dtype(config.dtype)
+
+    text_encoder = build_module(config.text_encoder, MODELS, device=device)
+    vae = build_module(config.vae, MODELS)
+    latent_size = vae.get_latent_size((1, config.sample_cfgs.height, config.sample_cfgs.width))
+
+    # update model config at inference time, e.g., enable_flashattn
+    model_cfg = train_config.model.copy()
+    model_cfg.update({k: v for k, v in config.items() if k in model_cfg})
+    model_cfg.update(from_pretrained=ckpt_path)
+    stdit = build_module(
+        model_cfg,
+        MODELS,
+        input_size=latent_size,
+        in_channels=vae.out_channels,
+        caption_channels=text_encoder.output_dim if text_encoder is not None else model_cfg.caption_channels,
+        model_max_length=text_encoder.model_max_length if text_encoder is not None else 0,
+        load_device=device,  # load the memory-mapped ckpt directly to device, refer to `load_checkpoint_lazy`
+        load_dtype=dtype,
+    )
+    if text_encoder is not None:
+        text_encoder.y_embedder = stdit.y_embedder  # hack for classifier-free guidance
+
+    vae = vae.to(device, dtype).eval()
+    stdit = stdit.to(device, dtype).eval()
+
+    torch.cuda.empty_cache()
+    return vae, text_encoder, stdit
+
+
+@functools.lru_cache(maxsize=8)
+def get_scheduler(sampling_steps, cfg_scale):
+    """
+    Build the scheduler for the given sampling steps and cfg scale.
+    The schedulers are kept and reused by later requests, instead of re-initializing a shared scheduler for each request.
+    """
+    from opensora.registry import SCHEDULERS, build_module
+
+    return build_module(dict(config.scheduler, num_sampling_steps=sampling_steps, cfg_scale=cfg_scale), SCHEDULERS)
 
 
 def parse_args():
@@ -293,6 +373,22 @@ def parse_args():
     parser.add_argument("--port", default=None, type=int, help="The port to run the Gradio App on.")
     parser.add_argument("--host", default=None, type=str, help="The host to run the Gradio App on.")
     parser.add_argument("--share", action="store_true", help="Whether to share this gradio demo.")
+    parser.add_argument(
+        "--train-config",
+        default="configs/causal_stdit/train_SkyTimelapse_demo.py",
+        type=str,
+        help="The training config of the CausalSTDiT2 checkpoint (only for causal-stdit2).",
+    )
+    parser.add_argument("--ckpt-path", default=None, type=str, help="The CausalSTDiT2 checkpoint (only for causal-stdit2).")
+    parser.add_argument(
+        "--concurrency-limit",
+        default=1,
+        type=int,
+        help="The max number of requests running at the same time, the others wait in the queue. The causal-stdit2 requests always run one at a time as the kv-cache is part of the model.",
+    )
+    parser.add_argument(
+        "--max-queue-size", default=16, type=int, help="The max number of requests waiting in the queue, new requests are rejected when it is full."
+    )
     parser.add_argument(
         "--enable-optimization",
         action="store_true",
@@ -330,8 +426,13 @@ from opensora.utils.misc import to_torch_dtype
 dtype = to_torch_dtype(config.dtype)
 device = torch.device("cuda")
 
-# build model
-vae, text_encoder, stdit, scheduler = build_models(args.model_type, config, enable_optimization=args.enable_optimization)
+# build model, the models and the scheduler are kept warm across requests
+if args.model_type == "causal-stdit2":
+    assert args.ckpt_path is not None, "--ckpt-path is required for causal-stdit2"
+    vae, text_encoder, stdit = build_causal_models(config, read_config(args.train_config), args.ckpt_path)
+else:
+    vae, text_encoder, stdit = build_models(args.model_type, config, enable_optimization=args.enable_optimization)
+get_scheduler(config.scheduler.num_sampling_steps, config.scheduler.cfg_scale)
 
 
 def run_inference(mode, prompt_text, resolution, aspect_ratio, length, reference_image, seed, sampling_steps, cfg_scale):
@@ -420,6 +521,9 @@ def run_inference(mode, prompt_text, resolution, aspect_ratio, length, reference
             raise ValueError(f"Invalid mode: {mode}")
 
         # 4.3. long video generation
+        # the latents are decoded for display only, in a background thread on a side CUDA stream, overlapping with the sampling of the next loop
+        decode_executor = ThreadPoolExecutor(max_workers=1)
+        decode_stream = torch.cuda.Stream(device=device)
         for loop_i in range(num_loop):
             # 4.4 sample in hidden space
             batch_prompts = [prompt[loop_i] for prompt in prompt_loops]
@@ -430,7 +534,9 @@ def run_inference(mode, prompt_text, resolution, aspect_ratio, length, reference
 
             # if cfg.reference_path is not None:
             if loop_i > 0:
-                ref_x = vae.encode(video_clips[-1])
+                # carry the latents of the last loop forward, instead of a vae.decode -> vae.encode round trip
+                # (which costs a full vae pass per loop and compounds the reconstruction error)
+                ref_x = samples
                 for j, refs in enumerate(refs_x):
                     if refs is None:
                         refs_x[j] = [ref_x[j]]
@@ -447,15 +553,7 @@ def run_inference(mode, prompt_text, resolution, aspect_ratio, length, reference
             masks = apply_mask_strategy(z, refs_x, mask_strategy, loop_i)
 
             # 4.6. diffusion sampling
-            # hack to update num_sampling_steps and cfg_scale
-            scheduler_kwargs = config.scheduler.copy()
-            scheduler_kwargs.pop('type')
-            scheduler_kwargs['num_sampling_steps'] = sampling_steps
-            scheduler_kwargs['cfg_scale'] = cfg_scale
-
-            scheduler.__init__(
-                **scheduler_kwargs
-            )
+            scheduler = get_scheduler(int(sampling_steps), float(cfg_scale))
             samples = scheduler.sample(
                 stdit,
                 text_encoder,
@@ -465,21 +563,23 @@ def run_inference(mode, prompt_text, resolution, aspect_ratio, length, reference
                 additional_args=model_args,
                 mask=masks,  # scheduler must support mask
             )
-            samples = vae.decode(samples.to(dtype))
-            video_clips.append(samples)
-
-            # 4.7. save video
-            if loop_i == num_loop - 1:
-                video_clips_list = [
-                    video_clips[0][0]] + [video_clips[i][0][:, config.condition_frame_length :] 
-                    for i in range(1, num_loop)
-                ]
-                video = torch.cat(video_clips_list, dim=1)
-                current_datetime = datetime.datetime.now()
-                timestamp = current_datetime.timestamp()
-                save_path = os.path.join(args.output, f"output_{timestamp}")
-                saved_path = save_sample(video, save_path=save_path, fps=config.fps // config.frame_interval)
-                return saved_path
+            # only decode the new frames, the first `condition_frame_length` frames are given by the last loop
+            # (the image vae keeps the number of frames, i.e., latent frames are video frames)
+            new_frames = samples if loop_i == 0 else samples[:, :, condition_frame_length:]
+            new_frames = new_frames.to(dtype)
+            new_frames.record_stream(decode_stream)  # not re-used by the allocator before the decoding is done
+            ready = torch.cuda.Event()
+            ready.record()
+            video_clips.append(decode_executor.submit(decode_latents, vae, new_frames, decode_stream, ready))
+
+        # 4.7. save video
+        video = torch.cat([clip.result()[0] for clip in video_clips], dim=1)
+        decode_executor.shutdown()
+        current_datetime = datetime.datetime.now()
+        timestamp = current_datetime.timestamp()
+        save_path = os.path.join(args.output, f"output_{timestamp}")
+        saved_path = save_sample(video, save_path=save_path, fps=config.fps // config.frame_interval)
+        return saved_path
 
 @spaces.GPU(duration=200)
 def run_image_inference(prompt_text, resolution, aspect_ratio, length, reference_image, seed, sampling_steps, cfg_scale):
@@ -490,7 +590,157 @@ def run_video_inference(prompt_text, resolution, aspect_ratio, length, reference
     return run_inference("Text2Video", prompt_text, resolution, aspect_ratio, length, reference_image, seed, sampling_steps, cfg_scale)
 
 
-def main():
+@spaces.GPU(duration=200)
+def run_causal_inference(prompt_text, length, reference_image, seed, sampling_steps, cfg_scale):
+    """
+    Stream the video chunk-by-chunk with the CausalSTDiT2 kv-cache model.
+    Each AR step of `autoregressive_sample_kv_cache_iter` yields a denoised latent chunk, which is decoded, saved as a segment
+    and sent to the streaming video right away, i.e., the first frames are shown after one AR step instead of after the whole video.
+    The complete video is saved and shown at the end.
+    """
+    import torchvision
+    from opensora.datasets import video_transforms
+    from opensora.utils.video_gen import autoregressive_sample_kv_cache_iter
+
+    if reference_image is None:
+        raise gr.Error("CausalSTDiT2 generates the video from the first frame, please upload a reference image.")
+    torch.manual_seed(seed)
+    sample_cfgs = config.sample_cfgs
+    chunk_len = sample_cfgs.auto_regre_chunk_len
+    num_seconds = int(length.rstrip("s"))
+    ar_steps = math.ceil((num_seconds * CAUSAL_FPS - 1) / chunk_len)
+
+    # NOTE generators may be resumed in different threads, so inference_mode is entered for each step
+    with torch.inference_mode():
+        transforms = torchvision.transforms.Compose(
+            [
+                video_transforms.ToTensorVideo(),  # TCHW, normalize to 0~1
+                video_transforms.ResizeCenterCropVideo(sample_cfgs.height),
+                torchvision.transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),  # To -1 ~ 1
+            ]
+        )
+        first_image = torch.from_numpy(reference_image).permute(2, 0, 1).unsqueeze(0)  # (1, 3, h, w)
+        first_image = transforms(first_image).unsqueeze(2).to(device, dtype)  # (1, 3, 1, H, W)
+        cond_frame_latents = vae.encode(first_image)  # (1, C, 1, H, W)
+        latent_size = vae.get_latent_size((chunk_len, sample_cfgs.height, sample_cfgs.width))
+
+        scheduler = get_scheduler(int(sampling_steps), float(cfg_scale))
+        bsz = 2 if scheduler.cfg_scale > 1.0 else 1
+        if stdit._kv_cache_registered and stdit.cache_kv.shape[1] != bsz:
+            stdit.empty_kv_cache()  # the warm kv-cache is only reused (by `reset_kv_cache`) for the same batch size
+
+    sampler = autoregressive_sample_kv_cache_iter(
+        scheduler,
+        stdit,
+        text_encoder,
+        z_size=(vae.out_channels, *latent_size),
+        prompts=[prompt_text if text_encoder is not None else None],
+        cond_frame_latents=cond_frame_latents,
+        ar_steps=ar_steps,
+        kv_cache_dequeue=config.kv_cache_dequeue,
+        kv_cache_max_seqlen=config.kv_cache_max_seqlen,
+        seed=seed,
+        verbose=False,
+        prefix_perturb_t=config.prefix_perturb_t,
+        progressive_alpha=config.get("progressive_alpha", -1),
+    )
+    timestamp = datetime.datetime.now().timestamp()
+    save_dir = os.path.join(args.output, f"output_{timestamp}")
+    os.makedirs(save_dir, exist_ok=True)
+    video_clips = [first_image[0].float().cpu()]  # [(C, T, H, W), ...]
+    # iterate until the sampler is exhausted, so that its post-loop code (profiler, FPS_INFO_SAVE_DIR dump) runs
+    for ar_step, samples in enumerate(iter_inference_mode(sampler)):  # samples: (1, C, T_n, H, W)
+        with torch.inference_mode():
+            # the image vae decodes frame-by-frame, so decoding each chunk is the same as decoding the whole video
+            clip = vae.decode(samples.to(dtype))[0].float().cpu()
+        segment = torch.cat([video_clips[0], clip], dim=1) if ar_step == 0 else clip
+        video_clips.append(clip)
+        segment_path = save_sample(
+            segment.clone(), fps=CAUSAL_FPS, save_path=os.path.join(save_dir, f"chunk{ar_step:03d}"), force_video=True
+        )
+        yield segment_path, gr.update()
+
+    video = torch.cat(video_clips, dim=1)
+    saved_path = save_sample(video, fps=CAUSAL_FPS, save_path=os.path.join(save_dir, "video"))
+    yield gr.update(), saved_path
+
+
+def build_causal_demo():
+    with gr.Blocks() as demo:
+        with gr.Row():
+            gr.HTML(
+                """
+            <div style='text-align: center;'>
+                <h1 style='margin-top: 5px;'>CausalCache-VDM: Autoregressive Video Generation with KV-Cache</h1>
+            </div>
+            """
+            )
+
+        with gr.Row():
+            with gr.Column():
+                prompt_text = gr.Textbox(
+                    label="Prompt",
+                    placeholder="Describe your video here",
+                    lines=4,
+                    visible=text_encoder is not None,
+                )
+                reference_image = gr.Image(
+                    label="First Frame",
+                )
+                length = gr.Radio(
+                    choices=["2s", "4s", "8s", "16s"],
+                    value="4s",
+                    label="Video Length",
+                )
+
+                with gr.Row():
+                    seed = gr.Slider(
+                        value=config.sample_cfgs.get("seed", 1024),
+                        minimum=1,
+                        maximum=2048,
+                        step=1,
+                        label="Seed"
+                    )
+                    sampling_steps = gr.Slider(
+                        value=config.scheduler.num_sampling_steps,
+                        minimum=1,
+                        maximum=200,
+                        step=1,
+                        label="Sampling steps"
+                    )
+                    cfg_scale = gr.Slider(
+                        value=config.scheduler.cfg_scale,
+                        minimum=0.0,
+                        maximum=10.0,
+                        step=0.1,
+                        label="CFG Scale",
+                        visible=text_encoder is not None,  # cls-free guidance needs the text encoder
+                    )
+
+            with gr.Column():
+                stream_video = gr.Video(
+                    label="Streaming Output",
+                    streaming=True,
+                    autoplay=True,
+                )
+                output_video = gr.Video(
+                    label="Output Video",
+                )
+
+        with gr.Row():
+            video_gen_button = gr.Button("Generate video")
+
+        # the kv-cache is part of the model, so the requests run one at a time, the others wait in the queue
+        video_gen_button.click(
+            fn=run_causal_inference,
+            inputs=[prompt_text, length, reference_image, seed, sampling_steps, cfg_scale],
+            outputs=[stream_video, output_video],
+            concurrency_limit=1,
+        )
+    return demo
+
+
+def build_demo():
     # create demo
     with gr.Blocks() as demo:
         with gr.Row():
@@ -589,6 +839,18 @@ def main():
              outputs=output_video
              )
 
+    return demo
+
+
+def main():
+    if args.model_type == "causal-stdit2":
+        demo = build_causal_demo()
+    else:
+        demo = build_demo()
+
+    # requests wait in a bounded queue, at most `concurrency_limit` of them run at the same time
+    demo.queue(default_concurrency_limit=args.concurrency_limit, max_size=args.max_queue_size)
+
     # launch
     demo.launch(server_port=args.port, server_name=args.host, share=args.share)
 
@@ -1,4 +1,2 @@
-from .acceleration import *
-from .datasets import *
-from .models import *
-from .registry import *
+# NOTE: sub-packages are not imported here, models/schedulers/datasets are imported by the registries
+# (`opensora.registry`) when they are built, so that importing a light module does not import torch models, diffusers, etc.
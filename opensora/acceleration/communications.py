@@ -11,11 +11,36 @@ def _all_to_all(
     group: dist.ProcessGroup,
     scatter_dim: int,
     gather_dim: int,
+    out: torch.Tensor = None,
+    async_op: bool = False,
 ):
-    input_list = [t.contiguous() for t in torch.tensor_split(input_, world_size, scatter_dim)]
-    output_list = [torch.empty_like(input_list[0]) for _ in range(world_size)]
-    dist.all_to_all(output_list, input_list, group=group)
-    return torch.cat(output_list, dim=gather_dim).contiguous()
+    """All-to-all with a single `all_to_all_single` call into one contiguous buffer.
+
+    The chunks to send are laid out as (world_size, *chunk_shape) with one copy (no copy if scatter_dim == 0),
+    and the received buffer is moved to `gather_dim` with one copy (no copy if gather_dim == 0),
+    i.e., no per-chunk `.contiguous()` and no `torch.cat`.
+
+    Args:
+        out: optional preallocated output, the result is written into it
+        async_op: if True, return a `wait` function which waits for the communication and returns the output
+    """
+    assert input_.shape[scatter_dim] % world_size == 0, f"{input_.shape}[{scatter_dim}] is not divisible by {world_size}"
+    # (..., world_size * d_s, ...) -> (world_size, ..., d_s, ...)
+    send = input_.unflatten(scatter_dim, (world_size, -1)).movedim(scatter_dim, 0).contiguous()
+    recv = torch.empty_like(send)
+    work = dist.all_to_all_single(recv, send, group=group, async_op=async_op)
+
+    def wait():
+        if work is not None:
+            work.wait()
+        # recv[i] is the chunk from rank i: (world_size, ..., d_g, ...) -> (..., world_size * d_g, ...)
+        recv_ = recv.movedim(0, gather_dim)
+        if out is not None:
+            out.unflatten(gather_dim, (world_size, -1)).copy_(recv_)
+            return out
+        return recv_.flatten(gather_dim, gather_dim + 1).contiguous()
+
+    return wait if async_op else wait()
 
 
 class _AllToAll(torch.autograd.Function):
@@ -63,6 +88,21 @@ def all_to_all(
     return _AllToAll.apply(input_, process_group, scatter_dim, gather_dim)
 
 
+def all_to_all_async(
+    input_: torch.Tensor,
+    process_group: dist.ProcessGroup,
+    scatter_dim: int = 2,
+    gather_dim: int = 1,
+    out: torch.Tensor = None,
+):
+    """Launch an all-to-all and return a `wait` function that returns the output, for overlapping computation
+    with communication at inference time (no autograd).
+    """
+    assert not (torch.is_grad_enabled() and input_.requires_grad), "all_to_all_async does not support autograd, use all_to_all"
+    world_size = dist.get_world_size(process_group)
+    return _all_to_all(input_, world_size, process_group, scatter_dim, gather_dim, out=out, async_op=True)
+
+
 def _gather(
     input_: torch.Tensor,
     world_size: int,
@@ -111,7 +151,6 @@ def _gather(input_, pg: dist.ProcessGroup, dim=-1):
 
     # all gather
     tensor_list = [torch.empty_like(input_) for _ in range(world_size)]
-    assert input_.device.type == "cuda"
     torch.distributed.all_gather(tensor_list, input_, group=pg)
 
     # concat
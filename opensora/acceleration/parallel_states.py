@@ -17,3 +17,11 @@ def set_sequence_parallel_group(group: dist.ProcessGroup):
 
 def get_sequence_parallel_group():
     return _GLOBAL_PARALLEL_GROUPS.get("sequence", None)
+
+
+def set_pipeline_parallel_group(group: dist.ProcessGroup):
+    _GLOBAL_PARALLEL_GROUPS["pipeline"] = group
+
+
+def get_pipeline_parallel_group():
+    return _GLOBAL_PARALLEL_GROUPS.get("pipeline", None)
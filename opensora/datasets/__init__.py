@@ -1,5 +1,24 @@
-from .dataloader import prepare_dataloader, prepare_variable_dataloader
-from .datasets import IMG_FPS, VariableVideoTextDataset, VideoTextDataset
-from .utils import get_transforms_image, get_transforms_video, save_sample
-from .datasets2 import VideoTextDatasetFromJson, VideoDatasetForVal
-from .skytimelapse_dataset import SkyTimelapseDataset,SkyTimelapseDatasetForEvalFVD
\ No newline at end of file
+from importlib import import_module
+
+# imported lazily (decord, pandas, etc. are only imported when used), datasets are built by `opensora.registry.DATASETS`
+_LAZY_ATTRS = {
+    "prepare_dataloader": "opensora.datasets.dataloader",
+    "prepare_variable_dataloader": "opensora.datasets.dataloader",
+    "IMG_FPS": "opensora.datasets.datasets",
+    "VariableVideoTextDataset": "opensora.datasets.datasets",
+    "VideoTextDataset": "opensora.datasets.datasets",
+    "get_transforms_image": "opensora.datasets.utils",
+    "get_transforms_video": "opensora.datasets.utils",
+    "save_sample": "opensora.datasets.utils",
+    "VideoTextDatasetFromJson": "opensora.datasets.datasets2",
+    "VideoDatasetForVal": "opensora.datasets.datasets2",
+    "SkyTimelapseDataset": "opensora.datasets.skytimelapse_dataset",
+    "SkyTimelapseDatasetForEvalFVD": "opensora.datasets.skytimelapse_dataset",
+    "LatentTextDataset": "opensora.datasets.latent_dataset",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        return getattr(import_module(_LAZY_ATTRS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,7 +1,9 @@
 import os
+import pickle
 from typing import Union, Dict, List, Optional
 import random
 import numpy as np
+import pandas as pd
 import torch
 import decord
 decord.bridge.set_bridge("torch")
@@ -15,6 +17,7 @@ from opensora.datasets.utils import (
     load_json
 )
 from opensora.datasets import video_transforms
+from opensora.datasets.index_cache import atomic_write, file_stat_key, get_index_cache_path
 # VID_EXTENSIONS, get_transforms_image, get_transforms_video, read_file, temporal_random_crop
 
 
@@ -33,6 +36,68 @@ def hit_condition(sample:dict,condition_ths:dict):
         
     return True
 
+def hit_condition_vectorized(df:pd.DataFrame,condition_ths:dict):
+    '''the same as `hit_condition`, applied on all rows of `df` at once'''
+    keep = np.ones(len(df),dtype=bool)
+    if condition_ths is None:
+        return keep
+    
+    for k, th_or_bool in condition_ths.items():
+        if k not in df.columns:
+            continue # this `k` is not labeled for all samples, we don't discard them
+        v = df[k]
+        v = v.where(v.notna(),th_or_bool) # if this `k` is not labeled, then we don't discard it
+        # NOTE bool is also int, so `>=` is used for bool thresholds as well, the same as `hit_condition`
+        cond = (v >= th_or_bool) if isinstance(th_or_bool,(int,float)) else (v==th_or_bool)
+        keep &= cond.to_numpy(dtype=bool)
+    
+    return keep
+
+
+def load_annotations(video_paths,anno_jsons,condition_ths,cache_dir=None,print_fn=print):
+    '''
+    load and filter the jsonl annotations, the result is cached on disk (pickle), keyed by the jsonl files (path, size, mtime),
+    video_paths and condition_ths, so that other ranks and later runs skip the parsing and filtering.
+    The kept samples are the dicts parsed by `load_jsonl` (only the filtering is vectorized), so a cache hit and a cache miss
+    give exactly the same annotations as the per-sample loop, i.e., unlabeled keys are absent, lists stay lists, ints stay ints
+    Returns:
+        annotations (List[dict])
+        stats (dict): total_before_filter, and the number of kept samples of each jsonl
+    '''
+    key = dict(
+        anno_jsons = [file_stat_key(fn) for fn in anno_jsons],
+        video_paths = list(video_paths),
+        condition_ths = condition_ths,
+    )
+    cache_path = get_index_cache_path(cache_dir,key,".pkl")
+    if os.path.exists(cache_path):
+        print_fn(f"load cached annotations from {cache_path}")
+        with open(cache_path,"rb") as f:
+            cache = pickle.load(f)
+        return cache["annotations"], cache["stats"]
+
+    annotations = []
+    stats = dict(total_before_filter=0, num_keep=[])
+    for path, fn in zip(video_paths,anno_jsons):
+        annos_per_dataset = load_jsonl(fn)
+        stats["total_before_filter"] += len(annos_per_dataset)
+        if condition_ths is not None:
+            # only the keys in condition_ths are put into the DataFrame, missing keys are NaN (i.e., not labeled)
+            df = pd.DataFrame.from_records(annos_per_dataset,columns=list(condition_ths.keys()))
+            keep = hit_condition_vectorized(df,condition_ths)
+            annos_per_dataset = [sample for sample, _keep in zip(annos_per_dataset,keep) if _keep]
+        for sample in annos_per_dataset:
+            sample["video_fn"] = os.path.join(path,sample["video_fn"])
+        stats["num_keep"].append(len(annos_per_dataset))
+        annotations.extend(annos_per_dataset)
+
+    def write_fn(tmp_path):
+        with open(tmp_path,"wb") as f:
+            pickle.dump(dict(annotations=annotations,stats=stats),f,protocol=pickle.HIGHEST_PROTOCOL)
+    atomic_write(cache_path,write_fn)
+    return annotations, stats
+
+
 @DATASETS.register_module()
 class VideoTextDatasetFromJson(object):
     def __init__(
@@ -45,6 +110,7 @@ class VideoTextDatasetFromJson(object):
         condition_ths: dict = None,
         aspect_ratio_buckets: tuple = ((256,256),(640,360),(360,640)), # TODO, currenlty we only use 256x256
         sample_repeats: int = 1, # for overft exps on several videos, set a large sample_repeats
+        index_cache_dir: str = None, # None for the default cache dir, see `opensora.datasets.index_cache`
         print_fn = print # this can be logger.info
     ) -> None:
         self.video_paths = video_paths.split(';') if isinstance(video_paths,str) else video_paths
@@ -72,22 +138,15 @@ class VideoTextDatasetFromJson(object):
         assert condition_ths is None or all(isinstance(v,(int,float,bool)) for v in condition_ths.values())
 
         print_fn(f"load and filter annotations, with condition_ths = {self.condition_ths}")
-        self.annotations = []
-        total_before_filter = 0
-        for path, fn in zip(self.video_paths,self.anno_jsons):
-            annos_per_dataset = load_jsonl(fn)
-            total_before_filter += len(annos_per_dataset)
-            _num_keep = 0
-            for sample in annos_per_dataset:
-                sample["video_fn"] = os.path.join(path,sample["video_fn"])
-                if condition_ths is None or hit_condition(sample,condition_ths):
-                    self.annotations.append(sample)
-                    _num_keep +=1
+        annotations, stats = load_annotations(self.video_paths,self.anno_jsons,condition_ths,index_cache_dir,print_fn)
+        for fn, _num_keep in zip(self.anno_jsons,stats["num_keep"]):
             if _num_keep == 0:
                 _info = "WARNING: no sample meets the conditions, "
                 _info += f"dataset: {fn}, with condition_ths: {condition_ths},"
                 _info += "make sure the keys in condition_ths match keys in the json file"
                 print_fn(_info)
+        self.annotations = annotations
+        total_before_filter = stats["total_before_filter"]
         assert len(self.annotations) > 0
         _ratio = len(self.annotations) / total_before_filter
         print_fn(f"total_before_filter={total_before_filter}, num_samples_keep:{len(self.annotations)}, ratio={_ratio}")
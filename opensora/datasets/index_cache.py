@@ -0,0 +1,19 @@
+import os
+
+from opensora.utils.file_utils import atomic_write, file_stat_key, json_md5  # noqa: F401, re-exported
+
+DEFAULT_INDEX_CACHE_DIR = os.getenv(
+    "OPENSORA_INDEX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "opensora", "dataset_index")
+)
+
+
+def get_index_cache_path(cache_dir, key, suffix):
+    '''
+    Args:
+        key (dict): everything the index depends on (e.g., paths, mtimes, filter conditions), must be json serializable
+    Returns:
+        path of the cache file, named by the md5 of `key`
+    '''
+    cache_dir = DEFAULT_INDEX_CACHE_DIR if cache_dir is None else cache_dir
+    return os.path.join(cache_dir, json_md5(key) + suffix)
+
@@ -0,0 +1,209 @@
+import os
+import random
+import json
+
+import numpy as np
+import torch
+
+from opensora.registry import DATASETS
+from opensora.datasets.utils import load_jsonl, load_json
+
+LATENT_STORE_META = "meta.json"
+
+
+class LatentShardWriter:
+    '''
+    write one shard of the latent store, i.e.,
+        shard_dir/latents.npy   (N, F, 2, C, T, h, w) float16, written through a memmap,
+                                the posterior mean & std (scaled) of the F = 1 or 2 (w/ the horizontal flip) clips
+        shard_dir/index.jsonl   one line per row: {text, actual_length, text_id}
+        shard_dir/y.npy         (N_text, L, D) float16, text embeddings de-duplicated by text
+        shard_dir/mask.npy      (N_text, L) bool
+    '''
+    def __init__(self, shard_dir, num_rows, latent_shape):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.num_rows = num_rows
+        self.latents = np.lib.format.open_memmap(
+            os.path.join(shard_dir, "latents.npy"), mode="w+", dtype=np.float16, shape=(num_rows, *latent_shape)
+        )
+        self.records = []
+        self.text_to_id = dict()
+        self.y = []
+        self.mask = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, latent, text, actual_length, y=None, mask=None):
+        # latent: (F, 2, C, T, h, w); y: (L, D); mask: (L,)
+        row = len(self.records)
+        assert row < self.num_rows
+        self.latents[row] = latent.to(torch.float16).cpu().numpy()
+
+        text_id = -1
+        if y is not None:
+            if text not in self.text_to_id:
+                self.text_to_id[text] = len(self.y)
+                self.y.append(y.to(torch.float16).cpu().numpy())
+                self.mask.append(mask.bool().cpu().numpy())
+            text_id = self.text_to_id[text]
+        self.records.append(dict(text=text, actual_length=int(actual_length), text_id=text_id))
+
+    def close(self):
+        assert len(self.records) == self.num_rows, f"{len(self.records)} != {self.num_rows}"
+        self.latents.flush()
+        del self.latents
+        with open(os.path.join(self.shard_dir, "index.jsonl"), "w") as f:
+            for record in self.records:
+                f.write(json.dumps(record) + "\n")
+        if len(self.y) > 0:
+            np.save(os.path.join(self.shard_dir, "y.npy"), np.stack(self.y, axis=0))
+            np.save(os.path.join(self.shard_dir, "mask.npy"), np.stack(self.mask, axis=0))
+
+
+@DATASETS.register_module()
+class LatentTextDataset:
+    '''
+    read VAE latents (and T5 embeddings, if any) precomputed by `scripts/precompute_latents.py`,
+    so that the training loop skips `vae.encode` and `text_encoder.encode`.
+
+    Each stored clip has `n_store_frames` latent frames (zero-padded after `actual_length`). We randomly crop
+    `n_sample_frames` of them, which is equivalent to a temporal crop in the pixel space since the VAE has no temporal patchify.
+    The posterior mean & std are stored, each sample draws a new latent `mean + std * randn` (as `vae.encode`),
+    from the clip or its horizontal flip (if stored, i.e., the RandomHorizontalFlipVideo of the training dataset).
+    Stores w/o `store_moments` in meta.json (one frozen sample per clip) are still supported.
+    '''
+    def __init__(
+        self,
+        root,
+        n_sample_frames,
+        sample_repeats: int = 1,
+        print_fn = print
+    ):
+        self.root = root
+        self.meta = load_json(os.path.join(root, LATENT_STORE_META))
+        self.n_sample_frames = n_sample_frames
+        self.n_store_frames = self.meta["n_store_frames"]
+        assert n_sample_frames <= self.n_store_frames, f"n_sample_frames={n_sample_frames} > n_store_frames={self.n_store_frames}"
+        self.image_size = tuple(self.meta["image_size"])
+        self.has_text_embedding = self.meta["has_text_embedding"]
+        self.store_moments = self.meta.get("store_moments", False)
+        self.sample_repeats = sample_repeats
+
+        self.shard_dirs = [os.path.join(root, d) for d in self.meta["shards"]]
+        self.records = []
+        shard_ids, rows = [], []
+        for shard_id, shard_dir in enumerate(self.shard_dirs):
+            records = load_jsonl(os.path.join(shard_dir, "index.jsonl"))
+            self.records.extend(records)
+            shard_ids.append(np.full(len(records), shard_id, dtype=np.int32))
+            rows.append(np.arange(len(records), dtype=np.int64))
+        self.shard_ids = np.concatenate(shard_ids)
+        self.rows = np.concatenate(rows)
+        self._shards = dict()  # memmaps are opened lazily, i.e., in each dataloader worker
+        self._text_index = None  # text -> (shard_id, text_id), built at the first `get_text_embedding`
+
+        print_fn(f"LatentTextDataset is built from {root}, with {len(self.shard_dirs)} shards, {len(self.records)} clips")
+
+    def __len__(self):
+        return len(self.records) * self.sample_repeats
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            shard_dir = self.shard_dirs[shard_id]
+            shard = dict(latents=np.load(os.path.join(shard_dir, "latents.npy"), mmap_mode="r"))
+            if self.has_text_embedding:
+                shard.update(
+                    y=np.load(os.path.join(shard_dir, "y.npy"), mmap_mode="r"),
+                    mask=np.load(os.path.join(shard_dir, "mask.npy"), mmap_mode="r"),
+                )
+            self._shards[shard_id] = shard
+        return self._shards[shard_id]
+
+    def get_text_embedding_shape(self):
+        '''(model_max_length, output_dim) of the stored text embeddings'''
+        assert self.has_text_embedding
+        y = np.load(os.path.join(self.shard_dirs[0], "y.npy"), mmap_mode="r")
+        return tuple(y.shape[-2:])
+
+    def get_text_embedding(self, text):
+        '''the stored (y, mask) of `text`, (1, L, D) float32 & (L,) long, None if no clip has this caption'''
+        assert self.has_text_embedding
+        if self._text_index is None:
+            self._text_index = {
+                record["text"]: (int(shard_id), record["text_id"]) for record, shard_id in zip(self.records, self.shard_ids)
+            }
+        if text not in self._text_index:
+            return None
+        shard_id, text_id = self._text_index[text]
+        shard_dir = self.shard_dirs[shard_id]
+        # read w/o `_get_shard`, so that no memmap is kept open in the main process
+        y = np.load(os.path.join(shard_dir, "y.npy"), mmap_mode="r")[text_id]
+        mask = np.load(os.path.join(shard_dir, "mask.npy"), mmap_mode="r")[text_id]
+        return torch.from_numpy(np.array(y)).float()[None], torch.from_numpy(np.array(mask)).long()
+
+    def __getitem__(self, index):
+        index = index % len(self.records)
+        record = self.records[index]
+        shard = self._get_shard(int(self.shard_ids[index]))
+        row = int(self.rows[index])
+
+        store_length = record["actual_length"]
+        begin_index = random.randint(0, max(0, store_length - self.n_sample_frames))
+        actual_length = min(self.n_sample_frames, store_length - begin_index)
+        latents = shard["latents"][row]
+        if self.store_moments:
+            flip = random.randrange(latents.shape[0])
+            moments = torch.from_numpy(
+                np.ascontiguousarray(latents[flip, :, :, begin_index : begin_index + actual_length])
+            ).float()  # (2, C, T', h, w)
+            clip = moments[0] + moments[1] * torch.randn_like(moments[0])
+        else:
+            clip = torch.from_numpy(np.ascontiguousarray(latents[:, begin_index : begin_index + actual_length]))
+        latent = torch.zeros((clip.shape[0], self.n_sample_frames, *clip.shape[2:]), dtype=torch.float16)
+        latent[:, :actual_length] = clip
+
+        sample = dict(
+            text = record["text"],
+            latent = latent, # (C, T, h, w), zero-padded after actual_length
+            actual_length = actual_length
+        )
+        if self.has_text_embedding:
+            text_id = record["text_id"]
+            sample.update(
+                y = torch.from_numpy(np.array(shard["y"][text_id]))[None], # (1, L, D)
+                mask = torch.from_numpy(np.array(shard["mask"][text_id])).long(), # (L,)
+            )
+        return sample
+
+
+class LatentStoreTextEncoder:
+    '''
+    stands in for the text encoder (e.g., `T5Encoder`) when training on a latent store w/ text embeddings, so that T5 is not built.
+    `encode` looks up the stored embeddings of the prompts (e.g., the validation prompts, which are often training captions),
+    the text encoder is built by `build_fn` only if a prompt is not in the store (lazily, once).
+    '''
+    def __init__(self, dataset: LatentTextDataset, device, build_fn=None):
+        self.dataset = dataset
+        self.device = device
+        self.build_fn = build_fn
+        self.text_encoder = None
+        self.y_embedder = None  # set by the training script, as `T5Encoder.y_embedder`
+        self.model_max_length, self.output_dim = dataset.get_text_embedding_shape()
+
+    def encode(self, text):
+        embeddings = [self.dataset.get_text_embedding(t) for t in text]
+        if any(e is None for e in embeddings):
+            if self.text_encoder is None:
+                assert self.build_fn is not None, f"prompts {text} are not in the latent store {self.dataset.root}"
+                self.text_encoder = self.build_fn()
+                self.text_encoder.y_embedder = self.y_embedder
+            return self.text_encoder.encode(text)
+        y = torch.stack([y for y, _ in embeddings], dim=0).to(self.device)  # (B, 1, L, D)
+        mask = torch.stack([mask for _, mask in embeddings], dim=0).to(self.device)  # (B, L)
+        return dict(y=y, mask=mask)
+
+    def null(self, n):
+        null_y = self.y_embedder.y_embedding[None].repeat(n, 1, 1)[:, None]
+        return null_y
@@ -242,3 +242,46 @@ class VariableVideoBatchSampler(DistributedSampler):
             return len(self.dataset) // min_batch_size
         else:
             return (len(self.dataset) + min_batch_size - 1) // min_batch_size
+
+
+class WorkStealingBatchSampler:
+    """Dynamic batch sharding across ranks for sampling/inference jobs.
+
+    Instead of a static per-rank split (as in `DistributedSampler`), each rank claims the next
+    un-processed batch from a counter shared through the process group's key-value store.
+    Each step of the iterator claims one batch, so the work a straggler holds is its current batch
+    plus the batches its consumer claims ahead. Do not pass it to a multi-worker `DataLoader`,
+    which claims `prefetch_factor * num_workers` batches at start; iterate it in the sampling loop
+    instead (e.g., `iter_claimed_batches` of `scripts/inference_dataset_ddp.py`, a bounded number of batches ahead).
+
+    Args:
+        indices (List[int]): dataset indices to process, must be identical on all ranks.
+        batch_size (int): number of indices per claimed batch.
+        store (dist.Store, optional): the shared store, defaults to the store of the default process group.
+        key (str): counter key in the store, use a different key for each pass over `indices`.
+    """
+
+    def __init__(
+        self,
+        indices: List[int],
+        batch_size: int,
+        store: Optional[dist.Store] = None,
+        key: str = "work_stealing_batch_sampler",
+    ) -> None:
+        self.indices = list(indices)
+        self.batch_size = batch_size
+        self.store = store if store is not None else dist.distributed_c10d._get_default_store()
+        self.key = key
+
+    def __iter__(self) -> Iterator[List[int]]:
+        while True:
+            # `add` is atomic and returns the value after increment
+            batch_id = self.store.add(self.key, 1) - 1
+            start = batch_id * self.batch_size
+            if start >= len(self.indices):
+                break
+            yield self.indices[start : start + self.batch_size]
+
+    def __len__(self) -> int:
+        # upper bound of the batches this rank may get
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
@@ -5,6 +5,7 @@ import torchvision
 from PIL import Image
 import os
 import os.path
+import json
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 IMG_EXTENSIONS = [
@@ -13,6 +14,7 @@ IMG_EXTENSIONS = [
 ]
 
 from opensora.datasets import video_transforms
+from opensora.datasets.index_cache import atomic_write, get_index_cache_path
 from opensora.registry import DATASETS
 
 def is_image_file(filename):
@@ -73,6 +75,72 @@ def make_dataset(dir, nframes, class_to_idx,silent=False):
         print(f"cut with {nframes} each, number of clips: {len(images)}")
     return images
 
+def scan_short_videos(root, cache_dir=None):
+    '''
+    the directory walk of `make_dataset`, cached on disk. The cache key includes the mtimes of root, long-video and short-video dirs,
+    so adding/removing frames or videos invalidates it (only dirs are stat-ed, no frame file is listed on a cache hit).
+    Returns:
+        classes (List[str]): sorted long-video labels
+        videos (List[Tuple[str, str, List[str]]]): (long_vid, short_vid, sorted frame filenames), in the order of `make_dataset`
+        short_vid_labels (List[str]): short-video labels in the (unsorted) `os.listdir` order, the same as the original
+            `SkyTimelapseDataset.short_vid_labels`, which is the class order of `SkyTimelapseDatasetForEvalFVD` w/ long_vid_as_class=False
+    '''
+    classes, _ = find_classes(root)
+    short_vid_labels, short_vid_dirs = [], []
+    for long_vid in classes:
+        long_vid_path = os.path.join(root, long_vid)
+        short_vids = [sv for sv in os.listdir(long_vid_path) if os.path.isdir(os.path.join(long_vid_path, sv))]
+        short_vid_labels.extend(short_vids)
+        short_vid_dirs.extend((long_vid, short_vid) for short_vid in sorted(short_vids))
+
+    key = dict(
+        root = os.path.realpath(root),
+        mtimes = [os.stat(root).st_mtime_ns] + [os.stat(os.path.join(root, *d)).st_mtime_ns for d in short_vid_dirs],
+        long_vid_mtimes = [os.stat(os.path.join(root, c)).st_mtime_ns for c in classes],
+    )
+    cache_path = get_index_cache_path(cache_dir, key, ".npz")
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        frames, offsets = cache["frames"].tolist(), cache["offsets"]
+        videos = [
+            (long_vid, short_vid, frames[offsets[i] : offsets[i + 1]])
+            for i, (long_vid, short_vid) in enumerate(short_vid_dirs)
+        ]
+        return classes, videos, short_vid_labels
+
+    videos = []
+    for long_vid, short_vid in short_vid_dirs:
+        frames = sorted(fn for fn in os.listdir(os.path.join(root, long_vid, short_vid)) if is_image_file(fn))
+        videos.append((long_vid, short_vid, frames))
+
+    def write_fn(path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                frames = np.array([fn for _, _, frames in videos for fn in frames]),
+                offsets = np.cumsum([0] + [len(frames) for _, _, frames in videos]),
+            )
+    atomic_write(cache_path, write_fn)
+    return classes, videos, short_vid_labels
+
+
+def make_dataset_from_scan(root, videos, nframes, class_to_idx, silent=False):
+    '''the same output as `make_dataset`, built from the result of `scan_short_videos`'''
+    images = []
+    for long_vid, short_vid, frames in videos:
+        for k in range(len(frames) // nframes):
+            images.append([
+                (os.path.join(root, long_vid, short_vid, fn), class_to_idx[long_vid])
+                for fn in frames[k * nframes : (k + 1) * nframes]
+            ])
+    if not silent:
+        print('number of long videos:')
+        print(len(class_to_idx))
+        print('number of short videos')
+        print(len(videos))
+        print(f"cut with {nframes} each, number of clips: {len(images)}")
+    return images
+
 @DATASETS.register_module()
 class SkyTimelapseDataset:
     def __init__(
@@ -82,11 +150,13 @@ class SkyTimelapseDataset:
         image_size=(128,128), # (h,w)
         unified_prompt = "a beautiful sky timelapse",
         loader=pil_loader,
+        index_cache_dir = None, # None for the default cache dir, see `opensora.datasets.index_cache`
         print_fn = print
     ):
         self.print_fn = print_fn
-        classes, class_to_idx = find_classes(root)
-        imgs = make_dataset(root, n_sample_frames,  class_to_idx)
+        classes, videos, short_vid_labels = scan_short_videos(root, index_cache_dir)
+        class_to_idx = {classes[i]: i for i in range(len(classes))}
+        imgs = make_dataset_from_scan(root, videos, n_sample_frames, class_to_idx)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + 
@@ -106,17 +176,8 @@ class SkyTimelapseDataset:
         self.unified_prompt = unified_prompt
 
 
-        long_vid_labels = classes
-        short_vid_labels = []
-        for long_vid_dir in long_vid_labels:
-            short_vids = os.listdir(os.path.join(root,long_vid_dir))
-            # print(short_vids)
-            short_vids = [
-                sv for sv in short_vids 
-                if os.path.isdir(os.path.join(root,long_vid_dir,sv))
-            ]
-            short_vid_labels.extend(short_vids)
-        self.long_vid_labels = long_vid_labels # 997 for train set
+        self.videos = videos
+        self.long_vid_labels = classes # 997 for train set
         self.short_vid_labels = short_vid_labels # 2392 for train set
 
         self.image_size = image_size
@@ -162,6 +223,83 @@ class SkyTimelapseDataset:
 
         return sample
 
+PACKED_INDEX_FILE = "index.json"
+
+@DATASETS.register_module()
+class SkyTimelapsePackedDataset:
+    '''
+    the same clips as `SkyTimelapseDataset`, but read from the packed frame store written by `tools/datasets/pack_skytimelapse.py`,
+    i.e., resized uint8 frames (N, H, W, C) in memory-mapped .npy shards. Each clip is a zero-copy slice of a shard,
+    so there is no file open or JPEG decoding per frame.
+    '''
+    def __init__(
+        self,
+        root, # the packed dir, e.g., /data/SkyTimelapse/sky_train_packed_256x256
+        n_sample_frames,
+        image_size=(128,128), # (h,w)
+        unified_prompt = "a beautiful sky timelapse",
+        print_fn = print
+    ):
+        self.print_fn = print_fn
+        self.root = root
+        with open(os.path.join(root, PACKED_INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.shard_names = index["shards"]
+        self.videos = index["videos"] # list of dict(long_vid, short_vid, shard, start, length, frames)
+        packed_size = tuple(index["image_size"])
+
+        # cut each short video into clips of `n_sample_frames`, the same as `make_dataset`
+        clips = []
+        for vid_id, video in enumerate(self.videos):
+            for k in range(video["length"] // n_sample_frames):
+                clips.append((vid_id, k * n_sample_frames))
+        if len(clips) == 0:
+            raise(RuntimeError(f"Found 0 clips in the packed store: {root}"))
+        self.clips = np.array(clips, dtype=np.int64)
+
+        self.classes = index["classes"]
+        self.class_to_idx = {self.classes[i]: i for i in range(len(self.classes))}
+        self.long_vid_labels = self.classes
+        self.short_vid_labels = [video["short_vid"] for video in self.videos]
+        self.n_sample_frames = n_sample_frames
+        self.unified_prompt = unified_prompt
+        self.split = index.get("split", None)
+
+        self.image_size = tuple(image_size)
+        transforms = [video_transforms.ToTensorVideo()] # TCHW
+        if self.image_size != packed_size:
+            transforms.append(video_transforms.ResizeCenterCropVideo(image_size))
+        transforms.append(torchvision.transforms.Normalize(mean=[0.5,0.5,0.5],std=[0.5,0.5,0.5],inplace=True)) # to -1 ~ 1
+        self.transforms = torchvision.transforms.Compose(transforms)
+
+        self._shards = dict() # opened lazily, i.e., in each dataloader worker
+        print_fn(f"SkyTimelapsePackedDataset is built from {root}, with {len(self.videos)} short videos, {len(self.clips)} clips")
+
+    def __len__(self):
+        return len(self.clips)
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            # copy-on-write memmap, so that torch.from_numpy gets a writable array without copying
+            self._shards[shard_id] = np.load(os.path.join(self.root, self.shard_names[shard_id]), mmap_mode="c")
+        return self._shards[shard_id]
+
+    def __getitem__(self, index):
+        vid_id, offset = self.clips[index].tolist()
+        vid = self.videos[vid_id]
+        start = vid["start"] + offset
+        frames = self._get_shard(vid["shard"])[start : start + self.n_sample_frames] # (T, H, W, C) uint8
+        video = torch.from_numpy(frames).permute(0,3,1,2) # TCHW
+        video = self.transforms(video) # TCHW
+
+        sample = dict(
+            text =  self.unified_prompt,
+            video = video.permute(1,0,2,3), # TCHW -> CTHW
+            actual_length = video.shape[0]
+        )
+
+        return sample
+
 @DATASETS.register_module()
 class SkyTimelapseDatasetForEvalFVD(SkyTimelapseDataset):
     def __init__(
@@ -173,10 +311,12 @@ class SkyTimelapseDatasetForEvalFVD(SkyTimelapseDataset):
         num_samples_total = None,
         num_samples_per_class = None,
         allow_short_video = False, # allow videos shorter than n_sample_frames
+        sample_seed = None, # if set, the random clip of each index is fixed, so that its I3D feature can be cached
         **kwargs
     ):
         
         super().__init__(**kwargs)
+        self.sample_seed = sample_seed
 
         self.read_video = read_video
         self.read_first_frame = read_first_frame
@@ -195,7 +335,7 @@ class SkyTimelapseDatasetForEvalFVD(SkyTimelapseDataset):
             
 
             del self.imgs 
-            imgs = make_dataset(self.root, 1,  self.class_to_idx,silent=True)
+            imgs = make_dataset_from_scan(self.root, self.videos, 1, self.class_to_idx,silent=True)
             imgs = [x[0] for x in imgs]
 
             from collections import defaultdict
@@ -237,7 +377,11 @@ class SkyTimelapseDatasetForEvalFVD(SkyTimelapseDataset):
             return super().__len__(self)
     
 
-    def __getitem__(self, index):
+    def get_clip_img_paths(self, index):
+        '''
+        Returns:
+            clip_img_paths, index (the index maybe re-sampled if its class has no valid video)
+        '''
         if not self.class_balance_sample:
             clip = self.imgs[index] 
             clip = sorted(clip,key=lambda x:x[0]) # sort by path
@@ -246,6 +390,7 @@ class SkyTimelapseDatasetForEvalFVD(SkyTimelapseDataset):
             '''
             follow the style-GAN-V paper, refer to its Appendix
             '''
+            rng = random if self.sample_seed is None else random.Random(f"{self.sample_seed}_{index}")
             class2idx = self.long_vid_labels if self.long_vid_as_class else self.short_vid_labels
             num_classes = len(class2idx)
             class2paths = self.longvid_to_img_paths if self.long_vid_as_class else self.shortvid_to_img_paths
@@ -253,7 +398,7 @@ class SkyTimelapseDatasetForEvalFVD(SkyTimelapseDataset):
             _i=1
             while class_name not in class2paths.keys():
                 # maybe len(class2paths) < num_classes
-                index = random.choice(range(len(self)))
+                index = rng.choice(range(len(self)))
                 _i+=1
                 class_name = class2idx[index % num_classes]
                 if _i > 10000:
@@ -264,15 +409,33 @@ class SkyTimelapseDatasetForEvalFVD(SkyTimelapseDataset):
             valid_start_ids = range(0,len(img_paths)-self.n_sample_frames)
 
             if len(valid_start_ids) > 0:
-                random_start = random.choice(valid_start_ids)
+                random_start = rng.choice(valid_start_ids)
                 clip_img_paths = img_paths[random_start:random_start+self.n_sample_frames]
             else:
                 clip_img_paths = img_paths
+        
+        return clip_img_paths, index
+    
+    def clip_key(self, index):
+        '''identity of the clip at `index` (w/o reading it), only valid if the sampling is fixed, refer to `sample_seed`'''
+        assert self.sample_seed is not None or not self.class_balance_sample
+        clip_img_paths, _ = self.get_clip_img_paths(index)
+        return [os.path.abspath(path) for path in clip_img_paths]
+
+    def video_name(self, index):
+        '''name of the video sampled for `index` (w/o reading it), used to resume sampling, only fixed if the sampling is fixed'''
+        clip_img_paths, index = self.get_clip_img_paths(index)
+        return self._video_name(clip_img_paths, index)
+
+    def _video_name(self, clip_img_paths, index):
+        long_vid_label, short_vid_label,filename = clip_img_paths[0].split('/')[-3:]
+        # e.g., 07U1fSrk9oI 07U1fSrk9oI_1 07U1fSrk9oI_frames_00000046.jpg
+        return f"{index:05d}_{filename}.mp4"
 
+    def __getitem__(self, index):
+        clip_img_paths, index = self.get_clip_img_paths(index)
         _1st_path = clip_img_paths[0]
-        long_vid_label, short_vid_label,filename = _1st_path.split('/')[-3:]
-        # e.g., 07U1fSrk9oI 07U1fSrk9oI_1 07U1fSrk9oI_frames_00000046.jpg
-        video_name = f"{index:05d}_{filename}.mp4"
+        video_name = self._video_name(clip_img_paths, index)
 
         if self.unified_prompt is None:
             text = anno["prompt"] # TODO
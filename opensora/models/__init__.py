@@ -1,7 +1,13 @@
-from .dit import *
-from .latte import *
-from .pixart import *
-from .stdit import *
-from .text_encoder import *
-from .vae import *
-from .causal_stdit2 import *
\ No newline at end of file
+from importlib import import_module
+
+# the model families are imported lazily, refer to `opensora.registry.MODELS`
+_SUBPACKAGES = ["dit", "latte", "pixart", "stdit", "text_encoder", "vae", "causal_stdit2"]
+
+
+def __getattr__(name):
+    # support `from opensora.models import XXX` as before
+    for subpackage in _SUBPACKAGES:
+        module = import_module(f"{__name__}.{subpackage}")
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,14 +4,15 @@ import torch
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.distributed as dist
 from einops import rearrange
 try:
-    from flash_attn import flash_attn_func
+    from flash_attn import flash_attn_func, flash_attn_varlen_func
 except:
     print("flash_attn is not installed")
 
-from opensora.acceleration.communications import all_to_all, split_forward_gather_backward
+from opensora.acceleration.communications import all_to_all, all_to_all_async, split_forward_gather_backward
 from opensora.acceleration.parallel_states import get_sequence_parallel_group
 
 from opensora.models.layers.blocks import LlamaRMSNorm
@@ -65,6 +66,87 @@ def partial_causal_flash_attn(q,k,v, **kwargs):
 
     return x
 
+def build_packed_seq_info(seg_lens,prefix_mask=None,num_rows=1,device=None):
+    '''
+    for packed training, variable-length clips are concatenated along the temporal axis, e.g., seg_lens = [13, 17, 9]
+
+    Args:
+        seg_lens (List[int]): length of each segment, sum(seg_lens) == T
+        prefix_mask (torch.Tensor): (T,), True for clean prefix frames, i.e., `mask_channel[0,0,:,0,0]`
+        num_rows (int): number of packed rows that share the same segments, e.g., (B S) for temporal attn
+    Returns:
+        dict, which is passed through `CausalSTDiT2Block.forward` and `AttentionWithContext.forward`
+    '''
+    seg_lens = [int(L) for L in seg_lens]
+    seg_lens_ = torch.as_tensor(seg_lens,dtype=torch.long,device=device)
+    seg_starts = torch.cumsum(seg_lens_,dim=0) - seg_lens_ # (n_seg,)
+    seg_ids = torch.repeat_interleave(torch.arange(len(seg_lens),device=device),seg_lens_) # (T,)
+    T = sum(seg_lens)
+
+    # cu_seqlens for flash_attn_varlen_func, the (B S) rows are flattened as [row0_seg0, row0_seg1, ..., row1_seg0, ...]
+    row_offsets = torch.arange(num_rows,device=device)[:,None] * T # (num_rows,1)
+    cu_seqlens = torch.cat([
+        (row_offsets + seg_starts[None,:]).flatten(),
+        torch.as_tensor([num_rows*T],device=device)
+    ]).to(torch.int32)
+
+    if prefix_mask is not None:
+        prefix_mask = prefix_mask.to(device=device,dtype=torch.bool)
+        prefix_lens = torch.zeros_like(seg_lens_).index_add_(0,seg_ids,prefix_mask.long()) # (n_seg,)
+    else:
+        prefix_lens = None
+
+    return dict(
+        seg_lens = seg_lens,
+        seg_ids = seg_ids,
+        seg_starts = seg_starts,
+        position_ids = torch.arange(T,device=device) - seg_starts[seg_ids], # restart from 0 at each segment, for RoPE
+        prefix_mask = prefix_mask,
+        prefix_lens = prefix_lens,
+        cu_seqlens = cu_seqlens,
+        max_seqlen = max(seg_lens),
+        num_rows = num_rows,
+    )
+
+
+def packed_flash_attn(q,k,v,packed_info,is_causal,**kwargs):
+    '''
+    q,k,v: (B, T, num_heads, head_dim), each row is packed by the same segments, attention never crosses segments
+    is_causal: True, False or "partial" (causal for the clean prefix and full-attn for noisy frames, inside each segment)
+    '''
+    B,T,H,D = q.shape
+    assert B == packed_info["num_rows"], f"B={B}, num_rows={packed_info['num_rows']}"
+    cu_seqlens = packed_info["cu_seqlens"]
+    max_seqlen = packed_info["max_seqlen"]
+    q_,k_,v_ = (z.reshape(B*T,H,D) for z in (q,k,v))
+    def _varlen_attn(causal):
+        x = flash_attn_varlen_func(q_,k_,v_,cu_seqlens,cu_seqlens,max_seqlen,max_seqlen,causal=causal,**kwargs)
+        return x.view(B,T,H,D)
+
+    if is_causal == "partial":
+        prefix_mask = packed_info["prefix_mask"]
+        x = torch.where(prefix_mask[None,:,None,None],_varlen_attn(True),_varlen_attn(False))
+    else:
+        x = _varlen_attn(is_causal)
+    return x
+
+
+def packed_attn_bias(packed_info,is_causal,device,dtype):
+    '''block-diagonal (causal) attn bias for packed sequences, used when flash-attn is disabled; return (T,T)'''
+    seg_ids = packed_info["seg_ids"]
+    T = len(seg_ids)
+    attn_mask = seg_ids[:,None] == seg_ids[None,:] # 1 for keep, 0 for masked out
+    if is_causal:
+        causal_mask = torch.tril(torch.ones(size=(T,T),dtype=torch.bool,device=seg_ids.device),diagonal=0)
+        if is_causal == "partial":
+            causal_mask |= packed_info["prefix_mask"].logical_not()[:,None] # noisy frames attend to their whole segment
+        attn_mask &= causal_mask
+
+    attn_bias = torch.zeros(size=(T,T),device=device,dtype=dtype)
+    attn_bias.masked_fill_(attn_mask.logical_not().to(device),float("-inf"))
+    return attn_bias
+
+
 class AttentionWithContext(nn.Module):
     def __init__(
         self,
@@ -97,8 +179,11 @@ class AttentionWithContext(nn.Module):
         self.is_causal = is_causal
         self.rope = rope
 
-    def forward(self, x: torch.Tensor, context: torch.Tensor = None, is_ctx_as_kv = False, return_kv=False,**kwargs) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, context: torch.Tensor = None, is_ctx_as_kv = False, return_kv=False, packed_info=None, **kwargs) -> torch.Tensor:
         B, N, C = x.shape
+        if packed_info is not None:
+            # packed training, refer to `build_packed_seq_info`
+            assert context is None and not return_kv
         # flash attn is not memory efficient for small sequences, this is empirical
         # enable_flash_attn = self.enable_flash_attn and (N > B) # TODO
         qkv = self.qkv(x)
@@ -148,12 +233,22 @@ class AttentionWithContext(nn.Module):
         if self.rope is not None:
             # refer to RotaryEmbForCacheQueue
             # we apply RoPE after fetch kv-cache, i.e., we wrote kv-cache w/o RoPE
-            q,k = self.rope(q,k)
+            if packed_info is not None:
+                q,k = self.rope(q,k,position_ids=packed_info["position_ids"])
+            else:
+                q,k = self.rope(q,k)
 
         q, k = self.q_norm(q), self.k_norm(k)
 
         if self.enable_flash_attn:
-            if self.is_causal == "partial":
+            if packed_info is not None:
+                x = packed_flash_attn(
+                    q,k,v,packed_info,
+                    is_causal=self.is_causal,
+                    dropout_p=self.attn_drop.p if self.training else 0.0,
+                    softmax_scale=self.scale,
+                )
+            elif self.is_causal == "partial":
                 x = partial_causal_flash_attn(
                     q,k,v,
                     dropout_p=self.attn_drop.p if self.training else 0.0,
@@ -178,7 +273,9 @@ class AttentionWithContext(nn.Module):
             attn = attn.to(torch.float32) # translate attn to float32
             
             # assert not self.is_causal, "TODO: manually set a causal attn mask"
-            if self.is_causal:
+            if packed_info is not None:
+                attn = attn + packed_attn_bias(packed_info,self.is_causal,device=attn.device,dtype=attn.dtype)
+            elif self.is_causal:
                 if self.is_causal == "parital": assert False, '''
                     TODO, design the attn-mask for train & inference_with_kv_cache separately
                     refer to tests/test_causal_attn.py
@@ -220,24 +317,71 @@ class AttentionWithContext(nn.Module):
 
 class SeqParallelAttentionWithContext(AttentionWithContext):
 
-    def forward(self, x: torch.Tensor, context: torch.Tensor = None, is_ctx_as_kv = False, return_kv=False) -> torch.Tensor:
+    def _qkv_all_to_all_overlapped(self, x, sp_group, sp_size, num_chunks):
+        '''
+        split the local heads of each rank into `num_chunks` head groups, project the qkv of head group k+1
+        while the all_to_all of head group k is in flight (inference only)
+        x: [B, SUB_N, C] -> qkv: [B, N, 3, NUM_HEAD_PER_DEVICE, HEAD_DIM]
+        '''
+        B, SUB_N, C = x.shape
+        num_heads_local = self.num_heads // sp_size
+        assert num_heads_local % num_chunks == 0, f"num_heads_per_device={num_heads_local}, num_chunks={num_chunks}"
+        h = num_heads_local // num_chunks
+
+        # the output features of `self.qkv` are ordered as (3, sp_size, num_chunks, h, head_dim), 
+        # re-arrange the weight once as (num_chunks, 3*sp_size*h*head_dim, C), so that each head group is a contiguous matrix
+        weight, bias = self.qkv.weight, self.qkv.bias
+        cache_key = (weight.data_ptr(), weight._version, num_chunks, sp_size)
+        if getattr(self, "_overlap_qkv_cache_key", None) != cache_key:
+            self._overlap_qkv_weight = weight.view(3, sp_size, num_chunks, h, self.head_dim, C).transpose(0, 2).transpose(1, 2).reshape(num_chunks, -1, C)
+            self._overlap_qkv_bias = None if bias is None else bias.view(3, sp_size, num_chunks, h, self.head_dim).transpose(0, 2).transpose(1, 2).reshape(num_chunks, -1)
+            self._overlap_qkv_cache_key = cache_key
+
+        qkv = torch.empty(size=(B, SUB_N * sp_size, 3, num_heads_local, self.head_dim), device=x.device, dtype=x.dtype)
+        waits = []
+        for k in range(num_chunks):
+            qkv_k = F.linear(x, self._overlap_qkv_weight[k], None if self._overlap_qkv_bias is None else self._overlap_qkv_bias[k])
+            qkv_k = qkv_k.view(B, SUB_N, 3, sp_size * h, self.head_dim)
+            # [B, SUB_N, 3, sp_size*h, HEAD_DIM] -> [B, N, 3, h, HEAD_DIM], written into the k-th head group of `qkv`
+            waits.append(all_to_all_async(qkv_k, sp_group, scatter_dim=3, gather_dim=1, out=qkv[:, :, :, k*h:(k+1)*h, :]))
+        for wait in waits:
+            wait()
+        return qkv
+
+    def forward(self, x: torch.Tensor, context: torch.Tensor = None, is_ctx_as_kv = False, return_kv=False, ctx_seq_sharded=False, comm_overlap_chunks=1, **kwargs) -> torch.Tensor:
+        '''
+        ctx_seq_sharded: whether the `context` (used as kv) is sharded along the sequence as `x`, 
+            e.g., the spatial kv-cache at inference time w/ `kv_cache_sequence_parallel` (each rank holds the kv of its spatial tokens)
+            otherwise `context` is complete on each rank and we only split its heads
+        return_kv: return the kv (before norm) of the local sequence shard, i.e., the kv-cache shard of this rank
+        comm_overlap_chunks: (inference only) overlap the qkv projection of head groups with all_to_all, 
+            refer to `_qkv_all_to_all_overlapped`
+        '''
         sp_group = get_sequence_parallel_group()
         sp_size = dist.get_world_size(sp_group)
 
         B, SUB_N, C = x.shape  # for sequence parallel here, the SUB_N is a local sequence length
         N = SUB_N * sp_size
-        qkv = self.qkv(x)
-        if return_kv:
-            kv_before_norm = qkv[:,:,C:].clone()
-            assert False, "TODO: consider auto-regre for seq parallel"
-        qkv_shape = (B, SUB_N, 3, self.num_heads, self.head_dim)
-        qkv = qkv.view(qkv_shape)
+        overlap = comm_overlap_chunks > 1 and not torch.is_grad_enabled() and not return_kv
 
-        
+        wait_ctx_kv = None
+        if overlap and context is not None and is_ctx_as_kv and ctx_seq_sharded:
+            # launch the all_to_all of the sharded kv-cache first, it is overlapped with the qkv projection below
+            wait_ctx_kv = all_to_all_async(context.view(B, context.shape[1], 2, self.num_heads, self.head_dim), sp_group, scatter_dim=3, gather_dim=1)
 
-        # apply all_to_all to gather sequence and split attention heads
-        # [B, SUB_N, 3, NUM_HEAD, HEAD_DIM] -> [B, N, 3, NUM_HEAD_PER_DEVICE, HEAD_DIM]
-        qkv = all_to_all(qkv, sp_group, scatter_dim=3, gather_dim=1)
+        if overlap:
+            # NOTE `self` can be an `AttentionWithContext`, e.g., the spatial attn called by `SeqParallelAttentionWithContext.forward(block.attn, ...)`
+            qkv = SeqParallelAttentionWithContext._qkv_all_to_all_overlapped(self, x, sp_group, sp_size, comm_overlap_chunks)
+        else:
+            qkv = self.qkv(x)
+            if return_kv:
+                kv_before_norm = qkv[:,:,C:].clone()
+            qkv_shape = (B, SUB_N, 3, self.num_heads, self.head_dim)
+            qkv = qkv.view(qkv_shape)
+
+            # apply all_to_all to gather sequence and split attention heads
+            # [B, SUB_N, 3, NUM_HEAD, HEAD_DIM] -> [B, N, 3, NUM_HEAD_PER_DEVICE, HEAD_DIM]
+            qkv = all_to_all(qkv, sp_group, scatter_dim=3, gather_dim=1)
 
         if self.enable_flash_attn:
             qkv_permute_shape = (2,0,1,3,4) # (3,B,N,num_heads,head_dim)
@@ -256,13 +400,21 @@ class SeqParallelAttentionWithContext(AttentionWithContext):
 
                 kv_shape = (B, N_c, 2, self.num_heads, self.head_dim)
                 kv = context.view(kv_shape)
-                kv = split_forward_gather_backward(kv,sp_group,dim=3, grad_scale="down") # [B*S T_c, 2, NUM_HEAD,  HEAD_DIM] -> [B*S T_c, 2, NUM_HEAD_PER_DEVICE, HEAD_DIM]
+                if wait_ctx_kv is not None:
+                    kv = wait_ctx_kv()
+                elif ctx_seq_sharded:
+                    kv = all_to_all(kv, sp_group, scatter_dim=3, gather_dim=1) # [B, SUB_N_c, 2, NUM_HEAD, HEAD_DIM] -> [B, N_c*sp_size, 2, NUM_HEAD_PER_DEVICE, HEAD_DIM]
+                else:
+                    kv = split_forward_gather_backward(kv,sp_group,dim=3, grad_scale="down") # [B*S T_c, 2, NUM_HEAD,  HEAD_DIM] -> [B*S T_c, 2, NUM_HEAD_PER_DEVICE, HEAD_DIM]
                 kv = kv.permute(qkv_permute_shape)
                 extra_k,extra_v = kv.unbind(0)
 
                 cat_dim = 1 if self.enable_flash_attn else 2
                 k = torch.cat([extra_k,k],dim=cat_dim)
                 v = torch.cat([extra_v,v],dim=cat_dim)
+                if kwargs.get("debug_info",None)=="attn_cf_with_kv_cache": # same as `AttentionWithContext.forward`
+                    k = extra_k
+                    v = extra_v
                 '''# attn seqlen: 
                     for temporal_attn: N_c + N = T_c + T    
                     for spatial_attn:  N_c + N = T_c*S + S
@@ -26,15 +26,17 @@ from opensora.models.layers.blocks import (
     t2i_modulate,
 )
 from opensora.registry import MODELS
-from opensora.utils.ckpt_utils import load_checkpoint
+from opensora.utils.ckpt_utils import load_checkpoint, load_checkpoint_lazy
 from opensora.utils.rope_llama_src import precompute_freqs_cis,apply_rotary_emb_q_or_k
 
 from .attention import (
     AttentionWithContext,
     SeqParallelAttentionWithContext,
+    build_packed_seq_info,
 )
 
 from opensora.utils.debug_utils import envs
+from opensora.utils.profiling import profile_range, get_profiler
 @torch.no_grad()
 def _init_conv2d_eye(conv):
     assert isinstance(conv,nn.Conv2d)
@@ -73,7 +75,7 @@ class RotaryEmbForCacheQueue(nn.Module):
     def set_attn_q_start(self,q_start):
         self.q_start = q_start
 
-    def forward(self,q,k):
+    def forward(self,q,k,position_ids=None):
         '''
         this func is designed for RoPE w/ kv-cache and w/ kv-cache dequeue
         it will be called inside Attention's forward
@@ -82,10 +84,15 @@ class RotaryEmbForCacheQueue(nn.Module):
             q (torch.Tensor): (bsz,len_q,n_heads,head_dim)
             k (torch.Tensor): (bsz,len_k,n_heads,head_dim)
             q_start (int): 
+            position_ids (torch.Tensor): (len_q,), only for packed training, where positions restart at each segment
 
         Returns:
             RoPE applied q, k
         '''
+        if position_ids is not None:
+            assert self.training and q.shape[1] == k.shape[1] == len(position_ids)
+            freqs = self.freqs[position_ids]
+            return apply_rotary_emb_q_or_k(q,freqs), apply_rotary_emb_q_or_k(k,freqs)
 
         q_len,k_len = q.shape[1],k.shape[1]
         maxL = self.freqs.shape[0]
@@ -175,6 +182,8 @@ class CausalSTDiT2Block(nn.Module):
         enable_flashattn=False,
         enable_layernorm_kernel=False,
         enable_sequence_parallelism=False,
+        kv_cache_sequence_parallel=False,
+        kv_cache_sp_comm_chunks=1,
         spatial_attn_enhance = None,
         is_causal: bool = True, # set it to False for ablation
         with_cross_attn = True,
@@ -188,6 +197,8 @@ class CausalSTDiT2Block(nn.Module):
         self.hidden_size = hidden_size
         self.enable_flashattn = enable_flashattn
         self._enable_sequence_parallelism = enable_sequence_parallelism
+        self._kv_cache_sequence_parallel = kv_cache_sequence_parallel # refer to `CausalSTDiT2.forward_kv_cache`
+        self._kv_cache_sp_comm_chunks = kv_cache_sp_comm_chunks # refer to `SeqParallelAttentionWithContext._qkv_all_to_all_overlapped`
         # assert (cross_frame_attn in ["first_frame","last_prefix",None]) or cross_frame_attn.startswith("prev_frames_")
         assert spatial_attn_enhance in ["first_frame",None] or spatial_attn_enhance.startswith("prev_frames_")
         self.spatial_attn_enhance = spatial_attn_enhance
@@ -248,12 +259,13 @@ class CausalSTDiT2Block(nn.Module):
                 hidden_size + temp_extra_in_channels, hidden_size, bias=True
             )
 
-    def forward(self, x, y, t, mask=None, tpe=None, mask_channel=None):
+    def forward(self, x, y, t, mask=None, tpe=None, mask_channel=None, packed_info=None):
         '''
         x: (b,f*h*w,c)
         t: diffusion timestep's emb: (b,c*6) or (b,f,c*6)
         tpe: temporal PosEmb
         mask_channel: (b,1,f,1,1): temporal mask channel (1 for prefix, 0 for noisy latent)
+        packed_info: for packed training (b=1, f=sum(seg_lens)), refer to `build_packed_seq_info`
         '''
         B, N, C = x.shape
         H, W = [self.input_size[i] // self.patch_size[i] for i in [1,2]] # T: complete length of the entire sp_group
@@ -303,7 +315,26 @@ class CausalSTDiT2Block(nn.Module):
             assert not self._enable_sequence_parallelism, "TODO"
             sae_mode = self.spatial_attn_enhance
             x_s_ = rearrange(x, "B (T S) C -> B T S C",T=T, S= S)
-            if sae_mode == "first_frame":
+            if packed_info is not None:
+                # the context frames are taken from the segment that each frame belongs to
+                seg_ids = packed_info["seg_ids"] # (T,)
+                seg_starts = packed_info["seg_starts"][seg_ids] # (T,)
+                if sae_mode == "first_frame":
+                    spatial_cond = x_s_[:,seg_starts,:,:] # (B, T, S, C)
+                else:
+                    prev_L = int(sae_mode.split('_')[-1])
+                    prefix_len = packed_info["prefix_lens"][seg_ids] # (T,)
+                    assert torch.all(prefix_len >= 1), f"prefix_len={packed_info['prefix_lens']}"
+                    prev_prefix = torch.cat([
+                        x_s_[:, seg_starts + torch.clamp(prefix_len - 1 - i, min=0), :, :] for i in range(prev_L)
+                    ],dim=2) # (B, T, prev_L*S, C)
+                    _x_s_repeat = x_s_.repeat(1,1,prev_L,1) # B T (prev_L S) C
+                    spatial_cond = torch.where(
+                        mask_channel[:,0,:,:,:].expand_as(_x_s_repeat).type(torch.bool),
+                        _x_s_repeat,
+                        prev_prefix
+                    )
+            elif sae_mode == "first_frame":
                 x_1st = x_s_[range(B),0,:,:] # (B, S, C)
                 spatial_cond = x_1st[:,None,:,:].repeat(1,T,1,1) # (B, T, S, C)
             
@@ -343,7 +374,9 @@ class CausalSTDiT2Block(nn.Module):
         
         
         attn_temp_kwargs=dict()
-        if self.is_causal == "partial":
+        if packed_info is not None:
+            attn_temp_kwargs.update({"packed_info":packed_info})
+        elif self.is_causal == "partial":
             cond_len = int(mask_channel[0,0,:,0,0].sum().item())
             attn_temp_kwargs.update({"cond_len":cond_len})
 
@@ -368,7 +401,11 @@ class CausalSTDiT2Block(nn.Module):
 
         # cross attn
         if self.with_cross_attn:
-            x = x + self.cross_attn(x, y, mask)
+            if packed_info is not None:
+                # each segment attends to its own prompt
+                x = x + self.cross_attn(x, y, mask, q_seqlens=[L*S for L in packed_info["seg_lens"]])
+            else:
+                x = x + self.cross_attn(x, y, mask)
             # print("use cross attn")
 
         # mlp
@@ -385,6 +422,8 @@ class CausalSTDiT2Block(nn.Module):
         t: diffusion timestep's emb: (b,c*6) or (b,f,c*6)
         tpe: temporal PosEmb
         mask_channel: (b,1,f,1,1): temporal mask channel this should be all zeros
+        w/ `kv_cache_sequence_parallel`, x holds the spatial tokens of this sp_rank, i.e., (b,f*(h*w//sp_size),c),
+            spatial attn & cross-frame attn use all_to_all, temporal attn & the cached kv are rank-local
         '''
         assert self.is_causal
         assert not self.training
@@ -392,6 +431,13 @@ class CausalSTDiT2Block(nn.Module):
         B, N, C = x.shape
         H, W = [self.input_size[i] // self.patch_size[i] for i in [1,2]] # T: complete length of the entire sp_group
         S = H *  W
+        if sp := self._kv_cache_sequence_parallel:
+            S = S // dist.get_world_size(get_sequence_parallel_group()) # local spatial tokens
+            attn_cls = SeqParallelAttentionWithContext
+            sp_kwargs = dict(comm_overlap_chunks=self._kv_cache_sp_comm_chunks)
+        else:
+            attn_cls = AttentionWithContext
+            sp_kwargs = dict()
         T = N // S # window_size
 
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
@@ -404,10 +450,11 @@ class CausalSTDiT2Block(nn.Module):
         # =======================================================================
         # spatial branch
         # =======================================================================
-        x_s = rearrange(x_m, "B (T S) C -> (B T) S C", T=T, S=S)
-        x_s = self.attn(x_s)
-        x_s = rearrange(x_s, "(B T) S C -> B (T S) C", T=T, S=S)
-        x = x + self.drop_path(gate_msa * x_s)
+        with profile_range("spatial_attn"):
+            x_s = rearrange(x_m, "B (T S) C -> (B T) S C", T=T, S=S)
+            x_s = attn_cls.forward(self.attn, x_s, **sp_kwargs)
+            x_s = rearrange(x_s, "(B T) S C -> B (T S) C", T=T, S=S)
+            x = x + self.drop_path(gate_msa * x_s)
         
         
         cached_kv_s,cached_kv_t = cached_kv
@@ -417,100 +464,106 @@ class CausalSTDiT2Block(nn.Module):
         # =======================================================================
         # cross-frame attn spatial branch
         # =======================================================================
-        spatial_kv = None
-        if self.spatial_attn_enhance is not None:
-            x_s = rearrange(x, "B (T S) C -> (B T) S C",T=T,S=S)
-            is_clean_x = return_kv==True # or is_clean_x = t==0
-            T_p = self.spatial_attn_ctx_len
+        with profile_range("cross_frame_attn"):
+            spatial_kv = None
+            if self.spatial_attn_enhance is not None:
+                x_s = rearrange(x, "B (T S) C -> (B T) S C",T=T,S=S)
+                is_clean_x = return_kv==True # or is_clean_x = t==0
+                T_p = self.spatial_attn_ctx_len
             
-            if is_clean_x: # for writing clean latents to kv-cache
-                assert cached_kv_s is None, "spatial kv-cache does not rely on previous spatial kv-cache"
-
-                _x_s_repeat = x_s.repeat(1,T_p,1) # (B T) (T_p S) C
-                x_s,spatial_kv = self.attn_cf(x_s, context=_x_s_repeat, is_ctx_as_kv=False, return_kv = True)
-                x_s:torch.Tensor        # (B T) S C
-                spatial_kv:torch.Tensor # (B T) S C*2
-
-                spatial_kv = rearrange(spatial_kv,"(B T) S C -> B T S C",T=T, S= S)
-                if self.spatial_attn_enhance == "first_frame":
-                    spatial_kv = spatial_kv[:,:1,:,:]  # B 1 S C*2
-                    # NOTE here `:1` index the relative 1st frame of the current chunk
-                    # , so `spatial_kv` will only be written once for the 1st call (the true 1st frame of the video)
-                    # refer to `CausalSTDiT2.write_kv_cache`
-                else:
-                    if T < (T_p:=self.spatial_attn_ctx_len):
-                        # e.g., T==1 for write 1st frame to cache
-                        spatial_kv = spatial_kv.repeat_interleave(T_p//T+1,dim=1)[:,:T_p,:,:]
+                if is_clean_x: # for writing clean latents to kv-cache
+                    assert cached_kv_s is None, "spatial kv-cache does not rely on previous spatial kv-cache"
+
+                    _x_s_repeat = x_s.repeat(1,T_p,1) # (B T) (T_p S) C
+                    x_s,spatial_kv = attn_cls.forward(self.attn_cf, x_s, context=_x_s_repeat, is_ctx_as_kv=False, return_kv = True)
+                    x_s:torch.Tensor        # (B T) S C
+                    spatial_kv:torch.Tensor # (B T) S C*2
+
+                    spatial_kv = rearrange(spatial_kv,"(B T) S C -> B T S C",T=T, S= S)
+                    if self.spatial_attn_enhance == "first_frame":
+                        spatial_kv = spatial_kv[:,:1,:,:]  # B 1 S C*2
+                        # NOTE here `:1` index the relative 1st frame of the current chunk
+                        # , so `spatial_kv` will only be written once for the 1st call (the true 1st frame of the video)
+                        # refer to `CausalSTDiT2.write_kv_cache`
                     else:
-                        spatial_kv = spatial_kv[:,-T_p:,:,:]  # B T_p S C*2
-
-                x_s = rearrange(x_s,"(B T) S C -> B (T S) C",T=T, S= S)
-                x = x + self.drop_path(gate_msa * x_s)
+                        if T < (T_p:=self.spatial_attn_ctx_len):
+                            # e.g., T==1 for write 1st frame to cache
+                            spatial_kv = spatial_kv.repeat_interleave(T_p//T+1,dim=1)[:,:T_p,:,:]
+                        else:
+                            spatial_kv = spatial_kv[:,-T_p:,:,:]  # B T_p S C*2
+
+                    x_s = rearrange(x_s,"(B T) S C -> B (T S) C",T=T, S= S)
+                    x = x + self.drop_path(gate_msa * x_s)
             
-            else: # for denoise, conditioned on cached spatial-kv
-                assert cached_kv_s is not None  # B T_p S C*2
-                if isinstance(T,torch.Tensor): # why ?
-                    T = int(T) 
-                assert  cached_kv_s.shape[1] == T_p
-                cached_kv_s = rearrange(cached_kv_s,"B T_p S C -> B (T_p S) C", T_p=T_p)
-                cached_kv_s = cached_kv_s[:,None,:,:].repeat_interleave(T,dim=1) # B T (T_p S) C*2
-                cached_kv_s = rearrange(cached_kv_s,"B T S C -> (B T) S C", T=T) # (B T) (T_p S) C*2
+                else: # for denoise, conditioned on cached spatial-kv
+                    assert cached_kv_s is not None  # B T_p S C*2
+                    if isinstance(T,torch.Tensor): # why ?
+                        T = int(T) 
+                    assert  cached_kv_s.shape[1] == T_p
+                    cached_kv_s = rearrange(cached_kv_s,"B T_p S C -> B (T_p S) C", T_p=T_p)
+                    cached_kv_s = cached_kv_s[:,None,:,:].repeat_interleave(T,dim=1) # B T (T_p S) C*2
+                    cached_kv_s = rearrange(cached_kv_s,"B T S C -> (B T) S C", T=T) # (B T) (T_p S) C*2
 
-                x_s = self.attn_cf(x_s, context=cached_kv_s, is_ctx_as_kv=True, return_kv = False,debug_info="attn_cf_with_kv_cache")
-                x_s = rearrange(x_s,"(B T) S C -> B (T S) C",T=T, S= S)
-                x = x + self.drop_path(gate_msa * x_s)
+                    if sp: sp_kwargs.update(ctx_seq_sharded=True) # the cached spatial kv is sharded as x_s
+                    x_s = attn_cls.forward(self.attn_cf, x_s, context=cached_kv_s, is_ctx_as_kv=True, return_kv = False,debug_info="attn_cf_with_kv_cache",**sp_kwargs)
+                    x_s = rearrange(x_s,"(B T) S C -> B (T S) C",T=T, S= S)
+                    x = x + self.drop_path(gate_msa * x_s)
 
 
         # =======================================================================
         # temporal branch
         # =======================================================================
-        x_t = rearrange(x, "B (T S) C -> (B S) T C", T=T, S=S)
-        if tpe is not None:
-            x_t = x_t + tpe
+        with profile_range("temporal_attn"):
+            x_t = rearrange(x, "B (T S) C -> (B S) T C", T=T, S=S)
+            if tpe is not None:
+                x_t = x_t + tpe
         
-        attn_temp_kwargs = dict()
-        if self.is_causal == "partial":
-            is_clean_x = return_kv
-            attn_temp_kwargs.update({"is_clean_x":is_clean_x})
+            attn_temp_kwargs = dict()
+            if self.is_causal == "partial":
+                is_clean_x = return_kv
+                attn_temp_kwargs.update({"is_clean_x":is_clean_x})
         
 
-        inject_mask_channel = self.temp_extra_in_channels > 0 # TODO: maybe inject other input (channel-wise concat)
-        if inject_mask_channel:
-            b,_,f,_,_ = mask_channel.shape
-            mask_channel = mask_channel.reshape(b,1,f,1).repeat(1, S, 1, 1) # (B, S, T, 1)
-            mask_channel = rearrange(mask_channel, "B S T C -> (B S) T C")
-            assert mask_channel.shape[:2] == x_t.shape[:2]
+            inject_mask_channel = self.temp_extra_in_channels > 0 # TODO: maybe inject other input (channel-wise concat)
+            if inject_mask_channel:
+                b,_,f,_,_ = mask_channel.shape
+                mask_channel = mask_channel.reshape(b,1,f,1).repeat(1, S, 1, 1) # (B, S, T, 1)
+                mask_channel = rearrange(mask_channel, "B S T C -> (B S) T C")
+                assert mask_channel.shape[:2] == x_t.shape[:2]
 
-            x_t = torch.cat([x_t,mask_channel],dim=-1) # (B S) T C+1
-            x_t = self.attn_temp_pre_merge(x_t) # (B S) T C  == (b*h*w, ws, c)
+                x_t = torch.cat([x_t,mask_channel],dim=-1) # (B S) T C+1
+                x_t = self.attn_temp_pre_merge(x_t) # (B S) T C  == (b*h*w, ws, c)
         
-        if cached_kv_t is not None:
-            T_accu = cached_kv_t.shape[1] # B T_accu S C*2
-            cached_kv_t = rearrange(cached_kv_t,"B T S C -> (B S) T C", T=T_accu)
-
-        x_t,temporal_kv = self.attn_temp(x_t,context=cached_kv_t,is_ctx_as_kv=True,return_kv = True, **attn_temp_kwargs)
-        x_t = rearrange(x_t,"(B S) T C -> B (T S) C", T=T, S=S)
-        temporal_kv = rearrange(temporal_kv,"(B S) T C -> B T S C", T=T, S=S)
+            if cached_kv_t is not None:
+                T_accu = cached_kv_t.shape[1] # B T_accu S C*2
+                cached_kv_t = rearrange(cached_kv_t,"B T S C -> (B S) T C", T=T_accu)
+
+            # temporal attn is always rank-local at inference time (`self.attn_temp` can be `SeqParallelAttentionWithContext` if trained w/ seq parallel)
+            x_t,temporal_kv = AttentionWithContext.forward(self.attn_temp,x_t,context=cached_kv_t,is_ctx_as_kv=True,return_kv = True, **attn_temp_kwargs)
+            x_t = rearrange(x_t,"(B S) T C -> B (T S) C", T=T, S=S)
+            temporal_kv = rearrange(temporal_kv,"(B S) T C -> B T S C", T=T, S=S)
         
-        x = x + self.drop_path(gate_msa * x_t)
+            x = x + self.drop_path(gate_msa * x_t)
         
         if return_kv and return_kv_only:
             # for the last block (save the computation of cross-attn)
             return None,spatial_kv,temporal_kv
 
         ######### cross-attn
-        if self.with_cross_attn:
-            if self._enable_sequence_parallelism:
-                # avoid using seq parallel
-                x = x + MultiHeadCrossAttention.forward(self.cross_attn,x,y,mask)
-            else:
-                x = x + self.cross_attn(x, y, mask)
-            # print("use cross attn")
+        with profile_range("cross_attn"):
+            if self.with_cross_attn:
+                if self._enable_sequence_parallelism:
+                    # avoid using seq parallel
+                    x = x + MultiHeadCrossAttention.forward(self.cross_attn,x,y,mask)
+                else:
+                    x = x + self.cross_attn(x, y, mask)
+                # print("use cross attn")
         # mlp
         # x = x + self.drop_path(gate_mlp * self.mlp(t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)))
 
-        x_m_ = t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)
-        x = x + self.drop_path(gate_mlp * self.mlp(x_m_))
+        with profile_range("mlp"):
+            x_m_ = t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)
+            x = x + self.drop_path(gate_mlp * self.mlp(x_m_))
 
         if return_kv:
             return (
@@ -549,6 +602,8 @@ class CausalSTDiT2(nn.Module):
         enable_flashattn=False,
         enable_layernorm_kernel=False,
         enable_sequence_parallelism=False,
+        kv_cache_sequence_parallel=False,
+        kv_cache_sp_comm_chunks=1,
         spatial_attn_enhance = None,
         cross_frame_attn:str = None,
         is_causal: bool = True,
@@ -624,6 +679,8 @@ class CausalSTDiT2(nn.Module):
                     enable_flashattn=self.enable_flashattn,
                     enable_layernorm_kernel=self.enable_layernorm_kernel,
                     enable_sequence_parallelism=enable_sequence_parallelism,
+                    kv_cache_sequence_parallel=kv_cache_sequence_parallel,
+                    kv_cache_sp_comm_chunks=kv_cache_sp_comm_chunks,
                     temp_extra_in_channels = temp_extra_in_channels if (i==0 or temp_extra_in_all_block) else 0,
                     spatial_attn_enhance=spatial_attn_enhance,
                     is_causal= is_causal,
@@ -660,6 +717,12 @@ class CausalSTDiT2(nn.Module):
         else:
             self.sp_rank = None
         
+        # shard the spatial tokens across the seq parallel group for inference w/ kv-cache, refer to `forward_kv_cache`
+        self.kv_cache_sequence_parallel = kv_cache_sequence_parallel
+        if kv_cache_sequence_parallel:
+            sp_size = dist.get_world_size(get_sequence_parallel_group())
+            assert self.num_spatial % sp_size == 0 and num_heads % sp_size == 0, f"num_spatial={self.num_spatial}, num_heads={num_heads}, sp_size={sp_size}"
+
         self.KV_CACHE_MAX_SEQLEN = 128
         self._kv_cache_registered = False
         self.kv_cache_dequeue = True
@@ -754,7 +817,7 @@ class CausalSTDiT2(nn.Module):
         b,c,t,h,w = x.shape
         assert tuple(self.input_size[1:]) == (h,w), f"x.shape=={x.shape}; input_size=={self.input_size}"
 
-    def forward(self, x, timestep, y, mask=None, mask_channel=None, x_temporal_start=None):
+    def forward(self, x, timestep, y, mask=None, mask_channel=None, x_temporal_start=None, segment_lens=None):
         """
         Forward pass of STDiT.
         Args:
@@ -765,6 +828,9 @@ class CausalSTDiT2(nn.Module):
             y (torch.Tensor): representation of prompts; of shape [B, 1, N_token, C]
             mask (torch.Tensor): mask for selecting prompt tokens; of shape [B, N_token]
             mask_channel: (B, 1, T, 1, 1) # extra mask (temporal-axis) channel, injected before temporal self-attn, TODO: rename this for injecting other information
+            segment_lens (List[int]): for packed training, B == 1 and `x` is the concatenation of variable-length clips along T,
+                sum(segment_lens) == T, and y, mask are of the clips, i.e., y.shape[0] == len(segment_lens).
+                Temporal attn, cross attn, tpe (or RoPE) are computed inside each segment
 
         Returns:
             x (torch.Tensor): output latent representation; of shape [B, C, T, H, W]
@@ -816,6 +882,19 @@ class CausalSTDiT2(nn.Module):
         t_mlp = self.t_block(t)  # [B, C*6]
         y,y_lens = self.process_text_embeddings_with_mask(y,mask)
 
+        if segment_lens is not None:
+            assert self.training and x.shape[0] == 1 and (not self.enable_sequence_parallelism), "packed seq is only for training"
+            assert sum(segment_lens) == num_temporal, f"segment_lens={segment_lens}, T={num_temporal}"
+            assert y_lens is None or len(y_lens) == len(segment_lens)
+            packed_info = build_packed_seq_info(
+                segment_lens,
+                prefix_mask = mask_channel[0,0,:,0,0] if mask_channel is not None else None,
+                num_rows = self.num_spatial,
+                device = device
+            )
+        else:
+            packed_info = None
+
         # shard over the sequence dim if sp is enabled
         if self.enable_sequence_parallelism:
             sp_group =  get_sequence_parallel_group()
@@ -833,11 +912,16 @@ class CausalSTDiT2(nn.Module):
             if i == 0:
                 if (not self.training) and (self.relative_tpe_mode is not None):
                     assert x_temporal_start is not None
-                tpe = self.get_relative_tpe(
-                    chunk_len= num_temporal,
-                    chunk_start_idx = x_temporal_start,
-                    with_kv_cache=False
-                )
+                if packed_info is not None:
+                    # tpe restarts at each segment (for RoPE, refer to packed_info["position_ids"])
+                    tpe = [self.get_relative_tpe(chunk_len=L) for L in packed_info["seg_lens"]]
+                    tpe = None if self.relative_tpe_mode == "rope" else torch.cat(tpe,dim=1)
+                else:
+                    tpe = self.get_relative_tpe(
+                        chunk_len= num_temporal,
+                        chunk_start_idx = x_temporal_start,
+                        with_kv_cache=False
+                    )
                 
                 if self.enable_sequence_parallelism:
                     assert False, "TODO"
@@ -845,7 +929,7 @@ class CausalSTDiT2(nn.Module):
             else:
                 tpe = None
 
-            x = auto_grad_checkpoint(block, x, y, t_mlp, y_lens, tpe, mask_channel)
+            x = auto_grad_checkpoint(block, x, y, t_mlp, y_lens, tpe, mask_channel, packed_info)
             
 
         if self.enable_sequence_parallelism:
@@ -885,6 +969,8 @@ class CausalSTDiT2(nn.Module):
             self.cache_indicator.zero_()
             if self.spatial_attn_enhance is not None:
                 self.spatial_ctx_kv.zero_()
+                if self.spatial_attn_enhance =="first_frame":
+                    self._1st_frame_kv_written = False # so that the (warm) model can be reused for a new video
 
     @torch.no_grad()
     def write_kv_cache(self,clean_x,y,mask,start_id): 
@@ -912,7 +998,7 @@ class CausalSTDiT2(nn.Module):
         dtype = self.pos_embed_temporal.dtype
 
         B = bsz
-        S = self.num_spatial
+        S = self.num_spatial_local
         C = self.hidden_size
 
         if max_seq_len is None:
@@ -1029,6 +1115,47 @@ class CausalSTDiT2(nn.Module):
             print(f"after write_kv_cache, cache_indicator={self.cache_indicator}")
         
     
+    @property
+    def num_spatial_local(self):
+        if self.kv_cache_sequence_parallel:
+            return self.num_spatial // dist.get_world_size(get_sequence_parallel_group())
+        return self.num_spatial
+
+    def _split_spatial_tokens(self,x):
+        '''(B,T,S,C) --> (B,T,S//sp_size,C), keep the spatial tokens of this sp_rank'''
+        if not self.kv_cache_sequence_parallel:
+            return x
+        sp_group = get_sequence_parallel_group()
+        S_local = self.num_spatial_local
+        sp_rank = dist.get_rank(sp_group)
+        return x[:,:,sp_rank*S_local:(sp_rank+1)*S_local,:]
+
+    def _gather_spatial_tokens(self,x,num_temporal):
+        '''(B,T*S_local,C) --> (B,T*S,C)'''
+        if not self.kv_cache_sequence_parallel:
+            return x
+        x = rearrange(x, "B (T S) C -> B T S C",T=num_temporal,S=self.num_spatial_local)
+        x = gather_forward_split_backward(x, get_sequence_parallel_group(), dim=2)
+        return rearrange(x, "B T S C -> B (T S) C")
+
+    def kv_cache_info(self):
+        '''kv-cache memory and the kv seqlen of attention for the next denoise call, used by the profiler'''
+        L_cache_accu = self.cache_indicator.sum().item()
+        info = dict(
+            cache_len = min(L_cache_accu, len(self.cache_indicator)), # temporal attn: kv_seqlen = cache_len + chunk_len (per spatial position)
+            cache_max_len = len(self.cache_indicator),
+            num_spatial = self.num_spatial_local,
+            temporal_kv_bytes = self.cache_kv.numel() * self.cache_kv.element_size(),
+            spatial_ctx_kv_bytes = 0,
+            spatial_ctx_len = 0,
+        )
+        if self.spatial_attn_enhance is not None:
+            info.update(
+                spatial_ctx_kv_bytes = self.spatial_ctx_kv.numel() * self.spatial_ctx_kv.element_size(),
+                spatial_ctx_len = self.spatial_ctx_kv.shape[2] * self.num_spatial, # cross-frame attn: kv_seqlen = T_p * S (gathered by all_to_all w/ seq parallel)
+            )
+        return info
+
     def process_text_embeddings_with_mask(self,y,mask):
         if self.y_embedder is None:
             # here y can be None
@@ -1050,6 +1177,79 @@ class CausalSTDiT2(nn.Module):
         
         return y,y_lens
 
+    # the steps of sampling w/ kv-cache, shared by `write_latents_to_cache`, `_forward_kv_cache` and `PipelineCausalSTDiT2`
+    def _kv_cache_mask_channel(self,x,write_cache):
+        '''(B, 1, T, 1, 1), all ones for the clean latents written to the kv-cache, all zeros for the chunk being denoised'''
+        return torch.ones_like(x[:,:1,:,:1,:1]) if write_cache else torch.zeros_like(x[:,:1,:,:1,:1])
+
+    def _embed_kv_cache(self,x):
+        '''(B, C, T, H, W) --> (B, T*S_local, C) tokens w/ pos_embed (S_local = S//sp_size w/ kv_cache_sequence_parallel)'''
+        num_temporal = x.shape[2]
+        x = self.x_embedder(x)  # [B, N, C]  # N = (16/1)*(32/2)*(32/2)
+        x = rearrange(x, "B (T S) C -> B T S C", T=num_temporal, S=self.num_spatial)
+        x = x + self.pos_embed
+        x = self._split_spatial_tokens(x) # (B, T, S_local, C) w/ kv_cache_sequence_parallel
+        return rearrange(x, "B T S C -> B (T S) C")
+
+    def _embed_timestep_kv_cache(self,timestep,dtype):
+        t = self.t_embedder(timestep, dtype=dtype)  # [B, C]
+        t_mlp = self.t_block(t)  # [B, C*6]
+        return t, t_mlp
+
+    def _run_blocks_kv_cache(self,x,y,t_mlp,y_lens,tpe,mask_channel,cached_kv_s,cached_kv_t,write_cache,block_offset=0,depth=None):
+        '''
+        run `self.blocks` w/ kv-cache, they are the blocks [block_offset, block_offset+len(self.blocks)) of a model of `depth` blocks
+        (a pipeline stage keeps part of the blocks, refer to `PipelineCausalSTDiT2`)
+        Args:
+            cached_kv_s, cached_kv_t: (len(self.blocks), B, ...)
+        Returns:
+            x, and the (spatial_kv, temporal_kv) of each block to write if `write_cache` (else an empty list)
+        '''
+        depth = len(self.blocks) if depth is None else depth
+        kv_cache_to_write = []
+        for i, block in enumerate(self.blocks):
+            block:CausalSTDiT2Block
+            block_idx = block_offset + i
+            if block_idx == 0:
+                tpe_input = tpe
+                mask_channel_input = mask_channel
+            else:
+                tpe_input = None
+                mask_channel_input = mask_channel if self.temp_extra_in_all_block else None
+
+            kv_t = None if cached_kv_t is None else cached_kv_t[i]
+            with profile_range("block",block_idx=block_idx):
+                if write_cache:
+                    # spatial kv-cache does not rely on previous spatial-kv-cache
+                    x, spatial_kv,temporal_kv = block.forward_kv_cache(
+                        x, y, t_mlp, y_lens, tpe_input, mask_channel_input, cached_kv=(None,kv_t),
+                        return_kv=True, return_kv_only = (block_idx == depth-1)
+                    )
+                    kv_cache_to_write.append((
+                        spatial_kv,     # (B, T_p, S, C*2)
+                        temporal_kv,    # (B, T, S, C*2)
+                    ))
+                else:
+                    kv_s = None if cached_kv_s is None else cached_kv_s[i]  # it can be None when spatial_attn_enhance is None
+                    x = block.forward_kv_cache(x, y, t_mlp, y_lens, tpe_input, mask_channel_input,cached_kv=(kv_s,kv_t), return_kv=False)
+        return x, kv_cache_to_write
+
+    def _stack_kv_cache(self,kv_cache_to_write):
+        '''[(spatial_kv, temporal_kv) of each block] --> (depth, B, T_p, S, C*2) or None, (depth, B, T, S, C*2)'''
+        if self.spatial_attn_enhance is not None:
+            spatial_kv  = torch.stack([st_kv[0] for st_kv in  kv_cache_to_write],dim=0)
+        else:
+            spatial_kv = None
+        temporal_kv = torch.stack([st_kv[1] for st_kv in  kv_cache_to_write],dim=0)
+        return spatial_kv, temporal_kv
+
+    def _final_kv_cache(self,x,t,num_temporal):
+        '''tokens --> (B, C_out, T, H, W)'''
+        x = self.final_layer(x, t, num_temporal=num_temporal)  # [B, N, C=T_p * H_p * W_p * C_out]
+        x = self._gather_spatial_tokens(x,num_temporal)
+        input_size = (num_temporal, self.input_size[1], self.input_size[2])
+        return self.unpatchify(x,input_size)  # [B, C_out, T, H, W]
+
     @torch.no_grad()
     def write_latents_to_cache(self,clean_x,y,mask):
         '''only write kv cache once after finish the whole denoising loop (use clean_x)
@@ -1057,82 +1257,49 @@ class CausalSTDiT2(nn.Module):
         # build timestep embedding with all t0's embedding
         # build mask_channel with all ones
         '''
-        
-        device = self.x_embedder.proj.weight.device
         dtype = self.x_embedder.proj.weight.dtype
-        
+
         x = clean_x.to(dtype)
         if y is not None: y = y.to(dtype)
         num_temporal = x.shape[2]
 
-        mask_channel = torch.ones_like(x[:,:1,:,:1,:1]) # (B, 1, T, 1, 1)
+        mask_channel = self._kv_cache_mask_channel(x,write_cache=True)
         timestep = torch.zeros_like(x[:,0,0,0,0]) # (B,)
 
         # embedding
-        x = self.x_embedder(x) # (B, N, C)
-        x = rearrange(x, "B (T S) C -> B T S C",T=num_temporal,S = self.num_spatial)
-        x = x + self.pos_embed
-        x = rearrange(x, "B T S C -> B (T S) C")
-
-        t = self.t_embedder(timestep, dtype=x.dtype)  # [B, C]
-        t_mlp = self.t_block(t)  # [B, C*6]
-
+        x = self._embed_kv_cache(x)
+        t, t_mlp = self._embed_timestep_kv_cache(timestep,x.dtype)
         y,y_lens = self.process_text_embeddings_with_mask(y,mask)
 
-
         # blocks
-        cached_kv_s,cached_kv_t = self._fetch_kv_cache() # this can be None for the 1st call (i.e., write the given 1st frame to kv-cache)
-        # cached_kv_s,  # (depth, B, T_p, S, C*2)
+        _,cached_kv_t = self._fetch_kv_cache() # this can be None for the 1st call (i.e., write the given 1st frame to kv-cache)
         # cached_kv_t  # (depth, B, T_accu, S, C*2)
-        cached_kv_s = None # overwtite it, spatial kv-cache does not rely on previous spatial-kv-cache
-        
-        kv_cache_to_write = []
         L_cache_accu = self.cache_indicator.sum().item() # this can be 0 for the 1st call (i.e., write the given 1st frame to kv-cache)
-        for i, block in enumerate(self.blocks):
-            block:CausalSTDiT2Block
-            if i == 0:
-                tpe = self.get_relative_tpe(
-                    chunk_len=num_temporal,
-                    chunk_start_idx=L_cache_accu,
-                    with_kv_cache=True
-                )
-                mask_channel_input = mask_channel
-            else:
-                tpe = None
-                mask_channel_input = mask_channel if self.temp_extra_in_all_block else None
-            
-            kv_s = None
-            kv_t = None if cached_kv_t is None else cached_kv_t[i]
-            cached_kv_i = (kv_s,kv_t)
-
-            x, spatial_kv,temporal_kv = block.forward_kv_cache(
-                x, y, t_mlp, y_lens, tpe, mask_channel_input, cached_kv=cached_kv_i,
-                return_kv=True, return_kv_only = (i == len(self.blocks)-1)
-            )
+        tpe = self.get_relative_tpe(chunk_len=num_temporal,chunk_start_idx=L_cache_accu,with_kv_cache=True)
+        _, kv_cache_to_write = self._run_blocks_kv_cache(
+            x, y, t_mlp, y_lens, tpe, mask_channel, None, cached_kv_t, write_cache=True
+        )
 
-            kv_cache_to_write.append((
-                spatial_kv,     # (B, T_p, S, C*2) 
-                temporal_kv,    # (B, T, S, C*2) 
-            ))
-        
-        if self.spatial_attn_enhance is not None:
-            spatial_kv  = torch.stack([st_kv[0] for st_kv in  kv_cache_to_write],dim=0) # (depth, B, T_p, S, C*2)
-        else:
-            spatial_kv = None
-        temporal_kv = torch.stack([st_kv[1] for st_kv in  kv_cache_to_write],dim=0) # (depth, B, T, S, C*2)
-        self._write_kv_cache(spatial_kv,temporal_kv)
+        spatial_kv, temporal_kv = self._stack_kv_cache(kv_cache_to_write)
+        with profile_range("cache_copy"):
+            self._write_kv_cache(spatial_kv,temporal_kv)
         
     
     @torch.no_grad()
     def forward_kv_cache(self,x,timestep,y,mask,start_id=None):
+        if (profiler := get_profiler()) is not None:
+            profiler.next_denoise_step()
+        with profile_range("denoise_step"):
+            return self._forward_kv_cache(x,timestep,y,mask,start_id=start_id)
+
+    def _forward_kv_cache(self,x,timestep,y,mask,start_id=None):
         assert not self.training
-        # assert not self.enable_sequence_parallelism
         # NOTE `self.enable_sequence_parallelism` can be `True`, 
-        # i.e., training with seq parallel, and `block.temp_attn` is `SeqParallelCausalSelfAttention`
-        # but we don't use seq parallel at inference time,  
-        # TODO: consider seq parallel
+        # i.e., training with seq parallel (along the temporal axis), and `block.temp_attn` is `SeqParallelAttentionWithContext`
+        # at inference time we do not split the temporal axis (the chunk is short and the kv-cache is appended along it), 
+        # instead, w/ `kv_cache_sequence_parallel`, the spatial tokens (and their kv-cache) are split across the seq parallel group,
+        # temporal attn is rank-local, spatial attn & cross-frame attn use all_to_all (scatter heads, gather spatial tokens)
 
-        device = self.x_embedder.proj.weight.device
         dtype = self.x_embedder.proj.weight.dtype
          
         num_temporal = x.shape[2]
@@ -1141,26 +1308,18 @@ class CausalSTDiT2(nn.Module):
         x = x.to(dtype)
         # timestep = timestep.to(dtype)
         if y is not None: y = y.to(dtype)
-        mask_channel = torch.zeros_like(x[:,:1,:,:1,:1]) # (B, 1, T, 1, 1)
-
+        mask_channel = self._kv_cache_mask_channel(x,write_cache=False)
 
         # embedding
-        x = self.x_embedder(x)  # [B, N, C]  # N = (16/1)*(32/2)*(32/2)
-        x = rearrange(x, "B (T S) C -> B T S C", T=num_temporal, S=self.num_spatial)
-        x = x + self.pos_embed
-        x = rearrange(x, "B T S C -> B (T S) C")
-
-        
-        t = self.t_embedder(timestep, dtype=x.dtype)  # [B, C]
-        t_mlp = self.t_block(t)  # [B, C*6]
-
+        x = self._embed_kv_cache(x)
+        t, t_mlp = self._embed_timestep_kv_cache(timestep,x.dtype)
         y,y_lens = self.process_text_embeddings_with_mask(y,mask)
 
-
         # blocks
-        cached_kv_s,cached_kv_t = self._fetch_kv_cache() # this can be None for the 1st call (i.e., write the given 1st frame to kv-cache)
+        cached_kv_s,cached_kv_t = self._fetch_kv_cache()
         # cached_kv_s,  # (depth, B, T_p, S, C*2)
         # cached_kv_t  # (depth, B, T_accu, S, C*2)
+        # (S = S_local w/ kv_cache_sequence_parallel)
         L_cache_accu = self.cache_indicator.sum().item() 
         assert L_cache_accu > 0 , "call `write_latents_to_cache` first"
         assert cached_kv_t is not None,  "call `write_latents_to_cache` first"
@@ -1168,33 +1327,14 @@ class CausalSTDiT2(nn.Module):
         if start_id is not None:
             # start_id is used in old-version code, remove this ideally
             assert start_id == L_cache_accu, f"start_id={start_id},L_cache_accu={L_cache_accu} " 
-        
-        for i, block in enumerate(self.blocks):
-            block:CausalSTDiT2Block
-            if i == 0:
-                tpe = self.get_relative_tpe(
-                    chunk_len=num_temporal,
-                    chunk_start_idx=L_cache_accu,
-                    with_kv_cache=True
-                )
-
-                mask_channel_input = mask_channel
-            else:
-                tpe = None
-                mask_channel_input = mask_channel if self.temp_extra_in_all_block else None
 
-            kv_s = None if cached_kv_s is None else cached_kv_s[i]  # it can be None when spatial_attn_enhance is None
-            kv_t = cached_kv_t[i]
-            cached_kv_i = (kv_s,kv_t)
-            x = block.forward_kv_cache(x, y, t_mlp, y_lens, tpe, mask_channel_input,cached_kv=cached_kv_i, return_kv=False)
+        tpe = self.get_relative_tpe(chunk_len=num_temporal,chunk_start_idx=L_cache_accu,with_kv_cache=True)
+        x, _ = self._run_blocks_kv_cache(
+            x, y, t_mlp, y_lens, tpe, mask_channel, cached_kv_s, cached_kv_t, write_cache=False
+        )
 
-        
         # final process
-        x = self.final_layer(x, t, num_temporal=num_temporal)  # [B, N, C=T_p * H_p * W_p * C_out]
-        input_size = (num_temporal, self.input_size[1], self.input_size[2])
-        x = self.unpatchify(x,input_size)  # [B, C_out, T, H, W]
-
-
+        x = self._final_kv_cache(x,t,num_temporal)
         x = x.to(torch.float32) # cast to float32 for better accuracy
         return x
     
@@ -1308,13 +1448,29 @@ class CausalSTDiT2(nn.Module):
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
 
+def build_and_load(build_fn,from_pretrained=None,load_device=None,load_dtype=None,save_as_pt=False):
+    '''
+    if `load_device` is given, the model is built w/o random init and its params are materialized from the memory-mapped
+    checkpoint directly on `load_device` with `load_dtype` (refer to `load_checkpoint_lazy`), e.g., for inference.
+    Otherwise (or if the checkpoint can not be loaded lazily), build on CPU and use `load_checkpoint` as before
+    '''
+    if from_pretrained is not None and load_device is not None:
+        model = load_checkpoint_lazy(build_fn,from_pretrained,device=load_device,dtype=load_dtype)
+        if model is not None:
+            return model
+    
+    model = build_fn()
+    if from_pretrained is not None:
+        load_checkpoint(model, from_pretrained,save_as_pt=save_as_pt)
+    return model
+
+
 @MODELS.register_module("CausalSTDiT2-XL/2")
-def CausalSTDiT2_XL_2(from_pretrained=None,from_scratch=None, **kwargs):
+def CausalSTDiT2_XL_2(from_pretrained=None,from_scratch=None,load_device=None,load_dtype=None, **kwargs):
     if "t_win_size" in kwargs: # support old version code
         kwargs.pop("t_win_size")
-    model = CausalSTDiT2(depth=28, hidden_size=1152, patch_size=(1, 2, 2), num_heads=16, **kwargs)
-    if from_pretrained is not None:
-        load_checkpoint(model, from_pretrained,save_as_pt=True)
+    build_fn = functools.partial(CausalSTDiT2,depth=28, hidden_size=1152, patch_size=(1, 2, 2), num_heads=16, **kwargs)
+    model = build_and_load(build_fn,from_pretrained,load_device,load_dtype,save_as_pt=True)
     if from_scratch is not None:
         assert from_scratch in ["temporal"] # TODO add other parts
         print(f"train {from_scratch} part from_scratch")
@@ -1328,18 +1484,16 @@ def CausalSTDiT2_XL_2(from_pretrained=None,from_scratch=None, **kwargs):
 
 # a tiny model for debug
 @MODELS.register_module("CausalSTDiT2-Tiny") 
-def CausalSTDiT2_Tiny(from_pretrained=None,from_scratch=None, **kwargs):
-    model = CausalSTDiT2(depth=2, hidden_size=1152, patch_size=(1, 2, 2), num_heads=16, **kwargs)
-    if from_pretrained is not None:
-        load_checkpoint(model, from_pretrained)
+def CausalSTDiT2_Tiny(from_pretrained=None,from_scratch=None,load_device=None,load_dtype=None, **kwargs):
+    build_fn = functools.partial(CausalSTDiT2,depth=2, hidden_size=1152, patch_size=(1, 2, 2), num_heads=16, **kwargs)
+    model = build_and_load(build_fn,from_pretrained,load_device,load_dtype)
     
     return model
 
 # Base model
 @MODELS.register_module("CausalSTDiT2-Base") 
-def CausalSTDiT2_Base(from_pretrained=None,from_scratch=None, **kwargs):
-    model = CausalSTDiT2(depth=14, hidden_size=1152, patch_size=(1, 2, 2), num_heads=16, **kwargs)
-    if from_pretrained is not None:
-        load_checkpoint(model, from_pretrained)
+def CausalSTDiT2_Base(from_pretrained=None,from_scratch=None,load_device=None,load_dtype=None, **kwargs):
+    build_fn = functools.partial(CausalSTDiT2,depth=14, hidden_size=1152, patch_size=(1, 2, 2), num_heads=16, **kwargs)
+    model = build_and_load(build_fn,from_pretrained,load_device,load_dtype)
 
     return model
\ No newline at end of file
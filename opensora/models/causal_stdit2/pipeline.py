@@ -0,0 +1,180 @@
+import warnings
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+from opensora.acceleration.parallel_states import get_pipeline_parallel_group
+from opensora.utils.profiling import profile_range, get_profiler
+
+from .causal_stdit2 import CausalSTDiT2
+
+'''
+depth-pipelined inference w/ kv-cache for CausalSTDiT2
+
+the blocks are partitioned (contiguous) across the ranks of the pipeline group, each stage keeps only its blocks
+and the kv-cache of its layers, i.e., (depth // num_stages, B, max_seqlen, S, C*2) instead of (depth, ...)
+
+all ranks run the same sampler (same noise), for each model call the batch (incl. the 2 halves of cls-free guidance)
+is split into micro-batches, and the hidden states of a micro-batch are sent to the next stage (isend) as soon as
+they are ready, so that stage i works on micro-batch m while stage i+1 works on micro-batch m-1 (GPipe-style, forward only)
+the pipeline bubble of each call is (num_stages-1)/(num_micro_batches+num_stages-1), and the micro-batches come from
+the batch only, i.e., num_micro_batches <= B. So the pipeline needs B >= num_stages to keep the stages busy, e.g.,
+for 4 stages, sample 2 videos (prompts) at once w/ cls-free guidance (B=4), w/ B=2 the bubble is 3/5 of each call.
+`validation_visualize` batches the compatible examples for this (refer to `get_val_batch_size` in opensora/utils/video_gen.py)
+by default, num_micro_batches = num_stages (one micro-batch per stage, clamped to B)
+the denoised output is broadcast from the last stage, so that all ranks continue the same sampling loop,
+it is (B, C_out, T, H, W), i.e., C_out/hidden_size (e.g., 8/1152) of the hidden states sent between the stages
+
+the small embedders (x/t/y) and the final layer are kept on each stage, only the hidden states are communicated
+'''
+
+
+def partition_blocks(depth, num_stages):
+    '''contiguous & balanced, the first `depth % num_stages` stages take one more block, return [(start,end),...]'''
+    assert depth >= num_stages, f"depth={depth} < num_stages={num_stages}"
+    sizes = [depth // num_stages + (1 if i < depth % num_stages else 0) for i in range(num_stages)]
+    starts = [sum(sizes[:i]) for i in range(num_stages)]
+    return [(start, start + size) for start, size in zip(starts, sizes)]
+
+
+class PipelineCausalSTDiT2(nn.Module):
+    '''
+    wrap a (built & loaded) CausalSTDiT2 as one pipeline stage, it can be used in place of the model in `autoregressive_sample_kv_cache`
+    Args:
+        model: the complete model, the blocks of other stages are removed in-place
+        num_micro_batches: number of micro-batches of each model call (at most the batch size), default the number of stages
+        group: the pipeline group, default `get_pipeline_parallel_group()`
+    '''
+    def __init__(self, model: CausalSTDiT2, num_micro_batches=None, group=None):
+        super().__init__()
+        assert not model.kv_cache_sequence_parallel, "TODO: combine pipeline with kv_cache_sequence_parallel"
+        self.pipeline_group = group if group is not None else get_pipeline_parallel_group()
+        assert self.pipeline_group is not None, "call `set_pipeline_parallel_group` first"
+        self.num_stages = dist.get_world_size(self.pipeline_group)
+        self.stage = dist.get_rank(self.pipeline_group)
+        self.num_micro_batches = self.num_stages if num_micro_batches is None else num_micro_batches
+
+        self.depth = model.depth
+        self.block_range = partition_blocks(model.depth, self.num_stages)[self.stage]
+        start, end = self.block_range
+        model.blocks = nn.ModuleList(model.blocks[start:end])
+        model.depth = end - start  # so that `model.register_kv_cache` only allocates the cache of this stage
+        self.model = model
+
+        self.is_first_stage = self.stage == 0
+        self.is_last_stage = self.stage == self.num_stages - 1
+        self.prev_rank = None if self.is_first_stage else dist.get_global_rank(self.pipeline_group, self.stage - 1)
+        self.next_rank = None if self.is_last_stage else dist.get_global_rank(self.pipeline_group, self.stage + 1)
+        self.last_rank = dist.get_global_rank(self.pipeline_group, self.num_stages - 1)
+
+    @property
+    def y_embedder(self):
+        return self.model.y_embedder
+
+    @property
+    def relative_tpe_mode(self):
+        return self.model.relative_tpe_mode
+
+    def register_kv_cache(self, bsz, max_seq_len=None, kv_cache_dequeue=True):
+        self.model.register_kv_cache(bsz, max_seq_len=max_seq_len, kv_cache_dequeue=kv_cache_dequeue)
+
+    def empty_kv_cache(self):
+        self.model.empty_kv_cache()
+
+    def reset_kv_cache(self):
+        self.model.reset_kv_cache()
+
+    def kv_cache_info(self):
+        return dict(stage=self.stage, block_range=list(self.block_range), **self.model.kv_cache_info())
+
+    @torch.no_grad()
+    def write_latents_to_cache(self, clean_x, y, mask):
+        timestep = torch.zeros_like(clean_x[:, 0, 0, 0, 0])  # (B,)
+        self._pipeline_forward(clean_x, timestep, y, mask, write_cache=True)
+
+    @torch.no_grad()
+    def forward(self, x, timestep, y=None, mask=None, **kwargs):
+        assert self.model._kv_cache_registered, "pipeline inference is only for sampling w/ kv-cache"
+        if (profiler := get_profiler()) is not None:
+            profiler.next_denoise_step()
+        with profile_range("denoise_step"):
+            return self._pipeline_forward(x, timestep, y, mask, write_cache=False)
+
+    def _pipeline_forward(self, x, timestep, y, mask, write_cache):
+        '''the same steps as `CausalSTDiT2._forward_kv_cache` / `write_latents_to_cache`, on the blocks of this stage'''
+        model = self.model
+        dtype = model.x_embedder.proj.weight.dtype
+        device = model.x_embedder.proj.weight.device
+        B, _, num_temporal, H, W = x.shape
+        assert model.patch_size[0] == 1
+
+        x = x.to(dtype)
+        if y is not None:
+            y = y.to(dtype)
+            if mask is not None and mask.shape[0] != y.shape[0]:  # this happens when using cls_free_guidance
+                mask = mask.repeat(y.shape[0] // mask.shape[0], 1)
+        mask_channel = model._kv_cache_mask_channel(x, write_cache)
+
+        cached_kv_s, cached_kv_t = model._fetch_kv_cache()
+        if write_cache:
+            cached_kv_s = None
+        else:
+            assert cached_kv_t is not None, "call `write_latents_to_cache` first"
+        L_cache_accu = model.cache_indicator.sum().item()
+        tpe = model.get_relative_tpe(chunk_len=num_temporal, chunk_start_idx=L_cache_accu, with_kv_cache=True)
+
+        hidden_shape = (num_temporal * model.num_spatial, model.hidden_size)
+        if B < self.num_stages:
+            warnings.warn(
+                f"batch size {B} < {self.num_stages} pipeline stages, the pipeline bubble is "
+                f"{self.num_stages - 1}/{B + self.num_stages - 1} of each call, sample more videos at once"
+            )
+        micro_batches = [(int(ids[0]), int(ids[-1]) + 1) for ids in torch.arange(B).tensor_split(min(self.num_micro_batches, B))]
+        send_handles, outputs, kv_to_write = [], [], []
+        for b0, b1 in micro_batches:
+            t, t_mlp = model._embed_timestep_kv_cache(timestep[b0:b1], dtype)
+            y_micro, y_lens = model.process_text_embeddings_with_mask(
+                None if y is None else y[b0:b1],
+                None if mask is None else mask[b0:b1],
+            )
+
+            if self.is_first_stage:
+                h = model._embed_kv_cache(x[b0:b1])
+            else:
+                h = torch.empty(size=(b1 - b0, *hidden_shape), device=device, dtype=dtype)
+                with profile_range("recv"):
+                    dist.recv(h, src=self.prev_rank, group=self.pipeline_group)
+
+            h, kv_micro = model._run_blocks_kv_cache(
+                h, y_micro, t_mlp, y_lens, tpe, mask_channel[b0:b1],
+                None if cached_kv_s is None else cached_kv_s[:, b0:b1],
+                None if cached_kv_t is None else cached_kv_t[:, b0:b1],
+                write_cache, block_offset=self.block_range[0], depth=self.depth,
+            )
+
+            if not self.is_last_stage:
+                send_handles.append(dist.isend(h.contiguous(), dst=self.next_rank, group=self.pipeline_group))
+            elif not write_cache:
+                outputs.append(model._final_kv_cache(h, t, num_temporal))
+            kv_to_write.append(kv_micro)
+
+        for handle in send_handles:
+            handle.wait()
+
+        if write_cache:
+            # cat micro-batches, (depth_of_stage, B, T_p or T, S, C*2)
+            kv_to_write = [model._stack_kv_cache(kv_micro) for kv_micro in kv_to_write]
+            spatial_kv = None if kv_to_write[0][0] is None else torch.cat([kv[0] for kv in kv_to_write], dim=1)
+            temporal_kv = torch.cat([kv[1] for kv in kv_to_write], dim=1)
+            with profile_range("cache_copy"):
+                model._write_kv_cache(spatial_kv, temporal_kv)
+            return None
+
+        if self.is_last_stage:
+            out = torch.cat(outputs, dim=0)  # (B, C_out, T, H, W)
+        else:
+            out = torch.empty(size=(B, model.out_channels, num_temporal, H, W), device=device, dtype=dtype)
+        with profile_range("broadcast"):
+            dist.broadcast(out, src=self.last_rank, group=self.pipeline_group)
+        return out.to(torch.float32)  # cast to float32 for better accuracy
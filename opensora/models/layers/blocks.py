@@ -323,8 +323,9 @@ class MultiHeadCrossAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.scale = self.head_dim**-0.5
 
-    def forward(self, x, cond, mask=None):
+    def forward(self, x, cond, mask=None, q_seqlens=None):
         # query/value: img tokens; key: condition; mask: if padding tokens
+        # q_seqlens: for packed sequences, number of img tokens of each cond, default: [N] * B
         B, N, C = x.shape
 
         q = self.q_linear(x).view(1, -1, self.num_heads, self.head_dim)
@@ -367,7 +368,7 @@ class MultiHeadCrossAttention(nn.Module):
         else:
             attn_bias = None
             if mask is not None:
-                attn_bias = xformers.ops.fmha.BlockDiagonalMask.from_seqlens([N] * B, mask)
+                attn_bias = xformers.ops.fmha.BlockDiagonalMask.from_seqlens([N] * B if q_seqlens is None else q_seqlens, mask)
             # print(attn_bias,N,B)
             # print(mask)
             x = xformers.ops.memory_efficient_attention(q, k, v, p=self.attn_drop.p, attn_bias=attn_bias)
@@ -1,61 +1,193 @@
 import torch
 import torch.nn as nn
-import diffusers
-print(diffusers,f"version = {diffusers.__version__}")
-from diffusers.models import AutoencoderKL
-try:
-    from diffusers.models import AutoencoderKLTemporalDecoder
-except:
-    print("AutoencoderKLTemporalDecoder not available")
-
 from einops import rearrange
 
 from opensora.registry import MODELS
 
 
+def get_available_memory(device):
+    """free device memory, including the memory cached (but not allocated) by the torch allocator, None for non-cuda devices"""
+    if device.type != "cuda":
+        return None
+    free, _ = torch.cuda.mem_get_info(device)
+    return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+
 @MODELS.register_module()
 class VideoAutoencoderKL(nn.Module):
-    def __init__(self, from_pretrained=None, micro_batch_size=None, cache_dir=None, local_files_only=False):
+    def __init__(
+        self,
+        from_pretrained=None,
+        micro_batch_size=None,
+        cache_dir=None,
+        local_files_only=False,
+        tile_sample_size=256,
+        tile_overlap=32,
+    ):
+        """
+        Args:
+            micro_batch_size (int | str | None): number of frames per VAE forward. `None` processes all frames at once,
+                "auto" starts from all frames and halves on OOM, the size that fits is cached per (op, N, H, W, dtype),
+                and a later call tries the double of it if more GPU memory is available than when it went OOM.
+            tile_sample_size (int | None): frames larger than this (in pixels) are decoded in spatial tiles
+                of this size, overlapping by `tile_overlap` pixels and linearly blended. `None` disables tiling,
+                by default only resolutions above 256x256 are tiled.
+        """
         super().__init__()
+        import diffusers # imported here, so that importing this module (or the registry) does not import diffusers
+        from diffusers.models import AutoencoderKL
+        print(diffusers,f"version = {diffusers.__version__}")
         self.module = AutoencoderKL.from_pretrained(
             from_pretrained, cache_dir=cache_dir, local_files_only=local_files_only
         )
         self.out_channels = self.module.config.latent_channels
         self.patch_size = (1, 8, 8)
         self.micro_batch_size = micro_batch_size
+        self.tile_sample_size = tile_sample_size
+        self.tile_overlap = tile_overlap
+        self._auto_micro_batch_size = dict()  # (op, N, H, W, dtype) -> (micro batch size that fits, available memory at OOM)
+        self._tile_plans = dict()  # (h, w, dtype, device) -> list of (h_slice, w_slice, blend_weight)
+
+    def _run_micro_batched(self, fn, x, op, out_device=None):
+        # x: (N, C, H, W), N = B*T
+        # out_device: where the output is gathered (default x.device), e.g., "cpu", so that the GPU holds one micro-batch of output
+        N = x.shape[0]
+        auto = self.micro_batch_size == "auto"
+        key = (op, N, *x.shape[-2:], x.dtype)
+        if auto:
+            available = get_available_memory(x.device)
+            bs, oom_available = self._auto_micro_batch_size.get(key, (N, None))
+            if oom_available is not None and available is not None and available > oom_available:
+                bs = min(N, bs * 2)  # re-probe a larger micro batch, it is halved back if it still goes OOM
+        else:
+            bs = N if self.micro_batch_size is None else self.micro_batch_size
+
+        x_out = None  # preallocated, so that no extra copy of the whole output is made by torch.cat
+        i = 0
+        while i < N:
+            oom = False
+            try:
+                x_bs = fn(x[i : i + bs])
+            except torch.cuda.OutOfMemoryError:
+                if not auto or bs == 1:
+                    raise
+                # only set a flag here: the traceback references the activations of the failed `fn`,
+                # which are freed only after leaving the except block
+                oom = True
+            if oom:
+                bs = max(1, bs // 2)
+                oom_available = available
+                torch.cuda.empty_cache()
+                continue
+            if x_out is None:
+                x_out = x_bs.new_empty((N,) + x_bs.shape[1:], device=out_device)
+            x_out[i : i + x_bs.shape[0]] = x_bs
+            i += x_bs.shape[0]
+            del x_bs
+
+        if auto:
+            self._auto_micro_batch_size[key] = (bs, oom_available)
+        return x_out
+
+    def _encode_frames(self, x):
+        return self.module.encode(x).latent_dist.sample().mul_(0.18215)
+
+    def _encode_moments_frames(self, x):
+        latent_dist = self.module.encode(x).latent_dist
+        return torch.cat([latent_dist.mean, latent_dist.std], dim=1).mul_(0.18215)
+
+    def _decode_frames(self, x):
+        h, w = x.shape[-2:]
+        if self.tile_sample_size is None or max(h, w) * self.patch_size[1] <= self.tile_sample_size:
+            return self.module.decode(x / 0.18215).sample
+
+        x_out = None
+        for h_slice, w_slice, weight in self._get_tile_plan(h, w, x.dtype, x.device):
+            tile = self.module.decode(x[:, :, h_slice, w_slice] / 0.18215).sample
+            if x_out is None:
+                x_out = tile.new_zeros(tile.shape[:2] + (h * self.patch_size[1], w * self.patch_size[2]))
+            ph = slice(h_slice.start * self.patch_size[1], h_slice.stop * self.patch_size[1])
+            pw = slice(w_slice.start * self.patch_size[2], w_slice.stop * self.patch_size[2])
+            x_out[:, :, ph, pw] += tile * weight
+        return x_out
+
+    def _get_tile_plan(self, h, w, dtype, device):
+        """
+        split the (h, w) latent into overlapping tiles, the blend weights ramp linearly inside the overlaps
+        and are normalized so that they sum to 1 at each output pixel
+        """
+        key = (h, w, dtype, device)
+        if key in self._tile_plans:
+            return self._tile_plans[key]
+
+        ps = self.patch_size[1]
+        tile = self.tile_sample_size // ps
+        overlap = min(self.tile_overlap // ps, tile - 1)
+
+        def get_starts(size):
+            if size <= tile:
+                return [0]
+            starts = list(range(0, size - tile + 1, tile - overlap))
+            if starts[-1] + tile < size:
+                starts.append(size - tile)
+            return starts
+
+        def get_ramp(start, length, size):
+            ramp = torch.ones(length * ps)
+            n = overlap * ps
+            if n > 0:
+                edge = (torch.arange(n) + 0.5) / n
+                if start > 0:
+                    ramp[:n] = torch.minimum(ramp[:n], edge)
+                if start + length < size:
+                    ramp[-n:] = torch.minimum(ramp[-n:], edge.flip(0))
+            return ramp
+
+        tiles = []
+        norm = torch.zeros(h * ps, w * ps)
+        for hs in get_starts(h):
+            for ws in get_starts(w):
+                h_slice, w_slice = slice(hs, min(hs + tile, h)), slice(ws, min(ws + tile, w))
+                weight = torch.outer(
+                    get_ramp(hs, h_slice.stop - hs, h),
+                    get_ramp(ws, w_slice.stop - ws, w),
+                )
+                norm[hs * ps : h_slice.stop * ps, ws * ps : w_slice.stop * ps] += weight
+                tiles.append((h_slice, w_slice, weight))
+
+        plan = []
+        for h_slice, w_slice, weight in tiles:
+            weight = weight / norm[h_slice.start * ps : h_slice.stop * ps, w_slice.start * ps : w_slice.stop * ps]
+            plan.append((h_slice, w_slice, weight.to(device=device, dtype=dtype)))
+        self._tile_plans[key] = plan
+        return plan
 
     def encode(self, x):
         # x: (B, C, T, H, W)
         B = x.shape[0]
         x = rearrange(x, "B C T H W -> (B T) C H W")
-
-        if self.micro_batch_size is None:
-            x = self.module.encode(x).latent_dist.sample().mul_(0.18215)
-        else:
-            bs = self.micro_batch_size
-            x_out = []
-            for i in range(0, x.shape[0], bs):
-                x_bs = x[i : i + bs]
-                x_bs = self.module.encode(x_bs).latent_dist.sample().mul_(0.18215)
-                x_out.append(x_bs)
-            x = torch.cat(x_out, dim=0)
+        x = self._run_micro_batched(self._encode_frames, x, "encode")
         x = rearrange(x, "(B T) C H W -> B C T H W", B=B)
         return x
 
-    def decode(self, x):
+    def encode_moments(self, x):
+        """
+        the (scaled) mean and std of the posterior, `encode(x)` is a sample of `mean + std * randn`
+        Return:
+            (B, 2, C, T, h, w), [:, 0] is the mean and [:, 1] is the std
+        """
+        B = x.shape[0]
+        x = rearrange(x, "B C T H W -> (B T) C H W")
+        x = self._run_micro_batched(self._encode_moments_frames, x, "encode_moments")
+        x = rearrange(x, "(B T) (M C) H W -> B M C T H W", B=B, M=2)
+        return x
+
+    def decode(self, x, out_device=None):
         # x: (B, C, T, H, W)
+        # out_device: e.g., "cpu" for long videos, so that the decoded frames are offloaded once each micro-batch is finished
         B = x.shape[0]
         x = rearrange(x, "B C T H W -> (B T) C H W")
-        if self.micro_batch_size is None:
-            x = self.module.decode(x / 0.18215).sample
-        else:
-            bs = self.micro_batch_size
-            x_out = []
-            for i in range(0, x.shape[0], bs):
-                x_bs = x[i : i + bs]
-                x_bs = self.module.decode(x_bs / 0.18215).sample
-                x_out.append(x_bs)
-            x = torch.cat(x_out, dim=0)
+        x = self._run_micro_batched(self._decode_frames, x, "decode", out_device)
         x = rearrange(x, "(B T) C H W -> B C T H W", B=B)
         return x
 
@@ -81,6 +213,7 @@ class VideoAutoencoderKL(nn.Module):
 class VideoAutoencoderKLTemporalDecoder(nn.Module):
     def __init__(self, from_pretrained=None, cache_dir=None, local_files_only=False):
         super().__init__()
+        from diffusers.models import AutoencoderKLTemporalDecoder
         self.module = AutoencoderKLTemporalDecoder.from_pretrained(
             from_pretrained, cache_dir=cache_dir, local_files_only=local_files_only
         )
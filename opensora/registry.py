@@ -1,4 +1,5 @@
 from copy import deepcopy
+from importlib import import_module
 
 import torch.nn as nn
 from mmengine.registry import Registry
@@ -28,17 +29,79 @@ def build_module(module, builder, **kwargs):
         raise TypeError(f"Only support dict and nn.Module, but got {type(module)}.")
 
 
-MODELS = Registry(
+class LazyRegistry(Registry):
+    '''
+    a Registry that imports the module of a type only when this type is built (or got) for the first time,
+    instead of importing all modules in `locations` (e.g., all model families, diffusers, transformers, ...) at once.
+    Args:
+        lazy_modules (dict): {registered type name: module that registers it}.
+            Types that are not listed here are looked up by importing all modules in `lazy_modules`
+    '''
+
+    def __init__(self, name, lazy_modules, **kwargs):
+        super().__init__(name, **kwargs)
+        self.lazy_modules = lazy_modules
+
+    def get(self, key):
+        if isinstance(key, str) and key not in self._module_dict:
+            if key in self.lazy_modules:
+                import_module(self.lazy_modules[key])
+            else:
+                for module_name in dict.fromkeys(self.lazy_modules.values()):
+                    import_module(module_name)
+        return super().get(key)
+
+
+MODELS = LazyRegistry(
     "model",
-    locations=["opensora.models"],
+    lazy_modules={
+        "DiT": "opensora.models.dit.dit",
+        "DiT-XL/2": "opensora.models.dit.dit",
+        "DiT-XL/2x2": "opensora.models.dit.dit",
+        "Latte": "opensora.models.latte.latte",
+        "Latte-XL/2": "opensora.models.latte.latte",
+        "Latte-XL/2x2": "opensora.models.latte.latte",
+        "PixArt": "opensora.models.pixart.pixart",
+        "PixArtMS": "opensora.models.pixart.pixart",
+        "PixArt-XL/2": "opensora.models.pixart.pixart",
+        "PixArtMS-XL/2": "opensora.models.pixart.pixart",
+        "STDiT": "opensora.models.stdit.stdit",
+        "STDiT-XL/2": "opensora.models.stdit.stdit",
+        "STDiT2": "opensora.models.stdit.stdit2",
+        "STDiT2-XL/2": "opensora.models.stdit.stdit2",
+        "CausalSTDiT2": "opensora.models.causal_stdit2.causal_stdit2",
+        "CausalSTDiT2-XL/2": "opensora.models.causal_stdit2.causal_stdit2",
+        "CausalSTDiT2-Tiny": "opensora.models.causal_stdit2.causal_stdit2",
+        "CausalSTDiT2-Base": "opensora.models.causal_stdit2.causal_stdit2",
+        "VideoAutoencoderKL": "opensora.models.vae.vae",
+        "VideoAutoencoderKLTemporalDecoder": "opensora.models.vae.vae",
+        "t5": "opensora.models.text_encoder.t5",
+        "clip": "opensora.models.text_encoder.clip",
+        "classes": "opensora.models.text_encoder.classes",
+    },
 )
 
-SCHEDULERS = Registry(
+SCHEDULERS = LazyRegistry(
     "scheduler",
-    locations=["opensora.schedulers"],
+    lazy_modules={
+        "iddpm": "opensora.schedulers.iddpm",
+        "clean_prefix_iddpm": "opensora.schedulers.iddpm",
+        "iddpm-speed": "opensora.schedulers.iddpm.speed",
+        "dpm-solver": "opensora.schedulers.dpms",
+    },
 )
 
-DATASETS = Registry(
+DATASETS = LazyRegistry(
     "dataset",
-    locations=["opensora.datasets"],
+    lazy_modules={
+        "VideoTextDataset": "opensora.datasets.datasets",
+        "VariableVideoTextDataset": "opensora.datasets.datasets",
+        "VideoTextDatasetFromJson": "opensora.datasets.datasets2",
+        "VideoDatasetForVal": "opensora.datasets.datasets2",
+        "SkyTimelapseDataset": "opensora.datasets.skytimelapse_dataset",
+        "SkyTimelapsePackedDataset": "opensora.datasets.skytimelapse_dataset",
+        "SkyTimelapseDatasetForEvalFVD": "opensora.datasets.skytimelapse_dataset",
+        "SkyTimelapseDatasetEvalImg2Vid_old": "opensora.datasets.skytimelapse_dataset",
+        "LatentTextDataset": "opensora.datasets.latent_dataset",
+    },
 )
@@ -1,2 +1,13 @@
-from .dpms import DPMS
-from .iddpm import IDDPM
+from importlib import import_module
+
+# imported lazily, refer to `opensora.registry.SCHEDULERS`
+_LAZY_ATTRS = {
+    "DPMS": "opensora.schedulers.dpms",
+    "IDDPM": "opensora.schedulers.iddpm",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        return getattr(import_module(_LAZY_ATTRS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,6 +1,7 @@
 from functools import partial
 import math
 import torch
+from einops import rearrange
 
 from opensora.registry import SCHEDULERS
 
@@ -403,6 +404,107 @@ class CleanPrefixIDDPM(IDDPM):
         return terms
     
 
+    def training_losses_clean_prefix_packed(self, model, *args, **kwargs):
+        return self._training_losses_clean_prefix_packed(self._wrap_model( model), *args, **kwargs)
+
+    def _training_losses_clean_prefix_packed(self,model,x_start,t,model_kwargs=None,noise=None):
+        '''variable-length clips (and prefix lengths) are packed along the temporal axis, e.g.,
+                    [segment 0                  | segment 1                  | ...]
+                    [clean_prefix | noisy latents| clean_prefix | noisy latents| ...]
+        mask_channel[1,1,...,   1,| 0,0,...,   0,| 1,...,      1,| 0,...,     0,| ...]
+        loss_mask   [0,0,...,   0,| 1,1,...,   1,| 0,...,      0,| 1,...,     1,| ...]
+        t           [t0,t0,...,                t0,| t1,...,                   t1,| ...]
+
+        x_start: (1,C,T,H,W), T = sum(model_kwargs["segment_lens"]), no padding
+        t: (T,), per-frame diffusion timestep, the same inside each segment
+        Returns:
+            terms, each term has shape (num_segments,), i.e., the same as the un-packed batch
+        '''
+        assert model_kwargs is not None
+        segment_lens = model_kwargs["segment_lens"] # NOTE do not pop this
+        loss_mask = model_kwargs.pop("loss_mask") # (1,c,T,h,w)
+        mask_channel = model_kwargs["mask_channel"] # (1,1,T,1,1); NOTE do not pop this
+        assert x_start.shape[0] == 1 and len(t) == x_start.shape[2] == sum(segment_lens)
+
+        # put frames to the batch dim, so that the per-frame `t` works with `q_sample`, `q_posterior_mean_variance`, etc.
+        to_frames = lambda z: rearrange(z, "1 C T H W -> T C 1 H W")
+        from_frames = lambda z: rearrange(z, "T C 1 H W -> 1 C T H W")
+
+        if noise is None:
+            noise = torch.randn_like(x_start)
+        x_t = from_frames(self.q_sample(to_frames(x_start), t, noise=to_frames(noise)))
+
+        x_clean_mask = mask_channel.expand_as(x_t).type(torch.bool)
+        x_t = torch.where(x_clean_mask,x_start,x_t)
+        pp_t= model_kwargs.pop("prefix_perturb_t",-1)
+        if pp_t >= 0 :
+            pp_t = torch.zeros_like(t) + pp_t # (T,)
+            perturb_noise = torch.randn_like(x_start)
+            x_clean_perturbed = from_frames(self.q_sample(to_frames(x_start),pp_t, noise=to_frames(perturb_noise)))
+            x_t = torch.where(x_clean_mask,x_clean_perturbed,x_t)
+
+        assert self.loss_type == gd.LossType.MSE or self.loss_type == gd.LossType.RESCALED_MSE
+
+        t_input = model_kwargs.pop("t_input",t[None]) # (1,T)
+        model_output = model(x_t, t_input, **model_kwargs)
+
+        seg_ids = torch.repeat_interleave(
+            torch.arange(len(segment_lens),device=x_start.device),
+            torch.as_tensor(segment_lens,device=x_start.device)
+        ) # (T,)
+        def masked_mean_per_segment(loss):
+            # (1,C,T,H,W) --> (num_segments,)
+            loss_sum = torch.zeros(len(segment_lens),device=loss.device,dtype=loss.dtype).index_add_(
+                0, seg_ids, (loss * loss_mask).sum(dim=[0,1,3,4])
+            )
+            mask_sum = torch.zeros(len(segment_lens),device=loss.device,dtype=loss_mask.dtype).index_add_(
+                0, seg_ids, loss_mask.sum(dim=[0,1,3,4])
+            )
+            return loss_sum / mask_sum
+
+        terms = {}
+        if self.model_var_type in [
+            gd.ModelVarType.LEARNED,
+            gd.ModelVarType.LEARNED_RANGE,
+        ]:
+            B, C = x_t.shape[:2]
+            assert model_output.shape == (B, C * 2, *x_t.shape[2:])
+            model_output, model_var_values = torch.split(model_output, C, dim=1)
+            # Learn the variance using the variational bound, but don't let
+            # it affect our mean prediction.
+            frozen_out = torch.cat([model_output.detach(), model_var_values], dim=1)
+            vb_loss = self._vb_terms_bpd_keep_dim(
+                model=lambda *args, r=to_frames(frozen_out): r,
+                x_start=to_frames(x_start),
+                x_t=to_frames(x_t),
+                t=t,
+                clip_denoised=False,
+            )["output"]
+            vb_loss = from_frames(vb_loss)
+            if self.loss_type == gd.LossType.RESCALED_MSE:
+                # Divide by 1000 for equivalence with initial implementation.
+                # Without a factor of 1/1000, the VB term hurts the MSE term.
+                vb_loss = vb_loss * self.num_timesteps / 1000.0
+            terms["vb"] = masked_mean_per_segment(vb_loss)
+
+        target = {
+            gd.ModelMeanType.PREVIOUS_X: lambda: from_frames(
+                self.q_posterior_mean_variance(x_start=to_frames(x_start), x_t=to_frames(x_t), t=t)[0]
+            ),
+            gd.ModelMeanType.START_X: lambda: x_start,
+            gd.ModelMeanType.EPSILON: lambda: noise,
+        }[self.model_mean_type]()
+        assert model_output.shape == target.shape == x_start.shape
+
+        terms["mse"] = masked_mean_per_segment((target - model_output) ** 2)
+        if "vb" in terms:
+            terms["loss"] = terms["mse"] + terms["vb"]
+        else:
+            terms["loss"] = terms["mse"]
+
+        return terms
+    
+
 
 def sum_flat(tensor):
     return tensor.sum(
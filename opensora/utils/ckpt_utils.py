@@ -1,26 +1,28 @@
+import collections
+import contextlib
 import functools
 import json
 import logging
 import operator
 import os
-from typing import Tuple
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Tuple
 import datetime
 
 import torch
 import torch.distributed as dist
 import torch.nn as nn
-try:
-    from colossalai.booster import Booster
-    from colossalai.checkpoint_io import GeneralCheckpointIO
-    from colossalai.cluster import DistCoordinator
-except:
-    print("colossalai not available")
-    Booster,GeneralCheckpointIO,DistCoordinator = None,None,None
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
-from torchvision.datasets.utils import download_url
 
-from opensora.datasets.sampler import VariableVideoBatchSampler
+from opensora.utils.file_utils import atomic_write
+
+if TYPE_CHECKING:
+    # colossalai is imported only when it is used, this module is also used by inference and eval scripts
+    from colossalai.booster import Booster
+    from colossalai.cluster import DistCoordinator
 
 hf_endpoint = os.environ.get("HF_ENDPOINT")
 if hf_endpoint is None:
@@ -108,12 +110,15 @@ def download_model(model_name=None, local_path=None, url=None):
         os.makedirs("pretrained_models", exist_ok=True)
         dir_name = os.path.dirname(local_path)
         file_name = os.path.basename(local_path)
+        from torchvision.datasets.utils import download_url
         download_url(web_path, dir_name, file_name)
     model = torch.load(local_path, map_location=lambda storage, loc: storage)
     return model
 
 
 def load_from_sharded_state_dict(model, ckpt_path):
+    from colossalai.checkpoint_io import GeneralCheckpointIO
+
     ckpt_io = GeneralCheckpointIO()
     ckpt_io.load_model(model, os.path.join(ckpt_path, "model"))
 
@@ -149,11 +154,14 @@ def remove_padding(tensor: torch.Tensor, original_shape: Tuple) -> torch.Tensor:
 def model_gathering(model: torch.nn.Module, model_shape_dict: dict):
     global_rank = dist.get_rank()
     global_size = dist.get_world_size()
+    # nccl only gathers cuda tensors, e.g., the EMA model can be kept in CPU memory
+    comm_device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else None
     for name, param in model.named_parameters():
-        all_params = [torch.empty_like(param.data) for _ in range(global_size)]
-        dist.all_gather(all_params, param.data, group=dist.group.WORLD)
+        param_data = param.data if comm_device is None else param.data.to(comm_device)
+        all_params = [torch.empty_like(param_data) for _ in range(global_size)]
+        dist.all_gather(all_params, param_data, group=dist.group.WORLD)
         if int(global_rank) == 0:
-            all_params = torch.cat(all_params)
+            all_params = torch.cat(all_params).to(param.device)
             param.data = remove_padding(all_params, model_shape_dict[name]).view(model_shape_dict[name])
     dist.barrier()
 
@@ -165,8 +173,173 @@ def record_model_param_shape(model: torch.nn.Module) -> dict:
     return param_shape
 
 
+# the sharded checkpoint layout of colossalai 0.3.x (written against `LowLevelZeroCheckpointIO` and `checkpoint_io/utils.py`
+# of colossalai==0.3.6), re-implemented here so that the async checkpoints are read by `booster.load_model/load_optimizer`
+# w/o depending on colossalai internals
+SHARDED_WEIGHTS_NAME = "pytorch_model.bin"
+SHARDED_WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
+SHARDED_STATES_NAME = "pytorch_optim.bin"
+SHARDED_STATES_INDEX_NAME = "pytorch_optim.bin.index.json"
+SHARDED_GROUP_FILE_NAME = "pytorch_optim_group.bin"
+
+
+def get_shard_filename(base_name, idx):
+    return base_name.replace(".bin", f"-{idx + 1:05d}.bin")
+
+
+def shard_state_dict(items, max_shard_size):
+    '''
+    split (key, tensor or dict of tensors) pairs into shards of at most `max_shard_size` MB, the same as colossalai's
+    `StateDictSharder` (a larger item is a shard on its own), yield (shard, size in MB)
+    '''
+    shard, shard_size = dict(), 0
+    for key, value in items:
+        tensors = [value] if torch.is_tensor(value) else [v for v in value.values() if torch.is_tensor(v)]
+        size = sum(t.numel() * t.element_size() for t in tensors) / 1024 / 1024
+        if shard_size + size > max_shard_size and shard_size > 0:
+            yield shard, shard_size
+            shard, shard_size = dict(), 0
+        shard[key] = value
+        shard_size += size
+    yield shard, shard_size
+
+
+def is_low_level_zero_plugin(plugin):
+    '''by the class name (incl. subclasses, e.g., ZeroSeqParallelPlugin), so that colossalai is not imported here'''
+    return any(cls.__name__ == "LowLevelZeroPlugin" for cls in type(plugin).__mro__)
+
+
+class AsyncCheckpointer:
+    '''
+    write checkpoint files in a background thread, so that training continues while the disk I/O runs.
+
+    - tensors are copied to (pinned) CPU buffers at `save_torch` / `save_sharded_model`, i.e., the snapshot is taken before returning,
+      the buffers are re-used by later checkpoints once their writing is finished
+    - each file is written to a temporary path and renamed, so a partially written file never shows up under its final name
+    - files are written in the order of submission (one writer thread), e.g., write `running_states.json` last,
+      so that a checkpoint dir is complete iff it has `running_states.json`
+    - at most `max_pending` checkpoints are in flight, `begin` blocks if there are more (this caps the host memory)
+    '''
+    def __init__(self, max_pending=1):
+        assert max_pending >= 1
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async_ckpt")
+        self._pending = deque() # futures of each checkpoint
+        self._free_buffers = dict() # file name -> a list of buffers
+        self._lock = threading.Lock()
+        self._pin_memory = torch.cuda.is_available()
+
+    def _snapshot(self, obj, buffers, prefix=""):
+        if torch.is_tensor(obj):
+            buf = buffers.get(prefix)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self._pin_memory and obj.is_cuda)
+                buffers[prefix] = buf
+            buf.copy_(obj.detach(), non_blocking=True)
+            return buf
+        elif isinstance(obj, dict):
+            return obj.__class__((k, self._snapshot(v, buffers, f"{prefix}.{k}")) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple)):
+            return obj.__class__(self._snapshot(v, buffers, f"{prefix}.{i}") for i, v in enumerate(obj))
+        else:
+            return obj
+
+    def _wait(self, max_pending):
+        while len(self._pending) > max_pending:
+            for future in self._pending.popleft():
+                future.result()  # re-raise the exception of the writer thread, if any
+
+    def begin(self):
+        '''call this at the beginning of each checkpoint'''
+        self._wait(self.max_pending - 1)
+        self._pending.append([])
+
+    def _write(self, path, write_fn, buffers=None):
+        try:
+            atomic_write(path, write_fn, ignore_errors=False)
+        finally:
+            if buffers is not None:
+                with self._lock:
+                    self._free_buffers.setdefault(os.path.basename(path), []).append(buffers)
+
+    def submit(self, path, write_fn, buffers=None):
+        if len(self._pending) == 0:
+            self.begin()
+        self._pending[-1].append(self._executor.submit(self._write, path, write_fn, buffers))
+
+    def _get_buffers(self, name):
+        with self._lock:
+            free_buffers = self._free_buffers.get(name, [])
+            return free_buffers.pop() if len(free_buffers) > 0 else dict()
+
+    def _sync(self):
+        if torch.cuda.is_available():
+            torch.cuda.current_stream().synchronize() # wait for the non_blocking copies of `_snapshot`
+
+    def save_torch(self, obj, path):
+        buffers = self._get_buffers(os.path.basename(path))
+        obj = self._snapshot(obj, buffers)
+        self._sync()
+        self.submit(path, functools.partial(torch.save, obj), buffers)
+
+    def save_sharded_model(self, model, checkpoint, size_per_shard=1024):
+        '''
+        the same files as `booster.save_model(model, checkpoint, shard=True)` of the LowLevelZeroPlugin, i.e., loaded by `booster.load_model`.
+        call it on the master rank only (the model is replicated across ranks w/ zero-2), the state_dict is copied to pinned buffers
+        before returning, and the buffers are re-used once the index file (the last file of the model) is written
+        '''
+        os.makedirs(checkpoint, exist_ok=True)
+        buffers = self._get_buffers(SHARDED_WEIGHTS_INDEX_NAME)
+        state_dict = self._snapshot(model.unwrap().state_dict(), buffers)
+        self._sync()
+
+        weight_map, total_size = dict(), 0
+        for idx, (shard, shard_size) in enumerate(shard_state_dict(state_dict.items(), size_per_shard)):
+            shard_file = get_shard_filename(SHARDED_WEIGHTS_NAME, idx)
+            total_size += shard_size
+            weight_map.update((key, shard_file) for key in shard.keys())
+            self.submit(os.path.join(checkpoint, shard_file), functools.partial(torch.save, shard))
+        index = dict(metadata=dict(total_size=total_size), weight_map=weight_map)
+        self.submit(os.path.join(checkpoint, SHARDED_WEIGHTS_INDEX_NAME), functools.partial(save_json, index), buffers)
+
+    def save_sharded_optimizer(self, optimizer, checkpoint, is_master, size_per_shard=1024):
+        '''
+        the same files as `booster.save_optimizer(optimizer, checkpoint, shard=True)` of the LowLevelZeroPlugin,
+        i.e., loaded by `booster.load_optimizer`. call it on all ranks: the optimizer states are sharded across the dp ranks and
+        `state_dict_shard` all-gathers them (collective), so the gathering runs here, and only the disk I/O runs in the background.
+        the gathered states are already CPU tensors owned by each shard, so no extra snapshot is needed
+        '''
+        os.makedirs(checkpoint, exist_ok=True)
+        if is_master:
+            # state_dict of the inner optimizer only has 'param_groups'
+            param_groups = optimizer.optim.state_dict()["param_groups"]
+            self.submit(os.path.join(checkpoint, SHARDED_GROUP_FILE_NAME), functools.partial(torch.save, param_groups))
+
+        weight_map, total_size = dict(), 0
+        for idx, (shard, shard_size) in enumerate(optimizer.state_dict_shard(max_shard_size=size_per_shard)):
+            shard_file = get_shard_filename(SHARDED_STATES_NAME, idx)
+            total_size += shard_size
+            weight_map.update((str(param_id), shard_file) for param_id in shard.keys())
+            if is_master:
+                self.submit(os.path.join(checkpoint, shard_file), functools.partial(torch.save, shard))
+            del shard
+        if is_master:
+            index = dict(metadata=dict(param_groups=SHARDED_GROUP_FILE_NAME, total_size=total_size), weight_map=weight_map)
+            self.submit(os.path.join(checkpoint, SHARDED_STATES_INDEX_NAME), functools.partial(save_json, index))
+
+    def save_json(self, data, path):
+        self.submit(path, functools.partial(save_json, data))
+
+    def wait(self):
+        self._wait(0)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+
 def save(
-    booster: Booster,
+    booster: "Booster",
     model: nn.Module,
     ema: nn.Module,
     optimizer: Optimizer,
@@ -175,26 +348,54 @@ def save(
     step: int,
     global_step: int,
     batch_size: int,
-    coordinator: DistCoordinator,
+    coordinator: "DistCoordinator",
     save_dir: str,
     shape_dict: dict,
     sampler=None,
+    async_checkpointer: AsyncCheckpointer = None,
 ):
+    '''
+    if `async_checkpointer` is given, all the files are written in its background thread, in the same layout as the booster
+    (so `load` is unchanged): the model, ema, sampler & lr_scheduler are snapshotted to pinned buffers on the master rank,
+    the sharded optimizer states are all-gathered by all ranks (collective, this part is synchronous) and written by the master.
+    `running_states.json` is written last, a checkpoint dir is complete iff it has `running_states.json`.
+    only the LowLevelZeroPlugin (incl. ZeroSeqParallelPlugin) is supported, for other plugins the model & optimizer
+    are saved by the booster synchronously
+    '''
     save_dir = os.path.join(save_dir, f"epoch{epoch}-global_step{global_step}")
+    async_model_optim = async_checkpointer is not None and is_low_level_zero_plugin(booster.plugin)
+    if async_checkpointer is not None:
+        async_checkpointer.begin()
     os.makedirs(os.path.join(save_dir, "model"), exist_ok=True)
 
-    booster.save_model(model, os.path.join(save_dir, "model"), shard=True)
+    if async_model_optim:
+        if coordinator.is_master():
+            async_checkpointer.save_sharded_model(model, os.path.join(save_dir, "model"))
+    else:
+        booster.save_model(model, os.path.join(save_dir, "model"), shard=True)
     # ema is not boosted, so we don't need to use booster.save_model
     model_gathering(ema, shape_dict)
     global_rank = dist.get_rank()
     if int(global_rank) == 0:
-        torch.save(ema.state_dict(), os.path.join(save_dir, "ema.pt"))
+        if async_checkpointer is not None:
+            async_checkpointer.save_torch(ema.state_dict(), os.path.join(save_dir, "ema.pt"))
+        else:
+            torch.save(ema.state_dict(), os.path.join(save_dir, "ema.pt"))
         model_sharding(ema)
 
     if optimizer is not None:
-        booster.save_optimizer(optimizer, os.path.join(save_dir, "optimizer"), shard=True, size_per_shard=4096)
+        if async_model_optim:
+            async_checkpointer.save_sharded_optimizer(
+                optimizer, os.path.join(save_dir, "optimizer"), coordinator.is_master(), size_per_shard=4096
+            )
+        else:
+            booster.save_optimizer(optimizer, os.path.join(save_dir, "optimizer"), shard=True, size_per_shard=4096)
     if lr_scheduler is not None:
-        booster.save_lr_scheduler(lr_scheduler, os.path.join(save_dir, "lr_scheduler"))
+        if async_model_optim:
+            if coordinator.is_master():
+                async_checkpointer.save_torch(lr_scheduler.state_dict(), os.path.join(save_dir, "lr_scheduler"))
+        else:
+            booster.save_lr_scheduler(lr_scheduler, os.path.join(save_dir, "lr_scheduler"))
     sampler_start_idx = step * batch_size if batch_size is not None else None
     running_states = {
         "epoch": epoch,
@@ -203,17 +404,23 @@ def save(
         "sample_start_index": sampler_start_idx,
     }
     if coordinator.is_master():
-        save_json(running_states, os.path.join(save_dir, "running_states.json"))
         if sampler is not None:
-            if isinstance(sampler, VariableVideoBatchSampler):
-                torch.save(sampler.state_dict(step), os.path.join(save_dir, "sampler"))
-            else:
-                torch.save(sampler.state_dict(), os.path.join(save_dir, "sampler"))
-    dist.barrier()
+            from opensora.datasets.sampler import VariableVideoBatchSampler
+            sampler_state = sampler.state_dict(step) if isinstance(sampler, VariableVideoBatchSampler) else sampler.state_dict()
+        if async_checkpointer is not None:
+            if sampler is not None:
+                async_checkpointer.save_torch(sampler_state, os.path.join(save_dir, "sampler"))
+            async_checkpointer.save_json(running_states, os.path.join(save_dir, "running_states.json"))
+        else:
+            save_json(running_states, os.path.join(save_dir, "running_states.json"))
+            if sampler is not None:
+                torch.save(sampler_state, os.path.join(save_dir, "sampler"))
+    if not async_model_optim:
+        dist.barrier() # the files written by the master are complete on return
 
 
 def load(
-    booster: Booster,
+    booster: "Booster",
     model: nn.Module,
     ema: nn.Module,
     optimizer: Optimizer,
@@ -262,15 +469,164 @@ def create_logger(logging_dir,return_log_path=False):
     else:  # dummy logger (does nothing)
         logger = logging.getLogger(__name__)
         logger.addHandler(logging.NullHandler())
+        if return_log_path:
+            return logger,None
     return logger
 
 
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def mmap_safetensors(path):
+    '''
+    read a .safetensors file as a memory map, the returned tensors are views of the (copy-on-write) mapped file,
+    i.e., nothing is read until a tensor is used, and the page cache is shared by all processes on the host
+    '''
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+    nbytes = os.path.getsize(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=nbytes)
+    file_bytes = torch.empty(0, dtype=torch.uint8).set_(storage)
+
+    state_dict = dict()
+    data_start = 8 + header_len
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        tensor_bytes = file_bytes[data_start + begin : data_start + end]
+        if (data_start + begin) % dtype.itemsize != 0:
+            tensor_bytes = tensor_bytes.clone()  # unaligned, this does not happen for files written by `safetensors`
+        state_dict[name] = tensor_bytes.view(dtype).reshape(info["shape"])
+    return state_dict
+
+
+def load_state_dict_mmap(ckpt_path):
+    '''
+    Args:
+        ckpt_path: .safetensors, .pt/.pth, or a dir that has `model.safetensors` or `model_ckpt.pt`
+    Returns:
+        state_dict whose tensors are memory-mapped, or None if `ckpt_path` is a sharded (booster) dir
+    '''
+    if os.path.isdir(ckpt_path):
+        for fn in ["model.safetensors", "model_ckpt.pt"]:
+            if os.path.isfile(os.path.join(ckpt_path, fn)):
+                return load_state_dict_mmap(os.path.join(ckpt_path, fn))
+        return None
+
+    if ckpt_path.endswith(".safetensors"):
+        return mmap_safetensors(ckpt_path)
+    try:
+        return torch.load(ckpt_path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        # `mmap=True` only supports the zipfile format (torch>=1.6)
+        return torch.load(ckpt_path, map_location="cpu")
+
+
+def convert_to_safetensors(ckpt_path, save_path=None):
+    '''convert a .pt checkpoint (or a dir that can be loaded by `load_checkpoint`) to .safetensors'''
+    from safetensors.torch import save_file
+
+    if save_path is None:
+        save_path = os.path.join(ckpt_path, "model.safetensors") if os.path.isdir(ckpt_path) else os.path.splitext(ckpt_path)[0] + ".safetensors"
+    state_dict = load_state_dict_mmap(ckpt_path)
+    assert state_dict is not None, f"no single-file checkpoint in {ckpt_path}, run `load_checkpoint(..., save_as_pt=True)` first"
+    # safetensors does not allow tensors that share memory
+    storage_count = collections.Counter(v.untyped_storage().data_ptr() for v in state_dict.values())
+    state_dict = {
+        k: v.contiguous().clone() if storage_count[v.untyped_storage().data_ptr()] > 1 else v.contiguous()
+        for k, v in state_dict.items()
+    }
+    atomic_write(save_path, functools.partial(save_file, state_dict, metadata={"format": "pt"}), ignore_errors=False)
+    return save_path
+
+
+@contextlib.contextmanager
+def init_empty_params():
+    '''parameters created in this context are on the `meta` device (no memory and no init cost), buffers are created as usual'''
+    register_parameter = nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            param = module._parameters[name]
+            module._parameters[name] = param.__class__(param.to("meta"), requires_grad=param.requires_grad)
+
+    nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+@torch.no_grad()
+def load_checkpoint_lazy(build_fn, ckpt_path, device="cpu", dtype=None):
+    '''
+    build the model w/ parameters on the `meta` device and materialize each parameter from the memory-mapped checkpoint,
+    directly on `device` with `dtype`. Compared with `load_checkpoint`, there is no random init, and the peak host memory is
+    about one tensor instead of the whole state_dict plus a randomly initialized model.
+
+    Returns:
+        model, or None if the checkpoint can not be loaded lazily (a sharded dir, or some parameters are missing),
+        in this case, use `load_checkpoint`
+    '''
+    state_dict = load_state_dict_mmap(ckpt_path)
+    if state_dict is None:
+        return None
+    with init_empty_params():
+        model = build_fn()
+    state_dict = reparameter(state_dict, ckpt_path, model=model)
+
+    missing_params = [name for name, _ in model.named_parameters() if name not in state_dict]
+    if len(missing_params) > 0:
+        print(f"Missing params: {missing_params}, can not load {ckpt_path} lazily")
+        return None
+
+    def _to_target(tensor):
+        return tensor.to(device=device, dtype=dtype if (dtype is not None and tensor.is_floating_point()) else tensor.dtype)
+
+    for module_name, module in model.named_modules():
+        prefix = f"{module_name}." if module_name else ""
+        for name, param in list(module._parameters.items()):
+            if param is None:
+                continue
+            value = state_dict[prefix + name]
+            assert value.shape == param.shape, f"{prefix + name}: {value.shape} != {param.shape}"
+            module._parameters[name] = param.__class__(_to_target(value), requires_grad=param.requires_grad)
+        for name, buf in list(module._buffers.items()):
+            if buf is None:
+                continue
+            value = state_dict.get(prefix + name, buf) # e.g., pos_embed is computed in __init__, not loaded
+            module._buffers[name] = _to_target(value)
+
+    unexpected_keys = [k for k in state_dict.keys() if k not in dict(model.state_dict())]
+    print(f"Lazily loaded {ckpt_path} to {device}, {dtype}, unexpected keys: {unexpected_keys}")
+    return model
+
+
 def load_checkpoint(model, ckpt_path, save_as_pt=False):
     if ckpt_path.endswith(".pt") or ckpt_path.endswith(".pth"):
         state_dict = find_model(ckpt_path, model=model)
         missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
         print(f"Missing keys: {missing_keys}")
         print(f"Unexpected keys: {unexpected_keys}")
+    elif ckpt_path.endswith(".safetensors"):
+        state_dict = reparameter(mmap_safetensors(ckpt_path), ckpt_path, model=model)
+        missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+        print(f"Missing keys: {missing_keys}")
+        print(f"Unexpected keys: {unexpected_keys}")
     elif os.path.isdir(ckpt_path):
         _pt_path = os.path.join(ckpt_path, "model_ckpt.pt")
         if os.path.isfile(_pt_path):
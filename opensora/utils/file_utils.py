@@ -0,0 +1,47 @@
+import hashlib
+import json
+import os
+
+'''
+small file helpers shared by the caches (dataset index, I3D features, video info) and the writers of outputs
+(checkpoints, decoded videos, scene clips)
+'''
+
+
+def json_md5(key):
+    '''md5 of a json serializable key, independent of the order of dict keys'''
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def atomic_write(path, write_fn, ignore_errors=True):
+    '''
+    write to a temporary file and rename it, so that concurrent ranks/workers never read a partial file,
+    and a killed run never leaves a partial file under `path`
+
+    Args:
+        write_fn: called w/ the temporary path, which has the same extension as `path` (e.g., for np.save, ffmpeg)
+        ignore_errors (bool): for caches, e.g., read-only cache dir, no parquet engine, or columns that can not be saved
+            as parquet, the data is still usable without cache. Set it to False for outputs, the error is raised after cleaning up
+    Returns:
+        True if the file is written
+    '''
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.tmp.{os.getpid()}{ext}"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except (OSError, ValueError, TypeError, ImportError):
+        if not ignore_errors:
+            raise
+        return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+def file_stat_key(path):
+    '''[realpath, size, mtime], changes iff the file is replaced or modified'''
+    stat = os.stat(path)
+    return [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
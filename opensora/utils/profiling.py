@@ -0,0 +1,126 @@
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+'''
+opt-in profiler for the kv-cache sampler (`autoregressive_sample_kv_cache`)
+
+usage:
+    profiler = enable_profiling()
+    ... sampling ...
+    profiler.save(save_dir)   # kv_cache_profile.json (per-phase stats & per-AR-step kv-cache info) & kv_cache_profile_trace.json (chrome://tracing)
+    disable_profiling()
+
+inside the model/sampler, each phase is wrapped by `with profile_range("spatial_attn"): ...`
+when the profiler is not enabled, `profile_range` returns a shared `nullcontext`, i.e., no cuda sync, no timer, no allocation
+'''
+
+_NULL_RANGE = nullcontext()
+_PROFILER = None
+
+
+class KVCacheProfiler:
+    '''
+    Args:
+        sync_cuda (bool): call `torch.cuda.synchronize` at the start and end of each range,
+            otherwise the cuda kernels are launched asynchronously and the time of a range is not the time of its kernels
+    '''
+    def __init__(self, sync_cuda=True):
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.events = []        # chrome trace events
+        self.ar_step_info = []  # kv-cache memory & attn seqlens, one for each AR step
+        self.range_stack = []
+        self.ar_step = None
+        self.denoise_step = None
+        self.t0 = time.perf_counter()
+
+    def _now_us(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - self.t0) * 1e6
+
+    @contextmanager
+    def range(self, name, **args):
+        self.range_stack.append(name)
+        path = "/".join(self.range_stack)
+        start = self._now_us()
+        try:
+            yield
+        finally:
+            end = self._now_us()
+            self.range_stack.pop()
+            if self.ar_step is not None:
+                args.update(ar_step=self.ar_step)
+            if self.denoise_step is not None:
+                args.update(denoise_step=self.denoise_step)
+            self.events.append(dict(
+                name=name, cat=path, ph="X", ts=start, dur=end - start, pid=0, tid=0, args=args
+            ))
+
+    def set_ar_step(self, ar_step):
+        self.ar_step = ar_step
+        self.denoise_step = None
+
+    def next_denoise_step(self):
+        self.denoise_step = 0 if self.denoise_step is None else self.denoise_step + 1
+
+    def log_ar_step(self, **info):
+        info = dict(ar_step=self.ar_step, **info)
+        self.ar_step_info.append(info)
+        self.events.append(dict(
+            name="kv_cache", ph="C", ts=self._now_us(), pid=0, tid=0,
+            args={k: v for k, v in info.items() if k.endswith("_bytes")}
+        ))
+
+    def summary(self):
+        '''aggregate the time of each phase by its path, e.g., "denoise/denoise_step/block/temporal_attn"'''
+        stats = dict()
+        for e in self.events:
+            if e["ph"] != "X":
+                continue
+            s = stats.setdefault(e["cat"], dict(count=0, total_ms=0.0, max_ms=0.0))
+            dur_ms = e["dur"] / 1e3
+            s["count"] += 1
+            s["total_ms"] += dur_ms
+            s["max_ms"] = max(s["max_ms"], dur_ms)
+        for s in stats.values():
+            s["mean_ms"] = s["total_ms"] / s["count"]
+        return stats
+
+    def save(self, save_dir, prefix="kv_cache_profile"):
+        os.makedirs(save_dir, exist_ok=True)
+        report_path = os.path.join(save_dir, f"{prefix}.json")
+        trace_path = os.path.join(save_dir, f"{prefix}_trace.json")
+        with open(report_path, "w") as f:
+            json.dump(dict(
+                sync_cuda=self.sync_cuda,
+                phases=self.summary(),
+                ar_steps=self.ar_step_info,
+            ), f, indent=4)
+        with open(trace_path, "w") as f:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit="ms"), f)
+        return report_path, trace_path
+
+
+def enable_profiling(sync_cuda=True):
+    global _PROFILER
+    _PROFILER = KVCacheProfiler(sync_cuda=sync_cuda)
+    return _PROFILER
+
+
+def disable_profiling():
+    global _PROFILER
+    _PROFILER = None
+
+
+def get_profiler():
+    return _PROFILER
+
+
+def profile_range(name, **args):
+    if _PROFILER is None:
+        return _NULL_RANGE
+    return _PROFILER.range(name, **args)
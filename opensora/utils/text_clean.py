@@ -0,0 +1,131 @@
+import html
+import re
+import urllib.parse as ul
+from functools import lru_cache
+
+'''
+the caption cleaning of the T5 pipeline (from PixArt / DeepFloyd IF),
+shared by `tools/datasets/datautil.py --clean-caption` and `opensora/models/text_encoder/t5.py`
+
+the output is the same as the original row-by-row version, but:
+    the regexes are compiled once, the independent char deletions/replacements are merged into one pass
+    BeautifulSoup (html) is only called if the caption has "<" or "&", ftfy only if it is not plain printable ascii or has "&"
+    `text_preprocessing` is memoized, so a prompt is cleaned once per process
+for a table of captions, clean the unique captions only, see `apply_unique` of datautil
+'''
+
+BAD_PUNCT_REGEX = re.compile(
+    r"[" + "#®•©™&@·º½¾¿¡§~" + "\)" + "\(" + "\]" + "\[" + "\}" + "\{" + "\|" + "\\" + "\/" + "\*" + r"]{1,}"
+)  # noqa
+
+URL_REGEX_1 = re.compile(
+    r"\b((?:https?:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))"  # noqa
+)
+URL_REGEX_2 = re.compile(
+    r"\b((?:www:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))"  # noqa
+)
+# 31C0—31EF CJK Strokes
+# 31F0—31FF Katakana Phonetic Extensions
+# 3200—32FF Enclosed CJK Letters and Months
+# 3300—33FF CJK Compatibility
+# 3400—4DBF CJK Unified Ideographs Extension A
+# 4DC0—4DFF Yijing Hexagram Symbols
+# 4E00—9FFF CJK Unified Ideographs
+# deleting the ranges one by one == deleting their union
+CJK_REGEX = re.compile(r"[\u31c0-\u31ef\u31f0-\u31ff\u3200-\u32ff\u3300-\u33ff\u3400-\u4dbf\u4dc0-\u4dff\u4e00-\u9fff]+")
+# все виды тире / all types of dash --> "-"
+DASH_REGEX = re.compile(
+    r"[\u002D\u058A\u05BE\u1400\u1806\u2010-\u2015\u2E17\u2E1A\u2E3A\u2E3B\u2E40\u301C\u3030\u30A0\uFE31\uFE32\uFE58\uFE63\uFF0D]+"  # noqa
+)
+# кавычки к одному стандарту
+QUOTE_TABLE = str.maketrans({**{c: '"' for c in "`´«»“”¨"}, **{c: "'" for c in "‘’"}})
+NICKNAME_REGEX = re.compile(r"@[\w\d]+\b")  # @<nickname>
+NOT_PLAIN_ASCII_REGEX = re.compile(r"[^\t\n\x20-\x7e]")  # text that ftfy may change
+
+# (pattern, replacement) in order, before & after `basic_clean`
+PRE_SUBS = [
+    (re.compile(r"&quot;?"), ""),  # &quot;
+    (re.compile(r"&amp"), ""),  # &amp
+    (re.compile(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"), " "),  # ip adresses:
+    (re.compile(r"\d:\d\d\s+$"), ""),  # article ids:
+    (re.compile(r"\\n"), " "),  # \n
+    (re.compile(r"#\d{1,3}\b"), ""),  # "#123"
+    (re.compile(r"#\d{5,}\b"), ""),  # "#12345.."
+    (re.compile(r"\b\d{6,}\b"), ""),  # "123456.."
+    (re.compile(r"[\S]+\.(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)"), ""),  # filenames:
+    (re.compile(r"[\"\']{2,}"), r'"'),  # """AUSVERKAUFT"""
+    (re.compile(r"[\.]{2,}"), r" "),  # """AUSVERKAUFT"""
+    (BAD_PUNCT_REGEX, r" "),  # ***AUSVERKAUFT***, #AUSVERKAUFT
+    (re.compile(r"\s+\.\s+"), r" "),  # " . "
+]
+DASH_UNDERSCORE_REGEX = re.compile(r"(?:\-|\_)")  # this-is-my-cute-cat / this_is_my_cute_cat
+POST_SUBS = [
+    (re.compile(r"\b[a-zA-Z]{1,3}\d{3,15}\b"), ""),  # jc6640
+    (re.compile(r"\b[a-zA-Z]+\d+[a-zA-Z]+\b"), ""),  # jc6640vc
+    (re.compile(r"\b\d+[a-zA-Z]+\d+\b"), ""),  # 6640vc231
+    (re.compile(r"(worldwide\s+)?(free\s+)?shipping"), ""),
+    (re.compile(r"(free\s)?download(\sfree)?"), ""),
+    (re.compile(r"\bclick\b\s(?:for|on)\s\w+"), ""),
+    (re.compile(r"\b(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)(\simage[s]?)?"), ""),
+    (re.compile(r"\bpage\s+\d+\b"), ""),
+    (re.compile(r"\b\d*[a-zA-Z]+\d+[a-zA-Z]+\d+[a-zA-Z\d]*\b"), r" "),  # j2d1a2a...
+    (re.compile(r"\b\d+\.?\d*[xх×]\d+\.?\d*\b"), ""),
+    (re.compile(r"\b\s+\:\s+"), r": "),
+    (re.compile(r"(\D[,\./])\b"), r"\1 "),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"^[\"\']([\w\W]+)[\"\']$"), r"\1"),
+    (re.compile(r"^[\'\_,\-\:;]"), r""),
+    (re.compile(r"[\'\_,\-\:\-\+]$"), r""),
+    (re.compile(r"^\.\S+$"), ""),
+]
+
+
+def basic_clean(text):
+    if "&" in text or NOT_PLAIN_ASCII_REGEX.search(text):
+        import ftfy
+
+        text = ftfy.fix_text(text)
+        text = html.unescape(html.unescape(text))
+    return text.strip()
+
+
+def clean_caption(caption):
+    caption = str(caption)
+    caption = ul.unquote_plus(caption)
+    caption = caption.strip().lower()
+    caption = caption.replace("<person>", "person")
+    # urls:
+    caption = URL_REGEX_1.sub("", caption)
+    caption = URL_REGEX_2.sub("", caption)
+    # html:
+    if "<" in caption or "&" in caption:
+        from bs4 import BeautifulSoup
+
+        caption = BeautifulSoup(caption, features="html.parser").text
+
+    caption = NICKNAME_REGEX.sub("", caption)
+    caption = CJK_REGEX.sub("", caption)
+    caption = DASH_REGEX.sub("-", caption)
+    caption = caption.translate(QUOTE_TABLE)
+
+    for pattern, repl in PRE_SUBS:
+        caption = pattern.sub(repl, caption)
+    if len(DASH_UNDERSCORE_REGEX.findall(caption)) > 3:
+        caption = DASH_UNDERSCORE_REGEX.sub(" ", caption)
+
+    caption = basic_clean(caption)
+
+    for pattern, repl in POST_SUBS:
+        caption = pattern.sub(repl, caption)
+    return caption.strip()
+
+
+@lru_cache(maxsize=1 << 16)
+def text_preprocessing(text, use_text_preprocessing: bool = True):
+    if use_text_preprocessing:
+        # The exact text cleaning as was in the training stage:
+        text = clean_caption(text)
+        text = clean_caption(text)
+        return text
+    else:
+        return text.lower().strip()
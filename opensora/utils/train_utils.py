@@ -1,13 +1,18 @@
+import functools
 import math
 import random
 from collections import OrderedDict
 
 import torch
 
-import colossalai
-COLOSSALAI_VERSION = str(colossalai.__version__).split('.') # '0.4.0', '0.4.1', '0.4.2'
-assert len(COLOSSALAI_VERSION)==3
-COLOSSALAI_VERSION = float('.'.join(COLOSSALAI_VERSION[1:])) # 4.0, 4.1, 4.2
+
+@functools.lru_cache(maxsize=None)
+def get_colossalai_version():
+    '''colossalai is imported at the first call, instead of at the import of this module'''
+    import colossalai
+    version = str(colossalai.__version__).split('.') # '0.4.0', '0.4.1', '0.4.2'
+    assert len(version)==3
+    return float('.'.join(version[1:])) # 4.0, 4.1, 4.2
 
 @torch.no_grad()
 def update_ema(
@@ -28,18 +33,88 @@ def update_ema(
             param_data = param.data
             ema_params[name].mul_(decay).add_(param_data, alpha=1 - decay)
         else:
-            if param.data.dtype != torch.float32:
-                param_id = id(param)
-                if COLOSSALAI_VERSION < 4.2:
-                    master_param = optimizer._param_store.working_to_master_param[param_id] # for colossalai==0.4.0
-                else:
-                    master_param = optimizer.working_to_master_param[param_id] # for colossalai=0.4.2
-                param_data = master_param.data
-            else:
-                param_data = param.data
+            param_data = _get_master_param(param, optimizer).data
             ema_params[name].mul_(decay).add_(param_data, alpha=1 - decay)
 
 
+def _get_master_param(param, optimizer):
+    if param.data.dtype == torch.float32:
+        return param
+    param_id = id(param)
+    if get_colossalai_version() < 4.2:
+        return optimizer._param_store.working_to_master_param[param_id] # for colossalai==0.4.0
+    else:
+        return optimizer.working_to_master_param[param_id] # for colossalai=0.4.2
+
+
+class EMAUpdater:
+    """
+    the same as `update_ema`, but
+        - the (ema_param, param) pairs (and the master params of the sharded optimizer) are looked up once in `__init__`
+        - all params are updated by multi-tensor `torch._foreach_*` kernels, instead of a python loop of `mul_` & `add_`
+        - the EMA can be updated every `update_every` steps, with decay**update_every to compensate the skipped steps
+        - the EMA can be kept in CPU memory (e.g., `ema_model.to("cpu")` before `model_sharding(ema_model)`),
+          the params are copied to pinned CPU buffers before each update
+
+    NOTE: build this after `booster.boost`, so that the master params of the optimizer exist.
+    We keep references to the param objects (not `param.data`), so it is safe when `model_sharding`/`model_gathering`
+    re-assign `ema_param.data` at checkpoint saving.
+    """
+    def __init__(
+        self, ema_model: torch.nn.Module, model: torch.nn.Module, optimizer=None, decay: float = 0.9999, sharded: bool = True, update_every: int = 1
+    ) -> None:
+        assert update_every >= 1
+        self.decay = decay
+        self.update_every = update_every
+        self.num_steps = 0
+
+        ema_params = OrderedDict(ema_model.named_parameters())
+        self.ema_params, self.model_params = [], []
+        for name, param in model.named_parameters():
+            if name == "pos_embed":
+                continue
+            if param.requires_grad == False:
+                continue
+            self.ema_params.append(ema_params[name])
+            self.model_params.append(_get_master_param(param, optimizer) if sharded else param)
+        self._cpu_buffers = None
+
+    def _fetch_model_params(self):
+        ema_device = self.ema_params[0].device
+        if all(p.device == ema_device for p in self.model_params):
+            return self.model_params
+
+        # e.g., EMA on CPU
+        if self._cpu_buffers is None or any(b.shape != p.shape for b, p in zip(self._cpu_buffers, self.model_params)):
+            pin_memory = torch.cuda.is_available()
+            self._cpu_buffers = [
+                torch.empty(p.shape, dtype=p.dtype, device=ema_device, pin_memory=pin_memory) for p in self.model_params
+            ]
+        for buf, p in zip(self._cpu_buffers, self.model_params):
+            buf.copy_(p.data, non_blocking=True)
+        if torch.cuda.is_available():
+            torch.cuda.current_stream().synchronize()
+        return self._cpu_buffers
+
+    @torch.no_grad()
+    def update(self, decay: float) -> None:
+        if len(self.ema_params) == 0:
+            return
+        model_params = self._fetch_model_params()
+        ema_data = [p.data for p in self.ema_params]
+        torch._foreach_mul_(ema_data, decay)
+        torch._foreach_add_(ema_data, [p.data for p in model_params], alpha=1 - decay)
+
+    def step(self) -> bool:
+        """call this after each `optimizer.step()`, return True if the EMA is updated at this step"""
+        self.num_steps += 1
+        if self.num_steps % self.update_every != 0:
+            return False
+        self.update(self.decay**self.update_every)
+        return True
+
+
+
 class MaskGenerator:
     def __init__(self, mask_ratios):
         valid_mask_names = [
@@ -9,12 +9,14 @@ import torch.distributed as dist
 from colossalai.utils import get_current_device,set_seed
 from diffusers.schedulers import LCMScheduler
 from opensora.datasets import save_sample
+from opensora.acceleration.parallel_states import get_sequence_parallel_group
 from opensora.registry import SCHEDULERS, build_module
 from opensora.utils.misc import to_torch_dtype
 
 from .train_utils import build_progressive_noise
 from .ckpt_utils import save_json
 from .debug_utils import envs
+from .profiling import profile_range, get_profiler
 
 @torch.no_grad()
 def validation_visualize(model,vae,text_encoder,val_examples,val_cfgs,exp_dir,writer,global_step):
@@ -48,14 +50,26 @@ def validation_visualize(model,vae,text_encoder,val_examples,val_cfgs,exp_dir,wr
         prefix_perturb_t = val_cfgs.get("prefix_perturb_t",-1)
     ))
     
-    for idx,example in enumerate(val_examples):
-        current_seed = example.seed
-        if current_seed == "random":
-            current_seed = int(str(datetime.now().timestamp()).split('.')[-1][:4])
-
-        if (first_image := example.first_image) is not None:
-            first_image = first_image.to(device=device,dtype=dtype) # (1,3,1,h,w)
-            cond_frame_latents = vae.encode(first_image) # vae accept shape (B,C,T,H,W), here B=1,T=1
+    # w/ kv_cache_sequence_parallel (or pipeline inference), all ranks in the sp_group (or pipeline group) denoise the same video (with the same noise)
+    if getattr(model,"kv_cache_sequence_parallel",False):
+        sp_group = get_sequence_parallel_group()
+    else:
+        sp_group = getattr(model,"pipeline_group",None) # refer to `PipelineCausalSTDiT2`
+    for batch in group_val_examples(val_examples,get_val_batch_size(model,val_cfgs,scheduler)):
+        # batch: list of (idx,example), the examples in a batch share the same z_size & ar_steps
+        seeds = []
+        for idx,example in batch:
+            current_seed = example.seed
+            if current_seed == "random":
+                current_seed = int(str(datetime.now().timestamp()).split('.')[-1][:4])
+            seeds.append(current_seed)
+        if sp_group is not None:
+            dist.broadcast_object_list(seeds, src=dist.get_global_rank(sp_group,0), group=sp_group)
+
+        example = batch[0][1]
+        if example.first_image is not None:
+            first_image = torch.cat([ex.first_image for _,ex in batch],dim=0).to(device=device,dtype=dtype) # (B,3,1,h,w)
+            cond_frame_latents = vae.encode(first_image) # vae accept shape (B,C,T,H,W), here T=1
         else:
             cond_frame_latents = None
         
@@ -70,41 +84,94 @@ def validation_visualize(model,vae,text_encoder,val_examples,val_cfgs,exp_dir,wr
             model, 
             text_encoder, 
             z_size = (vae.out_channels, *latent_size), 
-            prompts = [example.prompt],
+            prompts = [ex.prompt for _,ex in batch],
             cond_frame_latents=cond_frame_latents, # (B,C,1,H,W)
             ar_steps = example.auto_regre_steps,
-            seed = current_seed,
+            seed = seeds if len(batch) > 1 else seeds[0],
             verbose=True,
             **additional_kwargs
-        ) # (1, C, T, H, W)
-        fps = num_gen_frames / time_used
-        print(f"num_gen_frames={num_gen_frames}, time_used={time_used:.2f}, fps={fps:.2f}")
-        vae.micro_batch_size = 16
-        sample = vae.decode(samples.to(dtype=dtype))[0] # (C, T, H, W)
-        vae.micro_batch_size = None
-
-        video_name = f"idx{idx}_seed{current_seed}.mp4"
-        save_path = os.path.join(save_dir,video_name)
-        save_sample(sample.clone(),fps=8,save_path=save_path)
-
-        if writer is not None:
-            low, high = (-1,1)
-            sample.clamp_(min=low, max=high)
-            sample.sub_(low).div_(max(high - low, 1e-5)) # -1 ~ 1 --> 0 ~ 1
-            sample = sample.clamp_(0,1).float().cpu()
-            sample = sample.unsqueeze(0).permute(0,2,1,3,4) # BCTHW --> BTCHW
-
-            writer.add_video(
-                f"validation-{idx}",
-                sample,
-                global_step = global_step,
-                fps=8,
-                walltime=None
-            )
+        ) # (B, C, T, H, W)
+        fps = num_gen_frames * len(batch) / time_used
+        print(f"num_gen_frames={num_gen_frames}x{len(batch)}, time_used={time_used:.2f}, fps={fps:.2f}")
+        for (idx,example),current_seed,latents in zip(batch,seeds,samples):
+            vae.micro_batch_size = 16
+            with profile_range("vae_decode"):
+                sample = vae.decode(latents[None].to(dtype=dtype))[0] # (C, T, H, W)
+            vae.micro_batch_size = None
+
+            if sp_group is not None and dist.get_rank(sp_group) > 0:
+                continue # saved by sp_rank 0
+            video_name = f"idx{idx}_seed{current_seed}.mp4"
+            save_path = os.path.join(save_dir,video_name)
+            save_sample(sample.clone(),fps=8,save_path=save_path)
+
+            if writer is not None:
+                low, high = (-1,1)
+                sample.clamp_(min=low, max=high)
+                sample.sub_(low).div_(max(high - low, 1e-5)) # -1 ~ 1 --> 0 ~ 1
+                sample = sample.clamp_(0,1).float().cpu()
+                sample = sample.unsqueeze(0).permute(0,2,1,3,4) # BCTHW --> BTCHW
+
+                writer.add_video(
+                    f"validation-{idx}",
+                    sample,
+                    global_step = global_step,
+                    fps=8,
+                    walltime=None
+                )
     
     gc.collect()
     torch.cuda.empty_cache()
 
+def get_val_batch_size(model,val_cfgs,scheduler):
+    '''
+    w/ pipeline inference (refer to `PipelineCausalSTDiT2`), the batch is split into micro-batches that flow through the stages,
+    a batch of a single example (x2 w/ cls-free guidance) keeps most stages idle, so we sample several examples per call,
+    s.t. the batch (x2 w/ cls-free guidance) fills all the stages. Otherwise the examples are sampled one by one as before.
+    '''
+    num_stages = getattr(model,"num_stages",1)
+    if num_stages <= 1:
+        return 1
+    if (batch_size := val_cfgs.get("pipeline_batch_size",None)) is not None:
+        return batch_size
+    cfg_mult = 2 if scheduler.cfg_scale > 1.0 else 1
+    return -(-num_stages // cfg_mult) # ceil
+
+def group_val_examples(val_examples,batch_size):
+    '''
+    groups consecutive examples that can be sampled in one batch (same chunk_len, resolution, ar_steps & first-frame condition),
+    yields lists of (idx, example) with at most `batch_size` examples
+    '''
+    batch,batch_key = [],None
+    for idx,example in enumerate(val_examples):
+        key = (example.auto_regre_chunk_len, example.height, example.width, example.auto_regre_steps, example.first_image is None)
+        if batch and (key != batch_key or len(batch) >= batch_size):
+            yield batch
+            batch = []
+        batch.append((idx,example))
+        batch_key = key
+    if batch:
+        yield batch
+
+def build_init_noise(final_size,seed,device,dtype):
+    '''
+    seed: int (or None) for the whole batch, or a list of per-sample seeds, so that an example sampled in a batch
+    gets the same initial noise as it sampled alone (refer to `group_val_examples`)
+    '''
+    if not isinstance(seed,(list,tuple)):
+        seed = [seed]
+        sizes = [final_size]
+    else:
+        assert len(seed) == final_size[0], f"got {len(seed)} seeds for batch size {final_size[0]}"
+        sizes = [(1,*final_size[1:])] * len(seed)
+    init_noise = []
+    for _seed,size in zip(seed,sizes):
+        generator = torch.Generator(device)
+        if _seed:
+            generator.manual_seed(_seed)
+        init_noise.append(torch.randn(size,generator=generator,device=device,dtype=dtype))
+    return torch.cat(init_noise,dim=0)
+
 def denormalize(x, value_range=(-1, 1)):
 
     low, high = value_range
@@ -121,7 +188,33 @@ def autoregressive_sample_kv_cache(
     kv_cache_dequeue, kv_cache_max_seqlen, verbose=True,
     **kwargs
 ):
-    
+    time_start = time.time()
+    z_predicted = [cond_frame_latents.to(torch.float32)]
+    for samples in autoregressive_sample_kv_cache_iter(
+        scheduler, model, text_encoder,
+        z_size, prompts, cond_frame_latents, ar_steps,
+        kv_cache_dequeue, kv_cache_max_seqlen, verbose=verbose,
+        **kwargs
+    ):
+        z_predicted.append(samples)
+    z_predicted = torch.cat(z_predicted,dim=2) # (B,C, T_c + T_n*ar_steps, H, W)
+
+    time_used = time.time() - time_start
+    num_gen_frames = z_predicted.shape[2] - cond_frame_latents.shape[2]
+
+    return z_predicted,time_used,num_gen_frames
+
+
+def autoregressive_sample_kv_cache_iter(
+    scheduler, model, text_encoder,
+    z_size, prompts, cond_frame_latents, ar_steps,
+    kv_cache_dequeue, kv_cache_max_seqlen, verbose=True,
+    **kwargs
+):
+    '''
+    generator version of `autoregressive_sample_kv_cache`, yields the denoised chunk (B,C,T_n,H,W) of each AR step
+    right after it is written to the kv-cache, so that the caller can decode & show it while the next chunk is denoised (refer to gradio/app.py)
+    '''
     # cond_frame_latents: (B, C, T_c, H, W)
     # NOTE: cond_frame_latents output from vae with bf16, here we cast all tensor to fp32 for better accuracy
     # i.e., make sure bf16 is used only inside vae & STDiT model, outside which we all use fp32
@@ -135,18 +228,19 @@ def autoregressive_sample_kv_cache(
     z_predicted = cond_frame_latents.clone().to(**device_dtype)  # (B,C, T_c, H, W)
     
     time_start = time.time()
-    num_given_frames = z_predicted.shape[2]
-    
+
     model.register_kv_cache(
         bsz*2 if do_cls_free_guidance else bsz,
         max_seq_len = kv_cache_max_seqlen,
         kv_cache_dequeue = kv_cache_dequeue
     )
-    if text_encoder is not None:
-        model_kwargs = text_encoder.encode(prompts) # {y,mask}
-        y_null = text_encoder.null(bsz) if do_cls_free_guidance else None
-    else:
-        model_kwargs = {"y":None,"mask":None} 
+    profiler = get_profiler()
+    with profile_range("text_encode"):
+        if text_encoder is not None:
+            model_kwargs = text_encoder.encode(prompts) # {y,mask}
+            y_null = text_encoder.null(bsz) if do_cls_free_guidance else None
+        else:
+            model_kwargs = {"y":None,"mask":None} 
     
     if do_cls_free_guidance:
         model_kwargs["y"] = torch.cat([y_null,model_kwargs["y"]], dim=0)
@@ -170,39 +264,41 @@ def autoregressive_sample_kv_cache(
     else:
         prefix_condition = z_predicted
     
-    model.write_latents_to_cache(
-        torch.cat([prefix_condition]*2,dim=0) if do_cls_free_guidance else prefix_condition,
-        **model_kwargs
-    )
+    with profile_range("prefix_cache_write"):
+        model.write_latents_to_cache(
+            torch.cat([prefix_condition]*2,dim=0) if do_cls_free_guidance else prefix_condition,
+            **model_kwargs
+        )
 
-    generator = torch.Generator(z_predicted.device)
-    if seed:=kwargs.get("seed",None):
-        generator.manual_seed(seed)
 
     time_used_per_step = []
-    init_noise = torch.randn(final_size,generator=generator,**device_dtype)
+    init_noise = build_init_noise(final_size,kwargs.get("seed",None),**device_dtype)
     progressive_alpha = kwargs.get("progressive_alpha",-1)
+    predicted_len = z_predicted.shape[2]
+    last_cond = z_predicted[:,:,-1:,:,:] # only the last frame is needed (for progressive_alpha), the denoised chunks are yielded to the caller
     for ar_step in tqdm(range(ar_steps),disable=not verbose):
-        predicted_len = z_predicted.shape[2]
         denoise_len = chunk_len
         init_noise_chunk = init_noise[:,:,predicted_len:predicted_len+denoise_len,:,:]
         if progressive_alpha>0: 
             # TODO verify this, check the video gen result is correct
-            last_cond = z_predicted[:,:,-1:,:,:]
             tT_bsz = int(scheduler.num_timesteps -1)  # this is actually after timestep respacing, i.e., here tT  != 999
             tT_bsz = torch.zeros(size=(bsz,),device=z_predicted.device,dtype=torch.long) + tT_bsz
             start_noise = scheduler.q_sample(last_cond,tT_bsz, noise = torch.randn_like(last_cond))
             init_noise_chunk = build_progressive_noise(progressive_alpha, (bsz, *z_size), start_noise)
         
 
-        samples = scheduler.sample_v2(
-            model,
-            z= init_noise_chunk,
-            prompts=prompts,
-            device= z_predicted.device,
-            model_kwargs = model_kwargs,
-            progress_bar = verbose
-        ) # (B, C,T_n,H,W)
+        if profiler is not None:
+            profiler.set_ar_step(ar_step)
+            profiler.log_ar_step(chunk_len=denoise_len,**model.kv_cache_info())
+        with profile_range("denoise"):
+            samples = scheduler.sample_v2(
+                model,
+                z= init_noise_chunk,
+                prompts=prompts,
+                device= z_predicted.device,
+                model_kwargs = model_kwargs,
+                progress_bar = verbose
+            ) # (B, C,T_n,H,W)
         
         if envs.DEBUG_KV_CACHE3:
             print(f"<autoregressive_sample>: ar_step={ar_step}: samples={samples[0,0,:,0,0]}, {samples.shape}")
@@ -222,26 +318,24 @@ def autoregressive_sample_kv_cache(
         else:
             prefix_condition = samples
         
-        model.write_latents_to_cache(
-            torch.cat([prefix_condition]*2,dim=0) if do_cls_free_guidance else prefix_condition,
-            **model_kwargs
-        )
-        z_predicted = torch.cat([z_predicted,samples],dim=2) # (B,C, T_accu + T_n, H, W)
+        with profile_range("kv_cache_write"):
+            model.write_latents_to_cache(
+                torch.cat([prefix_condition]*2,dim=0) if do_cls_free_guidance else prefix_condition,
+                **model_kwargs
+            )
+        last_cond = samples[:,:,-1:,:,:]
 
-        
         if verbose: 
-            print(f"ar_step={ar_step}: given {predicted_len} frames,  denoise:{samples.shape} --> get:{z_predicted.shape}")
+            print(f"ar_step={ar_step}: given {predicted_len} frames,  denoise:{samples.shape} --> get:{predicted_len + samples.shape[2]} frames")
             print(time_used_per_step[-1])
-        
+        predicted_len += samples.shape[2]
+        yield samples # (B,C,T_n,H,W)
 
     if envs.FPS_INFO_SAVE_DIR:
         _path = os.path.join(envs.FPS_INFO_SAVE_DIR,"time_used_per_step.json")
         save_json(time_used_per_step,_path)
-
-    time_used = time.time() - time_start
-    num_gen_frames = z_predicted.shape[2] - num_given_frames
-
-    return z_predicted,time_used,num_gen_frames
+    if profiler is not None:
+        profiler.set_ar_step(None)
 
 
 
@@ -288,12 +382,9 @@ def autoregressive_sample(
     if do_cls_free_guidance:
         model_kwargs["y"] = torch.cat([y_null,model_kwargs["y"]], dim=0)
 
-    generator = torch.Generator(z_predicted.device)
-    if seed:=kwargs.get("seed",None):
-        generator.manual_seed(seed)
     
     time_used_per_step = []
-    init_noise = torch.randn(final_size,generator=generator,**device_dtype)
+    init_noise = build_init_noise(final_size,kwargs.get("seed",None),**device_dtype)
     progressive_alpha = kwargs.get("progressive_alpha",-1)
     for ar_step in tqdm(range(ar_steps),disable=not verbose):
         predicted_len = z_predicted.shape[2]
@@ -0,0 +1,23 @@
+import argparse
+
+from opensora.utils.ckpt_utils import convert_to_safetensors
+
+
+def main():
+    '''
+    convert a model checkpoint to .safetensors, which is memory-mapped by `load_checkpoint_lazy` (zero-copy, no unpickling)
+    python scripts/convert_ckpt_to_safetensors.py --ckpt_path /path/to/epochX-global_stepY
+        (a ckpt dir w/ `model_ckpt.pt`, saves `model.safetensors` in this dir),
+    or  python scripts/convert_ckpt_to_safetensors.py --ckpt_path /path/to/model.pt --save_path /path/to/model.safetensors
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_path", type=str, required=True)
+    parser.add_argument("--save_path", type=str, default=None)
+    args = parser.parse_args()
+
+    save_path = convert_to_safetensors(args.ckpt_path, args.save_path)
+    print(f"saved to {save_path}")
+
+
+if __name__ == "__main__":
+    main()
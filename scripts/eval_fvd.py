@@ -1,16 +1,20 @@
 import os
 import argparse
-import hashlib
 import json
 import random
 import numpy as np
 from tqdm import tqdm
 from pprint import pformat
 import torch
+import torch.distributed as dist
 import torchvision
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from mmengine.config import Config
+from evaluation.fvd.decoded_store import DecodedVideoStore
+from evaluation.fvd.feature_cache import I3DFeatureCache
+from evaluation.fvd.stats import FrechetStats, all_gather_stats, frechet_distance_from_stats
 from opensora.registry import DATASETS, build_module
+from opensora.utils.file_utils import file_stat_key
 from opensora.datasets.skytimelapse_dataset import SkyTimelapseDatasetForEvalFVD
 from opensora.utils.ckpt_utils import create_logger
 
@@ -91,16 +95,23 @@ class GenVideoDataset:
         transforms=None,
         nframes=-1,
         nsamples=-1,
+        seed=None, # fix the random selection, required if the dataset is sharded to multiple ranks
+        decoded_store=None, # `DecodedVideoStore`, read the decoded frames from it instead of decoding the mp4 files
         print_fn = print
     ):
         self.video_dir = video_dir
+        self.decoded_store = decoded_store
         self.transforms = transforms  if transforms is not None else lambda x:x
         self.nframes = nframes
         self.nsamples = nsamples
         self.print_fn = print_fn
 
         filenames = os.listdir(video_dir)
-        random.shuffle(filenames) # make sure it is random, although os.listdir is not sorted
+        if seed is None:
+            random.shuffle(filenames) # make sure it is random, although os.listdir is not sorted
+        else:
+            filenames = sorted(filenames)
+            random.Random(seed).shuffle(filenames)
         if nsamples > 0:
             filenames = filenames[:nsamples]
             if len(filenames) < nsamples:
@@ -112,20 +123,26 @@ class GenVideoDataset:
     
     def __len__(self):
         return len(self.video_paths)
+    
+    def clip_key(self,idx):
+        # identity of the clip for `I3DFeatureCache`, w/o reading the video
+        return [file_stat_key(self.video_paths[idx]), self.nframes]
 
     def __getitem__(self,idx):
         path = self.video_paths[idx]
-        video,audio,info = torchvision.io.read_video(path,pts_unit='sec',output_format="THWC") # uint8 in [0,255]
-        video_fps = info["video_fps"]
-
-        video = video.permute(0,3,1,2) # THWC -> TCHW
-        video = self.transforms(video) # TCHW,  values in -1 ~ 1
+        video = self.decoded_store.get(path) if self.decoded_store is not None else None
+        if video is None:
+            video,audio,info = torchvision.io.read_video(path,pts_unit='sec',output_format="THWC") # uint8 in [0,255]
         
         if self.nframes > 0:
+            # the transforms are frame-wise, so we can drop the frames ahead
             video = video[:self.nframes]
             assert video.shape[0] == self.nframes # otherwise we cannot stack them in `collate_fn`
             # the assert will be False if there are very shot videos (<self.nframes)
 
+        video = video.permute(0,3,1,2) # THWC -> TCHW
+        video = self.transforms(video) # TCHW,  values in -1 ~ 1
+
         
         sample = {
             "video_name":path.split('/')[-1],
@@ -198,71 +215,206 @@ def get_gt_dataset_configs(idx):
     # TODO add other datasets
     return SKY_TIMELAPSE_DATASET[idx]
 
-@torch.no_grad()
-def main(args):
-    # ================================================================
-    # 1. prepare i3d & fvd related funcs
-    # ================================================================
+def build_i3d_feat_fn(args,device):
+    '''
+    Returns:
+        get_window_feats: (videos, windows) -> {window name: np.ndarray (B,400)}, videos: (B,C,T,H,W) in 0~1.
+            The videos are preprocessed (resize & center crop to 224, frame-wise) once, and the frame windows of all videos
+            are fed to I3D in one batched forward (of `args.i3d_batch_size` clips per forward, if set)
+        i3d_tag: identity of the I3D variant, used by `I3DFeatureCache`
+    '''
     if args.method == 'styleganv':
-        from evaluation.fvd.styleganv.fvd import get_fvd_feats, frechet_distance, load_i3d_pretrained
+        from evaluation.fvd.styleganv.fvd import preprocess_single, load_i3d_pretrained
+        preprocess = lambda videos: torch.stack([preprocess_single(video) for video in videos])
+        i3d_kwargs = dict(rescale=False, resize=False, return_features=True) # Return raw features before the softmax layer.
         i3d_weights_path = f"{I3D_WEIGHTS_DIR}/styleganv/i3d_torchscript.pt"
     elif args.method == 'videogpt':
-        from evaluation.fvd.videogpt.fvd import load_i3d_pretrained
-        from evaluation.fvd.videogpt.fvd import get_fvd_logits as get_fvd_feats
-        from evaluation.fvd.videogpt.fvd import frechet_distance
+        from evaluation.fvd.videogpt.fvd import preprocess, load_i3d_pretrained
+        i3d_kwargs = dict()
         i3d_weights_path = f"{I3D_WEIGHTS_DIR}/videogpt/i3d_pretrained_400.pt"
 
-
-    device=torch.device("cuda")
     i3d = load_i3d_pretrained(weights_path=i3d_weights_path,device=device)
 
-    def _get_fvd_feats(vid:torch.Tensor) -> np.ndarray :
-        # vid: (B,C,T,H,W)
-        bsz = vid.shape[0] # we use the bsz outside (i.e., the bsz of dataloader)
-        feats = get_fvd_feats(vid, i3d=i3d, device=device,bs=bsz) # (bsz,400)
-        if args.method == 'styleganv':
-            pass
-        elif args.method == 'videogpt':
-            feats = feats.cpu().numpy()
+    def _get_window_feats(videos:torch.Tensor,windows:dict) -> dict :
+        videos = preprocess(videos) # (B,C,T,224,224), values in -1 ~ 1
+        B = videos.shape[0]
+        feats = dict()
+        # windows of the same length are concatenated along the batch dim
+        groups = dict()
+        for name, fids in windows.items():
+            groups.setdefault(videos.shape[2] if fids is None else len(fids), []).append(name)
+        for names in groups.values():
+            clips = torch.cat([videos if windows[name] is None else videos[:,:,windows[name]] for name in names],dim=0)
+            bs = args.i3d_batch_size if args.i3d_batch_size is not None else len(clips)
+            group_feats = torch.cat([
+                i3d(clips[i:i+bs].to(device),**i3d_kwargs).float().cpu() for i in range(0,len(clips),bs)
+            ],dim=0).numpy()
+            for i, name in enumerate(names):
+                feats[name] = group_feats[i*B:(i+1)*B]
         return feats
-        
+    
+    i3d_tag = [args.method] + file_stat_key(i3d_weights_path)
+    return _get_window_feats, i3d_tag
+
+
+def build_feat_cache(args,dataset,i3d_tag):
+    if args.no_feat_cache:
+        return None
+    # the clips are fed to I3D as `(video + 1) / 2`, after `dataset.transforms`
+    preprocess_tag = f"{repr(dataset.transforms)}; to 0~1"
+    return I3DFeatureCache(args.feat_cache_dir,preprocess_tag=preprocess_tag,i3d_tag=json.dumps(i3d_tag))
+
+
+def compute_fvd_stats(dataset,windows,get_window_feats,feat_cache,args,desc,print_fn=print):
+    '''
+    extract the I3D feats of each frame window of each clip in `dataset`, and accumulate them as streaming `FrechetStats`.
+    Feats in `feat_cache` are reused, only the clips that have missing feats are read and fed to I3D.
+    In distributed mode, each rank takes a shard of `dataset`, and the stats of all ranks are merged at the end.
+    Args:
+        windows (dict): {window name: frame ids (in the clip), or None for all frames}
+        get_window_feats: (videos, windows) -> {window name: feats}, refer to `build_i3d_feat_fn`
+    Returns:
+        {window name: FrechetStats}
+    '''
+    stats = {name:FrechetStats() for name in windows.keys()}
+    cached_feats = {name:[] for name in windows.keys()}
+    def _flush_cached_feats():
+        for name, feats in cached_feats.items():
+            if len(feats) > 0:
+                stats[name].update(np.stack(feats,axis=0))
+            feats.clear()
+
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+    shard_indices = range(rank,len(dataset),world_size)
+    missing_indices, missing_keys = [], []
+    for idx in shard_indices:
+        if feat_cache is None:
+            missing_indices.append(idx)
+            continue
+        clip_key = dataset.clip_key(idx)
+        keys = {name:feat_cache.key(clip_key,fids) for name,fids in windows.items()}
+        feats = {name:feat_cache.get(key) for name,key in keys.items()}
+        if any(feat is None for feat in feats.values()):
+            missing_indices.append(idx)
+            missing_keys.append(keys)
+        else:
+            for name, feat in feats.items():
+                cached_feats[name].append(feat)
+            if len(cached_feats[name]) >= 1024: # all windows have the same number of feats
+                _flush_cached_feats() # keep O(d^2) memory, instead of all the cached feats
+    _flush_cached_feats()
+    print_fn(f"{desc}: {len(shard_indices) - len(missing_indices)} clips from feat_cache, {len(missing_indices)} clips to compute (rank {rank})")
+
+    dataloader = DataLoader(
+        Subset(dataset,missing_indices),
+        batch_size=args.batch_size,
+        drop_last=False,
+        shuffle=False,
+        num_workers=args.num_workers,
+    )
+    num_done = 0
+    for batch in tqdm(dataloader,desc=desc,disable=rank!=0):
+        videos:torch.Tensor = batch["video"] # (B,C,T,H,W), values in -1 ~ 1
+        videos = (videos + 1) / 2.0  # -1~1 --> 0~1
+        window_feats = get_window_feats(videos,windows)
+        for name, feats in window_feats.items():
+            stats[name].update(feats)
+            if feat_cache is not None:
+                for keys, feat in zip(missing_keys[num_done:num_done+len(videos)],feats):
+                    feat_cache.put(keys[name],feat)
+        num_done += len(videos)
+    
+    return {name:all_gather_stats(_stats) for name,_stats in stats.items()}
+
+
+def init_distributed():
+    '''
+    data-parallel evaluation if launched by torchrun. Only the small FrechetStats are exchanged between ranks,
+    so gloo is used (also for CPU-only workers)
+    Returns:
+        device for I3D
+    '''
+    if int(os.getenv("WORLD_SIZE","1")) > 1:
+        dist.init_process_group(backend="gloo")
+    if torch.cuda.is_available():
+        local_rank = int(os.getenv("LOCAL_RANK","0"))
+        torch.cuda.set_device(local_rank)
+        return torch.device("cuda",local_rank)
+    return torch.device("cpu")
+
+
+def build_decoded_store(args,video_paths,print_fn=print):
+    '''decode the videos that are not in the store yet (each rank decodes its shard), refer to `DecodedVideoStore`'''
+    if args.no_decoded_store:
+        return None
+    store = DecodedVideoStore(args.decoded_store_dir)
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+    store.build(video_paths[rank::world_size],num_workers=args.num_workers,print_fn=print_fn)
+    if world_size > 1:
+        dist.barrier()
+        store.reload()
+    return store
+
+
+def get_ar_step_windows(chunk_len,num_ar_steps=None,num_frames=None,min_len=16):
+    '''
+    Args:
+        chunk_len: number of frames generated by each AR-step (after the 1st given frame)
+        num_ar_steps: None for all the AR-steps in `num_frames`
+    Returns:
+        {ar_step: frame ids}, for AR-step 1 ~ num_ar_steps, e.g., for chunk_len=8:
+            1:[1, 2, 3, 4, 5, 6, 7, 8], 2:[9, 10, 11, 12, 13, 14, 15, 16], ...
+        windows shorter than `min_len` are repeated frame-wise (incase too short for downsample in I3D network (8 x downsample))
+            [1,2,3,4,5,6,7,8] --> [1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8]
+    '''
+    if num_ar_steps is None:
+        num_ar_steps = (num_frames - 1) // chunk_len
+    windows = dict()
+    for ar_id in range(1,num_ar_steps+1):
+        sid = (ar_id-1)*chunk_len+1
+        fids = torch.as_tensor(range(sid,sid+chunk_len))
+        if len(fids) < min_len:
+            fids = fids.repeat_interleave(-(-min_len // len(fids)),dim=0)
+        windows[ar_id] = fids
+    return windows
+
+
+def get_num_frames(dataset):
+    return dataset[0]["video"].shape[1] # (C,T,H,W), all videos have the same length
+
+
+def step_fvd_to_chunk1(gen_stats):
+    return {ar_id:frechet_distance_from_stats(gen_stats[ar_id],gen_stats[1]) for ar_id in gen_stats.keys() if ar_id != 1}
 
+
+def step_fvd_to_gt(gen_stats,gt_stats):
+    return {ar_id:frechet_distance_from_stats(_stats,gt_stats) for ar_id,_stats in gen_stats.items()}
+
+
+@torch.no_grad()
+def main(args):
     # ================================================================
-    # 2. prepare logger & configs
+    # 1. prepare logger & configs
     # ================================================================
 
+    device = init_distributed()
     os.makedirs(exp_dir:=args.exp_dir,exist_ok=True)
     logger,log_path = create_logger(exp_dir,return_log_path=True)
     gt_data_cfg = get_gt_dataset_configs(2)
+    gt_data_cfg["sample_seed"] = args.gt_sample_seed
     logger.info(f"use gt_dataset_cfg: \n {pformat(gt_data_cfg)} \n")
 
     sample_config = Config.fromfile(args.sample_config)
     gen_video_dir =  sample_config.sample_save_dir
     logger.info(f"load gen data sampling config: {args.sample_config}")
     logger.info(f"gen_video_dir: {gen_video_dir}")
-    
-    
-    md5_tag = hashlib.md5(str(gt_data_cfg).encode('utf-8')).hexdigest()
-    gt_feats_cache_path = md5_tag + "_gt_feats_cache.npy"
-    gt_feats_cache_path = os.path.join(args.exp_dir,gt_feats_cache_path) # maybe another disk
-    if os.path.exists(gt_feats_cache_path):
-        pass
-        # TODO read cache, skip gt_feats computation
-        # But each run will random sample gt clips, so cached gt_feats is useless ?
 
     # ================================================================
-    # 3. build dataset & dataloader
+    # 2. build dataset & i3d
     # ================================================================
     
     SkyTimelapseDatasetForEvalFVD
     gt_dataset = build_module(gt_data_cfg, DATASETS,print_fn=logger.info)
-    gt_dataloader = DataLoader(
-        gt_dataset,
-        batch_size=args.batch_size,
-        drop_last=False,
-        shuffle=False,
-        num_workers=args.num_workers,
-    )
 
     ''' # use first frame expand to nframes as fake gen video
     gt_data_cfg.update(dict(
@@ -282,39 +434,23 @@ def main(args):
         transforms=gt_dataset.transforms,
         nframes=gt_dataset.n_sample_frames,
         nsamples = gt_dataset.num_samples_total,
+        seed=args.gen_sample_seed,
         print_fn=logger.info
     )
-    gen_dataloader = DataLoader(
-        gen_dataset,
-        batch_size=args.batch_size,
-        drop_last=False,
-        shuffle=False,
-        num_workers=args.num_workers,
-    )
+    gen_dataset.decoded_store = build_decoded_store(args,gen_dataset.video_paths,logger.info)
+
+    get_window_feats, i3d_tag = build_i3d_feat_fn(args,device)
+    feat_cache = build_feat_cache(args,gt_dataset,i3d_tag)
+    
     # ================================================================
-    # 4. compute i3d feats
+    # 3. compute i3d feats
     # ================================================================
+    
+    gt_stats = compute_fvd_stats(gt_dataset,{"all":None},get_window_feats,feat_cache,args,"compute i3d feats for gt data",logger.info)["all"]
+    gen_stats = compute_fvd_stats(gen_dataset,{"all":None},get_window_feats,feat_cache,args,"compute i3d feats for gen data",logger.info)["all"]
 
-    gt_feats = []
-    for batch in tqdm(gt_dataloader,desc="compute i3d feats for gt data"):
-        video_names = batch["video_name"]
-        gt_videos = batch["video"] # (B,C,T,H,W), values in -1 ~ 1
-        gt_videos = (gt_videos + 1) / 2.0  # -1~1 --> 0~1
-        feats = _get_fvd_feats(gt_videos)
-        gt_feats.append(feats)
-    gt_feats = np.concatenate(gt_feats,axis=0)
-
-    gen_feats = []
-    for batch in tqdm(gen_dataloader,desc="compute i3d feats for gen data"):
-        video_names = batch["video_name"]
-        gen_videos:torch.Tensor = batch["video"] # (B,C,T,H,W), values in -1 ~ 1
-        gen_videos = (gen_videos + 1) / 2.0  # -1~1 --> 0~1
-        feats = _get_fvd_feats(gen_videos)
-        gen_feats.append(feats)
-    gen_feats = np.concatenate(gen_feats,axis=0)
-
-    logger.info(f"gt_feats:{gt_feats.shape}; gen_feats:{gen_feats.shape}")
-    fvd = frechet_distance(gen_feats,gt_feats)
+    logger.info(f"gt_feats:{gt_stats.n}; gen_feats:{gen_stats.n}")
+    fvd = frechet_distance_from_stats(gen_stats,gt_stats)
     logger.info(f"fvd={fvd}")
     logger.info(f"results saved at log_path: {log_path}")
 
@@ -322,36 +458,10 @@ def main(args):
 def eval_stepFVD(args):
     
     # ================================================================
-    # 1. prepare i3d & fvd related funcs
-    # ================================================================
-    if args.method == 'styleganv':
-        from evaluation.fvd.styleganv.fvd import get_fvd_feats, frechet_distance, load_i3d_pretrained
-        i3d_weights_path = f"{I3D_WEIGHTS_DIR}/styleganv/i3d_torchscript.pt"
-    elif args.method == 'videogpt':
-        from evaluation.fvd.videogpt.fvd import load_i3d_pretrained
-        from evaluation.fvd.videogpt.fvd import get_fvd_logits as get_fvd_feats
-        from evaluation.fvd.videogpt.fvd import frechet_distance
-        i3d_weights_path = f"{I3D_WEIGHTS_DIR}/videogpt/i3d_pretrained_400.pt"
-
-
-    device=torch.device("cuda")
-    i3d = load_i3d_pretrained(weights_path=i3d_weights_path,device=device)
-
-    def _get_fvd_feats(vid:torch.Tensor) -> np.ndarray :
-        # vid: (B,C,T,H,W)
-        bsz = vid.shape[0] # we use the bsz outside (i.e., the bsz of dataloader)
-        feats = get_fvd_feats(vid, i3d=i3d, device=device,bs=bsz) # (bsz,400)
-        if args.method == 'styleganv':
-            pass
-        elif args.method == 'videogpt':
-            feats = feats.cpu().numpy()
-        return feats
-        
-
-    # ================================================================
-    # 2. prepare logger & configs
+    # 1. prepare logger & configs
     # ================================================================
 
+    device = init_distributed()
     os.makedirs(exp_dir:=args.exp_dir,exist_ok=True)
     logger,log_path = create_logger(exp_dir,return_log_path=True)
     
@@ -362,7 +472,7 @@ def eval_stepFVD(args):
     logger.info(f"gen_video_dir: {gen_video_dir}; num_files={num_files}")
 
     # ================================================================
-    # 3. build dataset & dataloader
+    # 2. build dataset & i3d
     # ================================================================
     
     SkyTimelapseDatasetForEvalFVD
@@ -375,101 +485,33 @@ def eval_stepFVD(args):
         gen_video_dir,
         transforms=gt_dataset.transforms,
         nframes=-1, # TODO make this configable
+        seed=args.gen_sample_seed,
         print_fn=logger.info
     )
+    gen_dataset.decoded_store = build_decoded_store(args,gen_dataset.video_paths,logger.info)
     del gt_dataset
-    gen_dataloader = DataLoader(
-        gen_dataset,
-        batch_size=args.batch_size,
-        drop_last=False,
-        shuffle=False,
-        num_workers=args.num_workers,
-    )
+
+    get_window_feats, i3d_tag = build_i3d_feat_fn(args,device)
+    feat_cache = build_feat_cache(args,gen_dataset,i3d_tag)
 
     # ================================================================
-    # 4. compute i3d feats
+    # 3. compute i3d feats
     # ================================================================
-    ar_steps = [0,1,2,3,4,5,6]
-    ar_steps_to_fids = {0:torch.as_tensor([0])}
-    for ar_id in ar_steps[1:]:
-        sid = (ar_id-1)*8+1
-        fids = torch.as_tensor(range(sid,sid+8))
-        ar_steps_to_fids.update({ar_id:fids})
-    print(ar_steps_to_fids)
-    
-    # ar_steps_to_fids = {
-    #     0:[0,1,2,3,4,5,6,7],
-    #     1:[8, 9, 10, 11, 12, 13, 14, 15],
-    #     2:[16, 17, 18, 19, 20, 21, 22, 23],
-    #     3:[24, 25, 26, 27, 28, 29, 30, 31],
-    #     4:[32, 33, 34, 35, 36, 37, 38, 39],
-    #     5:[40, 41, 42, 43, 44, 45, 46, 47],
-    #     6:[48, 49, 50, 51, 52, 53, 54, 55]
-    # }
-    ar_steps_to_fids = {k:torch.as_tensor(v) for k,v in ar_steps_to_fids.items()}
-    print(ar_steps_to_fids)
+    windows = get_ar_step_windows(args.step_fvd_chunk_len,args.num_ar_steps,get_num_frames(gen_dataset)) # (8,6) by default
+    gen_stats = compute_fvd_stats(gen_dataset,windows,get_window_feats,feat_cache,args,"compute i3d feats for gen data",logger.info)
     
-    gen_feats = {ar_id:[] for ar_id in ar_steps[1:]}
-    for batch in tqdm(gen_dataloader,desc="compute i3d feats for gen data"):
-        video_names = batch["video_name"]
-        gen_videos:torch.Tensor = batch["video"] # (B,C,T,H,W), values in -1 ~ 1
-        gen_videos = (gen_videos + 1) / 2.0  # -1~1 --> 0~1
-        assert ar_steps_to_fids[6][-1] == gen_videos.shape[2] - 1 
-        for ar_id,fids in ar_steps_to_fids.items():
-            if ar_id ==0:
-                continue
-            fids:torch.Tensor
-            if len(fids) < 16:
-                # incase too short for downsample in I3D network (8 x downsample)
-                fids = fids.repeat_interleave(2,dim=0) 
-                # [1,2,3,4,5,6,7,8] --> [1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8]
-            chunk_i = gen_videos[:,:,fids,:,:]
-            feats_i:np.ndarray = _get_fvd_feats(chunk_i)
-            gen_feats[ar_id].append(feats_i)
-    
-    chunk1 = np.concatenate(gen_feats[1],axis=0)
-    logger.info(f"chunk1:{chunk1.shape}")
-    fvd_to_chunk1 = dict()
-    for ar_id in ar_steps[2:]: # 2,3,4,5,6
-        chunk_i = np.concatenate(gen_feats[ar_id],axis=0)
-        fvd_i = frechet_distance(chunk_i,chunk1)
-        fvd_to_chunk1[ar_id] = fvd_i
+    logger.info(f"chunk1:{gen_stats[1].n}")
+    fvd_to_chunk1 = step_fvd_to_chunk1(gen_stats)
     logger.info(f"fvd_to_chunk1={fvd_to_chunk1}")
     logger.info(f"results saved at log_path: {log_path}")
 
 @torch.no_grad()
 def eval_stepFVDtoGT(args):
     # ================================================================
-    # 1. prepare i3d & fvd related funcs
-    # ================================================================
-    if args.method == 'styleganv':
-        from evaluation.fvd.styleganv.fvd import get_fvd_feats, frechet_distance, load_i3d_pretrained
-        i3d_weights_path = f"{I3D_WEIGHTS_DIR}/styleganv/i3d_torchscript.pt"
-    elif args.method == 'videogpt':
-        from evaluation.fvd.videogpt.fvd import load_i3d_pretrained
-        from evaluation.fvd.videogpt.fvd import get_fvd_logits as get_fvd_feats
-        from evaluation.fvd.videogpt.fvd import frechet_distance
-        i3d_weights_path = f"{I3D_WEIGHTS_DIR}/videogpt/i3d_pretrained_400.pt"
-
-
-    device=torch.device("cuda")
-    i3d = load_i3d_pretrained(weights_path=i3d_weights_path,device=device)
-
-    def _get_fvd_feats(vid:torch.Tensor) -> np.ndarray :
-        # vid: (B,C,T,H,W)
-        bsz = vid.shape[0] # we use the bsz outside (i.e., the bsz of dataloader)
-        feats = get_fvd_feats(vid, i3d=i3d, device=device,bs=bsz) # (bsz,400)
-        if args.method == 'styleganv':
-            pass
-        elif args.method == 'videogpt':
-            feats = feats.cpu().numpy()
-        return feats
-        
-
-    # ================================================================
-    # 2. prepare logger & configs
+    # 1. prepare logger & configs
     # ================================================================
 
+    device = init_distributed()
     os.makedirs(exp_dir:=args.exp_dir,exist_ok=True)
     logger,log_path = create_logger(exp_dir,return_log_path=True)
     
@@ -483,87 +525,120 @@ def eval_stepFVDtoGT(args):
     gt_data_cfg = get_gt_dataset_configs(2)
     gt_data_cfg["num_samples_total"]=num_files
     gt_data_cfg["n_sample_frames"]=16
+    gt_data_cfg["sample_seed"] = args.gt_sample_seed
     logger.info(f"use gt_dataset_cfg: \n {pformat(gt_data_cfg)} \n")
 
     # ================================================================
-    # 3. build dataset & dataloader
+    # 2. build dataset & i3d
     # ================================================================
     
     SkyTimelapseDatasetForEvalFVD
     gt_dataset = build_module(gt_data_cfg, DATASETS,print_fn=logger.info)
-    gt_dataloader = DataLoader(
-        gt_dataset,
-        batch_size=args.batch_size,
-        drop_last=False,
-        shuffle=False,
-        num_workers=args.num_workers,
-    )
 
     gen_dataset = GenVideoDataset(
         gen_video_dir,
         transforms=gt_dataset.transforms,
         nframes=-1, # TODO make this configable
+        seed=args.gen_sample_seed,
         print_fn=logger.info
     )
-    gen_dataloader = DataLoader(
-        gen_dataset,
-        batch_size=args.batch_size,
-        drop_last=False,
-        shuffle=False,
-        num_workers=args.num_workers,
-    )
+    gen_dataset.decoded_store = build_decoded_store(args,gen_dataset.video_paths,logger.info)
+
+    get_window_feats, i3d_tag = build_i3d_feat_fn(args,device)
+    feat_cache = build_feat_cache(args,gt_dataset,i3d_tag)
+
     # ================================================================
-    # 4. compute i3d feats
+    # 3. compute i3d feats
     # ================================================================
 
-    gt_feats = []
-    for batch in tqdm(gt_dataloader,desc="compute i3d feats for gt data"):
-        video_names = batch["video_name"]
-        gt_videos:torch.Tensor = batch["video"] # (B,C,T,H,W), values in -1 ~ 1
-        # gt_videos = gt_videos.repeat_interleave(2,dim=2)
-        gt_videos = (gt_videos + 1) / 2.0  # -1~1 --> 0~1
-        feats = _get_fvd_feats(gt_videos)
-        gt_feats.append(feats)
-
-
-    ar_steps = [0,1,2,3]
-    ar_steps_to_fids = {
-        0:[0],
-        1:[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16],
-        2:[17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32],
-        3:[33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48]
-    }
-    # ar_steps_to_fids = {
-    #     0:[0,1,2,3,4,5,6,7],
-    #     1:[8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23],
-    #     2:[24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39],
-    #     3:[40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55]
-    # }
-    ar_steps_to_fids = {k:torch.as_tensor(v) for k,v in ar_steps_to_fids.items()}
-    
-    gen_feats = {ar_id:[] for ar_id in ar_steps[1:]}
-    for batch in tqdm(gen_dataloader,desc="compute i3d feats for gen data"):
-        video_names = batch["video_name"]
-        gen_videos:torch.Tensor = batch["video"] # (B,C,T,H,W), values in -1 ~ 1
-        gen_videos = (gen_videos + 1) / 2.0  # -1~1 --> 0~1
-        assert ar_steps_to_fids[3][-1] == gen_videos.shape[2] - 1, f"gen_videos.shape={gen_videos.shape}"
-        for ar_id,fids in ar_steps_to_fids.items():
-            if ar_id ==0:
-                continue
-            chunk_i = gen_videos[:,:,fids,:,:]
-            feats_i:np.ndarray = _get_fvd_feats(chunk_i)
-            gen_feats[ar_id].append(feats_i)
+    gt_stats = compute_fvd_stats(gt_dataset,{"all":None},get_window_feats,feat_cache,args,"compute i3d feats for gt data",logger.info)["all"]
+
+    windows = get_ar_step_windows(gt_dataset.n_sample_frames,args.num_ar_steps,get_num_frames(gen_dataset)) # (16,3) by default
+    gen_stats = compute_fvd_stats(gen_dataset,windows,get_window_feats,feat_cache,args,"compute i3d feats for gen data",logger.info)
     
-    chunk_gt = np.concatenate(gt_feats,axis=0)
-    logger.info(f"chunk_gt:{chunk_gt.shape}")
-    fvd_to_gt = dict()
-    for ar_id in ar_steps[1:]: # 1,2,3
-        chunk_i = np.concatenate(gen_feats[ar_id],axis=0)
-        fvd_i = frechet_distance(chunk_i,chunk_gt)
-        fvd_to_gt[ar_id] = fvd_i
+    logger.info(f"chunk_gt:{gt_stats.n}")
+    fvd_to_gt = step_fvd_to_gt(gen_stats,gt_stats)
     logger.info(f"fvd_to_chunk_gt={fvd_to_gt}")
     logger.info(f"results saved at log_path: {log_path}")
 
+@torch.no_grad()
+def evaluate_metrics(args):
+    '''
+    evaluate all `args.metrics` (fvd, step_fvd, step_fvd_to_gt) in one pass: each gen video is decoded once (or read from the
+    `DecodedVideoStore`), and the frame windows of all metrics are fed to I3D from the same tensor.
+    The gt clips (16 frames) are shared by fvd and step_fvd_to_gt.
+    '''
+    # ================================================================
+    # 1. prepare logger & configs
+    # ================================================================
+    
+    device = init_distributed()
+    os.makedirs(exp_dir:=args.exp_dir,exist_ok=True)
+    logger,log_path = create_logger(exp_dir,return_log_path=True)
+    metrics = args.metrics.split(',')
+    assert all(m in ["fvd","step_fvd","step_fvd_to_gt"] for m in metrics), metrics
+
+    sample_config = Config.fromfile(args.sample_config)
+    gen_video_dir =  sample_config.sample_save_dir
+    logger.info(f"load gen data sampling config: {args.sample_config}")
+    num_files = len(os.listdir(gen_video_dir))
+    logger.info(f"gen_video_dir: {gen_video_dir}; num_files={num_files}; metrics={metrics}")
+
+    gt_data_cfg = get_gt_dataset_configs(2)
+    gt_data_cfg["num_samples_total"]=num_files
+    gt_data_cfg["n_sample_frames"]=16
+    gt_data_cfg["sample_seed"] = args.gt_sample_seed
+    logger.info(f"use gt_dataset_cfg: \n {pformat(gt_data_cfg)} \n")
+
+    # ================================================================
+    # 2. build dataset & i3d
+    # ================================================================
+    
+    gt_dataset = build_module(gt_data_cfg, DATASETS,print_fn=logger.info)
+    gen_dataset = GenVideoDataset(
+        gen_video_dir,
+        transforms=gt_dataset.transforms,
+        nframes=-1,
+        seed=args.gen_sample_seed,
+        print_fn=logger.info
+    )
+    gen_dataset.decoded_store = build_decoded_store(args,gen_dataset.video_paths,logger.info)
+
+    get_window_feats, i3d_tag = build_i3d_feat_fn(args,device)
+    feat_cache = build_feat_cache(args,gt_dataset,i3d_tag)
+
+    # ================================================================
+    # 3. compute i3d feats of all windows in one pass
+    # ================================================================
+
+    windows = dict()
+    if "fvd" in metrics:
+        windows[("fvd",0)] = torch.arange(gt_dataset.n_sample_frames)
+    num_frames = get_num_frames(gen_dataset)
+    if "step_fvd" in metrics:
+        _windows = get_ar_step_windows(args.step_fvd_chunk_len,args.num_ar_steps,num_frames)
+        windows.update({("step_fvd",ar_id):fids for ar_id,fids in _windows.items()})
+    if "step_fvd_to_gt" in metrics:
+        _windows = get_ar_step_windows(gt_dataset.n_sample_frames,args.num_ar_steps,num_frames)
+        windows.update({("step_fvd_to_gt",ar_id):fids for ar_id,fids in _windows.items()})
+    gen_stats = compute_fvd_stats(gen_dataset,windows,get_window_feats,feat_cache,args,"compute i3d feats for gen data",logger.info)
+    if "fvd" in metrics or "step_fvd_to_gt" in metrics:
+        gt_stats = compute_fvd_stats(gt_dataset,{"all":None},get_window_feats,feat_cache,args,"compute i3d feats for gt data",logger.info)["all"]
+    
+    results = dict()
+    if "fvd" in metrics:
+        results["fvd"] = frechet_distance_from_stats(gen_stats[("fvd",0)],gt_stats)
+    if "step_fvd" in metrics:
+        results["fvd_to_chunk1"] = step_fvd_to_chunk1({ar_id:_stats for (m,ar_id),_stats in gen_stats.items() if m=="step_fvd"})
+    if "step_fvd_to_gt" in metrics:
+        results["fvd_to_chunk_gt"] = step_fvd_to_gt({ar_id:_stats for (m,ar_id),_stats in gen_stats.items() if m=="step_fvd_to_gt"},gt_stats)
+    logger.info(f"results={results}")
+    if log_path is not None:
+        with open(os.path.splitext(log_path)[0] + "_results.json","w") as f:
+            json.dump(results,f,indent=4)
+    logger.info(f"results saved at log_path: {log_path}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--gt_data_config",type=str, default="./configs/default.py",help="training config")
@@ -576,6 +651,16 @@ if __name__ == "__main__":
     parser.add_argument("--num_workers",type=int, default=4)
     parser.add_argument("--verbose", action='store_true')
     parser.add_argument("--step_fvd", action='store_true')
+    parser.add_argument("--gen_sample_seed",type=int, default=0, help="fix the selection of gen videos, the same on all ranks")
+    parser.add_argument("--gt_sample_seed",type=int, default=0, help="fix the random gt clips, so that their i3d feats can be cached")
+    parser.add_argument("--feat_cache_dir",type=str, default=None, help="default: $I3D_FEATURE_CACHE_DIR or ~/.cache/opensora/i3d_feats")
+    parser.add_argument("--no_feat_cache", action='store_true')
+    parser.add_argument("--decoded_store_dir",type=str, default=None, help="default: $DECODED_VIDEO_STORE_DIR or ~/.cache/opensora/decoded_videos")
+    parser.add_argument("--no_decoded_store", action='store_true')
+    parser.add_argument("--i3d_batch_size",type=int, default=None, help="max number of clips (windows) per I3D forward, None for all windows of a batch")
+    parser.add_argument("--step_fvd_chunk_len",type=int, default=8, help="number of frames per AR-step for step_fvd (step_fvd_to_gt uses the gt length)")
+    parser.add_argument("--num_ar_steps",type=int, default=None, help="None for all the AR-steps in the gen videos")
+    parser.add_argument("--metrics",type=str, default=None, help="e.g., fvd,step_fvd,step_fvd_to_gt, evaluate them in one pass")
     args = parser.parse_args()
 
     
@@ -585,7 +670,9 @@ if __name__ == "__main__":
     # i3d_weights_path = f"{I3D_WEIGHTS_DIR}/styleganv/i3d_torchscript.pt" (for styleganv)
     # i3d_weights_path = f"{I3D_WEIGHTS_DIR}/videogpt/i3d_pretrained_400.pt" (for videogpt)
 
-    if args.step_fvd:
+    if args.metrics is not None:
+        evaluate_metrics(args)
+    elif args.step_fvd:
         # eval_stepFVD(args)
         eval_stepFVDtoGT(args)
     else:
@@ -31,7 +31,8 @@ export I3D_WEIGHTS_DIR="${CODE_ROOT}/_backup/common_metrics_on_video_quality-mai
 # i3d_weights_path = f"{I3D_WEIGHTS_DIR}/videogpt/i3d_pretrained_400.pt" (for videogpt)
 
 
-python scripts/eval_fvd.py \
+# data-parallel over $NUM_GPUS processes (for CPU-only workers, set CUDA_VISIBLE_DEVICES="" and --nproc_per_node N)
+torchrun --standalone --nproc_per_node $NUM_GPUS scripts/eval_fvd.py \
     --step_fvd \
     --sample_config $ABS_SAMPLE_CONFIG \
     --exp_dir $EXP_DIR \
@@ -16,6 +16,7 @@ from mmengine.config import Config
 from colossalai.utils import get_current_device, set_seed
 from opensora.datasets import video_transforms
 
+from opensora.acceleration.parallel_states import set_pipeline_parallel_group, set_sequence_parallel_group
 from opensora.registry import DATASETS, MODELS, SCHEDULERS, build_module
 from opensora.utils.ckpt_utils import create_logger
 from opensora.utils.misc import (
@@ -24,6 +25,7 @@ from opensora.utils.misc import (
 )
 from opensora.utils.video_gen import validation_visualize
 from opensora.utils.debug_utils import envs
+from opensora.utils.profiling import enable_profiling, disable_profiling
 
 
 def build_validate_examples(examples_or_path,sample_cfgs,print_fn):
@@ -144,16 +146,37 @@ def main(cfg):
     latent_size = vae.get_latent_size(input_size)
     assert os.path.exists(cfg.ckpt_path)
     cfg.model.from_pretrained = cfg.ckpt_path
+    if cfg.lazy_load_ckpt and cfg.model.type.startswith("CausalSTDiT2"):
+        # build w/o random init and load the memory-mapped ckpt directly to device, refer to `load_checkpoint_lazy`
+        load_kwargs = dict(load_device=device, load_dtype=dtype)
+    else:
+        load_kwargs = dict()
+    if cfg.kv_cache_sequence_parallel:
+        # all ranks generate the same video, each rank holds the spatial tokens (and their kv-cache) of its shard
+        assert cfg.model.type.startswith("CausalSTDiT2") and cfg.enable_kv_cache
+        set_sequence_parallel_group(dist.group.WORLD)
+        load_kwargs.update(kv_cache_sequence_parallel=True, kv_cache_sp_comm_chunks=cfg.kv_cache_sp_comm_chunks)
+    if cfg.pipeline_parallel:
+        # each rank keeps the blocks (and the kv-cache) of its stage, refer to `PipelineCausalSTDiT2`
+        assert cfg.model.type.startswith("CausalSTDiT2") and cfg.enable_kv_cache and (not cfg.kv_cache_sequence_parallel)
+        set_pipeline_parallel_group(dist.group.WORLD)
+        if "load_device" in load_kwargs:
+            load_kwargs.update(load_device="cpu") # only move the blocks of this stage to device
     model = build_module(
         cfg.model,
         MODELS,
         input_size=latent_size,
         in_channels=vae.out_channels,
         caption_channels=text_encoder_output_dim,
-        model_max_length=text_encoder_model_max_length
+        model_max_length=text_encoder_model_max_length,
+        **load_kwargs
     )
     if text_encoder is not None:
         text_encoder.y_embedder = model.y_embedder  # hack for classifier-free guidance
+    if cfg.pipeline_parallel:
+        from opensora.models.causal_stdit2.pipeline import PipelineCausalSTDiT2
+        model = PipelineCausalSTDiT2(model, num_micro_batches=cfg.pipeline_micro_batches)
+        logger.info(f"pipeline stage {model.stage}/{model.num_stages}: blocks {model.block_range}")
 
 
     # 4.3. move to device
@@ -173,7 +196,14 @@ def main(cfg):
     except:
         assert False, f"global_step={global_step}"
     
+    if cfg.profile_kv_cache:
+        # time each phase of the kv-cache sampler (w/ cuda sync), refer to `opensora/utils/profiling.py`
+        profiler = enable_profiling(sync_cuda=cfg.profile_sync_cuda)
     validation_visualize(model,vae,text_encoder,val_examples,cfg,exp_dir,writer=None,global_step=global_step)
+    if cfg.profile_kv_cache:
+        report_path,trace_path = profiler.save(os.path.join(exp_dir,"profile"))
+        disable_profiling()
+        logger.info(f"profiling report saved at {report_path}, chrome trace saved at {trace_path}")
 
 def merge_args(cfg,train_cfg,args):
     cfg.update(dict(
@@ -204,6 +234,14 @@ def merge_args(cfg,train_cfg,args):
         enable_kv_cache = True,
         kv_cache_dequeue = True,
         kv_cache_max_seqlen = 65,
+        lazy_load_ckpt = True,
+        profile_kv_cache = False,
+        profile_sync_cuda = True,
+        kv_cache_sequence_parallel = False,
+        kv_cache_sp_comm_chunks = 1, # >1: overlap the qkv projection of head groups with all_to_all
+        pipeline_parallel = False,
+        pipeline_micro_batches = None, # None: one per stage; the micro-batches are split from the batch of each model call
+        pipeline_batch_size = None, # num of examples sampled per call w/ pipeline_parallel, None: ceil(num of stages / 2) w/ cls-free guidance (num of stages w/o), s.t. the batch fills all stages
     )
     
 
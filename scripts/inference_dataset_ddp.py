@@ -1,8 +1,14 @@
 
 import argparse
+import copy
 import hashlib
 import os
 import gc
+import glob
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import random
 from datetime import timedelta,datetime
 import json
 from easydict import EasyDict
@@ -10,12 +16,14 @@ from tqdm import tqdm
 
 import torch
 import torch.distributed as dist
-from torch.utils.data import DataLoader,DistributedSampler
+import torch.multiprocessing as mp
+from torch.utils.data import default_collate
 import torchvision
 
 from mmengine.config import Config
 from colossalai.utils import get_current_device, set_seed
 from opensora.datasets import save_sample
+from opensora.datasets.sampler import WorkStealingBatchSampler
 from opensora.registry import DATASETS, MODELS, SCHEDULERS, build_module
 from opensora.utils.ckpt_utils import create_logger
 from opensora.utils.misc import (
@@ -24,6 +32,131 @@ from opensora.utils.misc import (
 )
 from opensora.utils.video_gen import autoregressive_sample,autoregressive_sample_kv_cache
 from opensora.utils.debug_utils import envs
+from opensora.utils.profiling import enable_profiling, disable_profiling, profile_range
+
+
+class IndexedDataset:
+    '''wraps a dataset and adds the dataset index to each sample, so that finished samples can be recorded'''
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        sample["index"] = index
+        return sample
+
+
+_worker_dataset = None
+
+
+def _init_decode_worker(dataset, base_seed):
+    # the same per-worker setup as a DataLoader worker
+    global _worker_dataset
+    _worker_dataset = dataset
+    seed = (base_seed + os.getpid()) % 2**32
+    random.seed(seed)
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)
+
+
+def _decode_sample(index):
+    return _worker_dataset[index]
+
+
+def iter_claimed_batches(batch_sampler, dataset, num_workers, prefetch=None):
+    '''
+    claim the batches of `WorkStealingBatchSampler` lazily in the sampling loop, and decode them with a pool of worker processes.
+    At most `prefetch` batches are claimed ahead of the one being sampled, i.e., a straggler holds at most `prefetch + 1` unfinished batches.
+    by default, prefetch = ceil(num_workers / batch_size), i.e., just enough claimed samples to keep all workers busy
+    (a DataLoader iterates the batch sampler in the main process and claims `prefetch_factor * num_workers` batches at once)
+    '''
+    if num_workers == 0:
+        for batch_indices in batch_sampler:
+            yield default_collate([dataset[index] for index in batch_indices])
+        return
+    if prefetch is None:
+        prefetch = max(1, -(-num_workers // batch_sampler.batch_size))
+
+    # tensors are returned through shared memory (the reductions of torch.multiprocessing), as in a DataLoader
+    pool = mp.get_context("fork").Pool(num_workers, initializer=_init_decode_worker, initargs=(dataset, torch.initial_seed()))
+    pending = deque()
+    try:
+        for batch_indices in batch_sampler:  # each step claims one batch
+            pending.append(pool.map_async(_decode_sample, batch_indices, chunksize=1))
+            if len(pending) > prefetch:
+                yield default_collate(pending.popleft().get())
+        while pending:
+            yield default_collate(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# runtime knobs that do not change the samples, excluded from the hash of `sample_save_dir`,
+# so that changing them (e.g., for a resumed job) keeps the same dir and the finished samples
+EXECUTION_ONLY_KEYS = [
+    "skip_finished",
+    "num_writer_threads",
+    "lazy_load_ckpt",
+    "profile_kv_cache",
+    "profile_sync_cuda",
+    "vae_micro_batch_size",
+]
+
+
+def get_cfg_md5(cfg):
+    cfg_dict = copy.deepcopy(cfg._cfg_dict)
+    for k in EXECUTION_ONLY_KEYS:
+        cfg_dict.pop(k, None)
+    return hashlib.md5(str(cfg_dict).encode('utf-8')).hexdigest()
+
+
+def load_finished_video_names(sample_save_dir):
+    '''read all manifest files (one per rank of previous runs) and return the names of the videos that are on disk'''
+    finished = set()
+    for manifest_path in glob.glob(os.path.join(sample_save_dir, "manifest_rank*.jsonl")):
+        for record in load_jsonl(manifest_path):
+            if os.path.exists(record["save_path"]):
+                finished.add(record["video_name"])
+    return finished
+
+
+class AsyncSampleWriter:
+    '''
+    write videos with background threads, so that the sampling loop never waits for disk I/O.
+    Each finished video is appended to this rank's manifest, which is used to resume the job.
+    '''
+    def __init__(self, manifest_path, num_threads=2, max_pending=16, logger=None):
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.manifest_path = manifest_path
+        self.max_pending = max_pending
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def _write(self, sample, index, video_name, save_path, fps):
+        save_path = save_sample(sample, fps=fps, save_path=save_path)
+        with self._lock:
+            with open(self.manifest_path, "a") as f:
+                f.write(json.dumps(dict(index=index, video_name=video_name, save_path=save_path)) + "\n")
+        if self.logger is not None:
+            self.logger.info(f"rank-{dist.get_rank()} wirte video to {save_path}")
+
+    def submit(self, sample, index, video_name, save_path, fps=8):
+        # bound the number of videos held in CPU memory
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(self.executor.submit(self._write, sample, index, video_name, save_path, fps))
+
+    def close(self):
+        for future in self._pending:
+            future.result()
+        self._pending = []
+        self.executor.shutdown(wait=True)
 
 
 @torch.no_grad()
@@ -55,7 +188,7 @@ def main(cfg):
     
     # make sample output dir
     exp_name = exp_dir.split('/')[-1]
-    md5_tag = hashlib.md5(str(cfg._cfg_dict).encode('utf-8')).hexdigest()
+    md5_tag = get_cfg_md5(cfg)
     md5_tag = md5_tag + "_" + exp_name
     sample_save_dir = os.path.join(cfg.sample_save_dir,md5_tag) # maybe another disk
     os.makedirs(sample_save_dir,exist_ok=True)
@@ -91,13 +224,19 @@ def main(cfg):
     latent_size = vae.get_latent_size(input_size)
     assert os.path.exists(cfg.ckpt_path)
     cfg.model.from_pretrained = cfg.ckpt_path
+    if cfg.lazy_load_ckpt and cfg.model.type.startswith("CausalSTDiT2"):
+        # build w/o random init and load the memory-mapped ckpt directly to device, refer to `load_checkpoint_lazy`
+        load_kwargs = dict(load_device=device, load_dtype=dtype)
+    else:
+        load_kwargs = dict()
     model = build_module(
         cfg.model,
         MODELS,
         input_size=latent_size,
         in_channels=vae.out_channels,
         caption_channels=text_encoder_output_dim,
-        model_max_length=text_encoder_model_max_length
+        model_max_length=text_encoder_model_max_length,
+        **load_kwargs
     )
     if text_encoder is not None:
         text_encoder.y_embedder = model.y_embedder  # hack for classifier-free guidance
@@ -111,20 +250,34 @@ def main(cfg):
 
     # 6.2. build validation dataset
     dataset = build_module(cfg.val_data_cfg, DATASETS)
-    
-    sampler = DistributedSampler(
-        dataset,
-        shuffle=True,
-        drop_last=False
-    )
 
-    dataloader = DataLoader(
-        dataset,
+    # skip finished samples before sharding, rank-0 decides so that all ranks share the same work list
+    todo_indices = [None]
+    if is_master():
+        finished = load_finished_video_names(sample_save_dir) if cfg.skip_finished else set()
+        g = torch.Generator()
+        g.manual_seed(0)
+        todo_indices = torch.randperm(len(dataset), generator=g).tolist()
+        if len(finished) > 0:
+            # keyed by the video name (the saved file), which is fixed only if the dataset sampling is fixed (e.g., `sample_seed`)
+            todo_indices = [i for i in todo_indices if dataset.video_name(i) not in finished]
+        todo_indices = [todo_indices]
+        logger.info(f"{len(finished)} samples are finished, {len(todo_indices[0])} samples to go")
+    dist.broadcast_object_list(todo_indices, src=0)
+    todo_indices = todo_indices[0]
+
+    # dynamic sharding, each rank claims the next batch once it is free
+    batch_sampler = WorkStealingBatchSampler(
+        todo_indices,
         batch_size=cfg.batch_size,
-        drop_last=False,
-        shuffle=False,
-        num_workers=cfg.num_workers,
-        sampler=sampler
+        key=f"inference_dataset_ddp/{md5_tag}"
+    )
+
+    dataloader = iter_claimed_batches(batch_sampler, IndexedDataset(dataset), num_workers=cfg.num_workers)
+    writer = AsyncSampleWriter(
+        manifest_path=os.path.join(sample_save_dir, f"manifest_rank{dist.get_rank()}.jsonl"),
+        num_threads=cfg.num_writer_threads,
+        logger=logger
     )
 
     # ==========================================================================================
@@ -132,7 +285,8 @@ def main(cfg):
     # ==========================================================================================
 
     assert vae.patch_size[0] == 1, "TODO: consider temporal patchify"
-    vae.micro_batch_size = 33
+    vae.micro_batch_size = cfg.get("vae_micro_batch_size","auto")
+    vae.tile_sample_size = cfg.get("vae_tile_sample_size",vae.tile_sample_size) # by default, tiled above 256x256
     
     scheduler = build_module(cfg.scheduler,SCHEDULERS)
     assert cfg.get("clean_prefix",True), "TODO add code for non first frame conditioned"
@@ -161,9 +315,13 @@ def main(cfg):
     z_size = (vae.out_channels, *latent_size)
     auto_regre_steps = sample_cfgs.auto_regre_steps
 
-    for batch in tqdm(dataloader,disable=not is_master()):
+    if cfg.profile_kv_cache:
+        # time each phase of the kv-cache sampler (w/ cuda sync), refer to `opensora/utils/profiling.py`
+        profiler = enable_profiling(sync_cuda=cfg.profile_sync_cuda)
+    for batch in tqdm(dataloader,total=len(batch_sampler),disable=not is_master()):
         
         video_names = batch["video_name"]
+        indices = batch["index"].tolist()
         prompts = batch["text"] if text_encoder is not None else [None]*len(video_names)
         if dataset.read_first_frame:
             first_frame = batch["first_frame"]  # (B, C, 1, H, W)
@@ -196,18 +354,20 @@ def main(cfg):
         # fps = num_gen_frames / time_used
         # print(f"num_gen_frames={num_gen_frames}, time_used={time_used:.2f}, fps={fps:.2f}")
         
-        samples = vae.decode(samples.to(dtype=dtype)) # (B, C, T, H, W)
-        for rank_id in range(dist.get_world_size()): # Write files sequentially
-            for idx in range(samples.shape[0]):
-                video_name = video_names[idx] # e.g., 07U1fSrk9oI_frames_00000046.jpg.mp4
-                sample = samples[idx]
-                save_path = os.path.join(sample_save_dir,video_name)
-                save_sample(sample.clone(),fps=8,save_path=save_path)
-                logger.info(f"rank-{rank_id} wirte video to {save_path}")
-
-            dist.barrier()
-        
+        with profile_range("vae_decode"):
+            # decoded frames are offloaded per micro-batch, so that the GPU memory does not grow with the video length
+            samples = vae.decode(samples.to(dtype=dtype),out_device="cpu") # (B, C, T, H, W)
+        samples = samples.float() # hand over to the writer threads, w/o holding GPU memory
+        for idx in range(samples.shape[0]):
+            video_name = video_names[idx] # e.g., 07U1fSrk9oI_frames_00000046.jpg.mp4
+            save_path = os.path.join(sample_save_dir,video_name)
+            writer.submit(samples[idx].clone(), indices[idx], video_name, save_path, fps=8)
         
+    writer.close()
+    if cfg.profile_kv_cache:
+        report_path,trace_path = profiler.save(os.path.join(exp_dir,"profile"),prefix=f"kv_cache_profile_rank{dist.get_rank()}")
+        disable_profiling()
+        logger.info(f"profiling report saved at {report_path}, chrome trace saved at {trace_path}")
     dist.barrier()
     gc.collect()
     torch.cuda.empty_cache()
@@ -238,6 +398,11 @@ def merge_args(cfg,train_cfg,args):
         enable_kv_cache = True,
         kv_cache_dequeue = True,
         kv_cache_max_seqlen = 65,
+        lazy_load_ckpt = True,
+        skip_finished = True, # resume from the manifests in `sample_save_dir`
+        num_writer_threads = 2,
+        profile_kv_cache = False,
+        profile_sync_cuda = True,
     )
 
     for k, v in default_cfgs.items():
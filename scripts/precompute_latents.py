@@ -0,0 +1,184 @@
+
+import argparse
+import os
+import gc
+import json
+from copy import deepcopy
+from datetime import timedelta
+from functools import partial
+from tqdm import tqdm
+
+import torch
+import torch.distributed as dist
+import torchvision
+from torch.utils.data import DataLoader, DistributedSampler
+
+from mmengine.config import Config
+from colossalai.utils import get_current_device, set_seed
+from opensora.datasets.latent_dataset import LatentShardWriter, LATENT_STORE_META
+from opensora.datasets.video_transforms import RandomHorizontalFlipVideo
+from opensora.registry import DATASETS, MODELS, build_module
+from opensora.utils.ckpt_utils import create_logger
+from opensora.utils.misc import to_torch_dtype
+
+
+def first_window_sample(n_sample_frames, sample_interval, total_frames):
+    return list(range(0, total_frames, sample_interval))[:n_sample_frames]
+
+
+def disable_random_augmentation(dataset):
+    '''
+    the random augmentations of the training dataset must not be frozen into the store:
+        the random flip is removed, both flips are encoded instead (`store_flip`), and `LatentTextDataset` picks one per sample
+        the random temporal window starts at the first frame, `LatentTextDataset` randomly crops `n_sample_frames`
+        of the `n_store_frames` stored frames, so set n_store_frames > n_sample_frames to keep the temporal augmentation
+    '''
+    transforms = getattr(dataset, "transforms", None)
+    if isinstance(transforms, torchvision.transforms.Compose):
+        transforms.transforms = [t for t in transforms.transforms if not isinstance(t, RandomHorizontalFlipVideo)]
+    if hasattr(dataset, "temporal_random_sample"):
+        dataset.temporal_random_sample = partial(first_window_sample, dataset.n_sample_frames, dataset.sample_interval)
+
+
+@torch.no_grad()
+def main(cfg):
+    '''
+    encode the training clips once with the (frozen) VAE and text encoder, and save them as a latent store
+    which is read by `LatentTextDataset`, e.g., set in the training config:
+        train_data_cfg = dict(type="LatentTextDataset", root=/path/to/output_dir, n_sample_frames=33)
+    '''
+    assert torch.cuda.is_available()
+    dist.init_process_group(backend="nccl", timeout=timedelta(hours=24))
+    torch.cuda.set_device(dist.get_rank() % torch.cuda.device_count())
+    set_seed(1024)
+    device = get_current_device()
+    dtype = to_torch_dtype(cfg.dtype)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+
+    output_dir = cfg.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    logger = create_logger(output_dir if rank == 0 else None)
+
+    # each clip is stored with `n_store_frames` frames, the training dataset randomly crops `n_sample_frames` of them in latent space
+    train_data_cfg = deepcopy(cfg.train_data_cfg)
+    train_data_cfg.update(n_sample_frames=cfg.n_store_frames)
+    dataset = build_module(train_data_cfg, DATASETS, print_fn=logger.info)
+    disable_random_augmentation(dataset)
+    logger.info(f"Dataset `{train_data_cfg.type}` is built, with {len(dataset)} videos.")
+
+    sampler = DistributedSampler(dataset, shuffle=False, drop_last=False)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=cfg.batch_size,
+        shuffle=False,
+        drop_last=False,
+        num_workers=cfg.num_workers,
+        sampler=sampler,
+    )
+
+    text_encoder = build_module(cfg.get("text_encoder", None), MODELS, device=device)
+    vae = build_module(cfg.vae, MODELS).to(device, dtype).eval()
+    vae.micro_batch_size = cfg.get("vae_micro_batch_size", "auto")
+
+    # the posterior mean & std are stored, so that each epoch samples new noise, of the clip and (if store_flip) its flip
+    input_size = (cfg.n_store_frames, *dataset.image_size)
+    num_flips = 2 if cfg.store_flip else 1
+    latent_shape = (num_flips, 2, vae.out_channels, *vae.get_latent_size(input_size))
+
+    # DistributedSampler pads the index list to be divisible by world_size (rank r gets positions r, r+W, ...),
+    # skip the padded positions so that each clip is stored exactly once
+    num_positions = len(sampler)
+    is_padded = [rank + j * world_size >= len(dataset) for j in range(num_positions)]
+    num_rows = num_positions - sum(is_padded)
+    shard_sizes = [min(cfg.shard_size, num_rows - i) for i in range(0, num_rows, cfg.shard_size)]
+    shards, writer = [], None
+
+    pos = 0
+    for batch in tqdm(dataloader, disable=rank != 0):
+        x = batch["video"].to(device, dtype)  # (B, C, T, H, W)
+        z = vae.encode_moments(x)  # (B, 2, C, T, h, w), mean & std
+        if cfg.store_flip:
+            z = torch.stack([z, vae.encode_moments(x.flip(-1))], dim=1)  # (B, 2, 2, C, T, h, w)
+        else:
+            z = z[:, None]
+        texts = batch["text"]
+        if text_encoder is not None:
+            text_kwargs = text_encoder.encode(texts)
+            ys, masks = text_kwargs["y"][:, 0], text_kwargs["mask"]  # (B, L, D), (B, L)
+        else:
+            ys, masks = [None] * len(texts), [None] * len(texts)
+
+        for b in range(z.shape[0]):
+            pos += 1
+            if is_padded[pos - 1]:
+                continue
+
+            if writer is None:
+                shard_name = f"shard_r{rank:03d}_{len(shards):04d}"
+                writer = LatentShardWriter(os.path.join(output_dir, shard_name), shard_sizes[len(shards)], latent_shape)
+                shards.append(shard_name)
+            writer.add(z[b], texts[b], batch["actual_length"][b], y=ys[b], mask=masks[b])
+            if len(writer) == writer.num_rows:
+                writer.close()
+                writer = None
+
+    assert writer is None
+    all_shards = [None] * world_size
+    dist.all_gather_object(all_shards, shards)
+    if rank == 0:
+        meta = dict(
+            source_data_cfg=train_data_cfg,
+            vae=cfg.vae,
+            n_store_frames=cfg.n_store_frames,
+            store_moments=True,
+            num_flips=num_flips,
+            image_size=list(dataset.image_size),
+            latent_shape=list(latent_shape),
+            has_text_embedding=text_encoder is not None,
+            shards=sorted(s for shards_per_rank in all_shards for s in shards_per_rank),
+        )
+        with open(os.path.join(output_dir, LATENT_STORE_META), "w") as f:
+            json.dump(meta, f, indent=4)
+        logger.info(f"latent store with {len(meta['shards'])} shards is saved at {output_dir}")
+
+    dist.barrier()
+    gc.collect()
+    torch.cuda.empty_cache()
+
+
+def merge_args(cfg, args):
+    default_cfgs = dict(
+        dtype = "fp16",
+        batch_size = 4,
+        num_workers = 4,
+        shard_size = 1024,
+        store_flip = True,
+    )
+    for k, v in default_cfgs.items():
+        if k not in cfg:
+            cfg[k] = v
+
+    for k, v in vars(args).items():
+        if v is not None:
+            cfg[k] = v
+
+    if cfg.get("n_store_frames", None) is None:
+        cfg.n_store_frames = cfg.train_data_cfg.n_sample_frames
+    return cfg
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./configs/default.py", help="training config")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--n_store_frames", type=int, default=None, help="frames stored per clip, defaults to train_data_cfg.n_sample_frames")
+    parser.add_argument("--shard_size", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=None)
+    parser.add_argument("--no_store_flip", dest="store_flip", action="store_false", default=None,
+                        help="only store the unflipped clips (half the size), the flip augmentation is lost")
+    args = parser.parse_args()
+
+    configs = Config.fromfile(args.config)
+    configs = merge_args(configs, args)
+
+    main(configs)
@@ -31,9 +31,11 @@ from opensora.acceleration.parallel_states import (
 from opensora.acceleration.plugin import ZeroSeqParallelPlugin
 from opensora.datasets import prepare_dataloader,save_sample
 from opensora.datasets import video_transforms
+from opensora.datasets.latent_dataset import LatentStoreTextEncoder, LatentTextDataset
 
 from opensora.registry import DATASETS, MODELS, SCHEDULERS, build_module
-from opensora.utils.ckpt_utils import create_logger, load, model_sharding, record_model_param_shape, save
+from opensora.schedulers.iddpm import build_progressive_noise
+from opensora.utils.ckpt_utils import AsyncCheckpointer, create_logger, load, model_sharding, record_model_param_shape, save
 from opensora.utils.config_utils import create_tensorboard_writer,save_training_config
 from opensora.utils.misc import (
     all_reduce_mean, 
@@ -43,7 +45,7 @@ from opensora.utils.misc import (
     to_torch_dtype,
     load_jsonl
 )
-from opensora.utils.train_utils import update_ema, PrefixLenSampler
+from opensora.utils.train_utils import EMAUpdater, PrefixLenSampler
 from opensora.utils.debug_utils import envs
 from opensora.utils.video_gen import validation_visualize
 
@@ -130,7 +132,14 @@ def main(cfg):
     # 4. build model
     # ======================================================
     # 4.1. build model
-    text_encoder = build_module(cfg.get("text_encoder", None), MODELS, device=device)
+    # w/ a latent store (precomputed by scripts/precompute_latents.py), the training loop needs neither T5 nor the VAE encoder
+    use_latent_store = isinstance(dataset, LatentTextDataset)
+    if use_latent_store and dataset.has_text_embedding and cfg.get("text_encoder", None) is not None:
+        # T5 is built only if a validation prompt is not in the store
+        build_text_encoder = lambda: build_module(cfg.text_encoder, MODELS, device=device)
+        text_encoder = LatentStoreTextEncoder(dataset, device, build_fn=build_text_encoder)
+    else:
+        text_encoder = build_module(cfg.get("text_encoder", None), MODELS, device=device)
     if text_encoder is not None:
         text_encoder_output_dim = text_encoder.output_dim
         text_encoder_model_max_length = text_encoder.model_max_length
@@ -164,12 +173,13 @@ def main(cfg):
     
 
     # 4.2. create ema
-    ema = deepcopy(model).to(torch.float32).to(device)
+    ema = deepcopy(model).to(torch.float32).to("cpu" if cfg.ema_on_cpu else device)
     requires_grad(ema, False)
     ema_shape_dict = record_model_param_shape(ema)
 
     # 4.3. move to device
-    vae = vae.to(device, dtype)
+    vae_device = "cpu" if use_latent_store else device # w/ the latent store, the VAE is moved to device only for validation
+    vae = vae.to(vae_device, dtype)
     model = model.to(device, dtype)
 
     # 4.4. build scheduler
@@ -188,7 +198,7 @@ def main(cfg):
     if cfg.grad_checkpoint:
         set_grad_checkpoint(model)
     model.train()
-    update_ema(ema, model, decay=0, sharded=False)
+    EMAUpdater(ema, model, sharded=False).update(decay=0)
     ema.eval()
 
     # =======================================================
@@ -203,6 +213,7 @@ def main(cfg):
     )
     torch.set_default_dtype(torch.float)
     logger.info("Boost model for distributed training")
+    ema_updater = EMAUpdater(ema, model.module, optimizer=optimizer, decay=cfg.ema_decay, update_every=cfg.ema_update_every)
 
     # =======================================================
     # 6. training loop
@@ -247,12 +258,18 @@ def main(cfg):
     val_examples = val_cfgs.get("examples",None)
     val_examples = val_examples if val_examples is not None else val_cfgs.examples_json 
     val_examples = build_validate_examples(val_examples,val_cfgs.sample_cfgs,print_fn=logger.info)
-    if cfg.validate_before_train and coordinator.is_master():
+    def validate():
         model.eval()
+        vae.to(device)
         validation_visualize(model.module,vae,text_encoder,val_examples,val_cfgs,exp_dir,writer,global_step)
+        vae.to(vae_device)
         model.train()
 
+    if cfg.validate_before_train and coordinator.is_master():
+        validate()
+
     # 6.3. training loop
+    async_checkpointer = AsyncCheckpointer(max_pending=cfg.async_ckpt_max_pending) if cfg.async_ckpt else None
 
     for epoch in range(start_epoch, cfg.epochs):
         
@@ -271,21 +288,60 @@ def main(cfg):
             loss_accu_step = 0
             for step, batch in enumerate(dataloader_iter):
                 is_last_step = (step == len(dataloader_iter) - 1)
-                x = batch.pop("video").to(device, dtype)  # [B, C, T, H, W]
                 y = batch.pop("text")
                 # Visual and text encoding
                 with torch.no_grad():
                     # Prepare visual inputs
-                    x = vae.encode(x)  # [B, C, T, H/P, W/P]
+                    if "latent" in batch:
+                        # precomputed by scripts/precompute_latents.py
+                        x = batch.pop("latent").to(device, dtype)  # [B, C, T, H/P, W/P]
+                    else:
+                        x = batch.pop("video").to(device, dtype)  # [B, C, T, H, W]
+                        x = vae.encode(x)  # [B, C, T, H/P, W/P]
                     # Prepare text inputs
-                    if text_encoder is not None:
+                    if "y" in batch:
+                        model_kwargs = {"y":batch.pop("y").to(device, dtype),"mask":batch.pop("mask").to(device)}
+                    elif text_encoder is not None:
                         model_kwargs = text_encoder.encode(y) # {y,y_mask}
                     else:
                         model_kwargs = {"y":None,"mask":None}
                     
                 bsz = x.shape[0]
                 actual_length = batch["actual_length"]
-                if cfg.clean_prefix:
+                segment_lens = None
+                if cfg.packed_training:
+                    '''e.g., pack clips with different actual_length & prefix_len along the temporal axis (no padding)
+                                [segment 0                     | segment 1          | ...]
+                    latents:    [z0,...,z9,  | z10,...,z13,    | z0,...,z4, | z5,...,z8, | ...]
+                    mask_channel[1,...,1,    | 0,...,0,        | 1,...,1,   | 0,...,0,   | ...]
+                    loss_mask   [0,...,0,    | 1,...,1,        | 0,...,0,   | 1,...,1,   | ...]
+                    t_input     [0,...,0,    | t0,...,t0,      | 0,...,0,   | t1,...,t1, | ...]
+                    '''
+                    assert cfg.clean_prefix and cfg.scheduler.type == "clean_prefix_iddpm"
+                    assert actual_length is not None
+                    assert cfg.prefix_min_len < actual_length.min().item(), "mask sure use condition_th to filter data"
+                    assert cfg.img_dropout_prob == 0 or cfg.img_dropout_prob==0.0,"TODO: refer to _backup/train_backup_before_remove_reweight_loss.py"
+
+                    prefix_lens,segment_lens = [],[]
+                    for act_L in actual_length.tolist():
+                        pL = prefix_len_sampler.random_choose(act_L)
+                        prefix_lens.append(pL)
+                        segment_lens.append(pL + min(cfg.ar_size,act_L - pL))
+                    x = torch.cat([x[b,:,:L] for b,L in enumerate(segment_lens)],dim=1)[None] # (1,C,sum(segment_lens),H,W)
+                    mask_channel = torch.zeros_like(x[:,0:1,:,:1,:1]) # (1,1,T,1,1)
+                    start = 0
+                    for pL,L in zip(prefix_lens,segment_lens):
+                        mask_channel[:,:,start:start+pL,:,:] = 1 # set 1 for cond, 0 for denoise chunk
+                        start += L
+                    loss_mask = (1 - mask_channel).expand_as(x).contiguous() # only calculate loss for the denoise part
+
+                    model_kwargs.update(dict(
+                        mask_channel = mask_channel, # (1,1,T,1,1)
+                        loss_mask = loss_mask, # (1,c,T,h,w)
+                        prefix_perturb_t = cfg.prefix_perturb_t,
+                        segment_lens = segment_lens,
+                    ))
+                elif cfg.clean_prefix:
                     '''e.g.,
                                 [frame prompt    | frame to denoise| padding    ]
                                 [clean_prefix    | noisy latents   | padding    ]
@@ -324,16 +380,26 @@ def main(cfg):
                     loss_mask = None
 
                 # Diffusion
-                t = torch.randint(0, scheduler.num_timesteps, (x.shape[0],), device=device)
-                if cfg.clean_prefix and cfg.clean_prefix_set_t0:
-                    # mask_channel: (bsz,1,f,1,1)
-                    num_frames = x.shape[2]
-                    t_input = t[:,None].repeat(1,num_frames) # (bsz,f)
-                    # NOTE we do not modift `t` inplace, because `p_sample_loop` only accepts `t` with shape (bsz,)
-                    t_input[:,:pL] = 0
+                if segment_lens is not None:
+                    t = torch.randint(0, scheduler.num_timesteps, (bsz,), device=device)
+                    t = torch.repeat_interleave(t,torch.as_tensor(segment_lens,device=device)) # (T,), one timestep per segment
+                    t_input = t[None].clone() # (1,T)
+                    if cfg.clean_prefix_set_t0:
+                        t_input[mask_channel[:,0,:,0,0].bool()] = 0
                     model_kwargs.update(dict(t_input=t_input))
-
-                if loss_mask is not None:
+                else:
+                    t = torch.randint(0, scheduler.num_timesteps, (x.shape[0],), device=device)
+                    if cfg.clean_prefix and cfg.clean_prefix_set_t0:
+                        # mask_channel: (bsz,1,f,1,1)
+                        num_frames = x.shape[2]
+                        t_input = t[:,None].repeat(1,num_frames) # (bsz,f)
+                        # NOTE we do not modift `t` inplace, because `p_sample_loop` only accepts `t` with shape (bsz,)
+                        t_input[:,:pL] = 0
+                        model_kwargs.update(dict(t_input=t_input))
+
+                if segment_lens is not None:
+                    loss_func = scheduler.training_losses_clean_prefix_packed
+                elif loss_mask is not None:
                     if cfg.scheduler.type == "clean_prefix_iddpm":
                         loss_func = scheduler.training_losses_clean_prefix
                     else:
@@ -342,7 +408,12 @@ def main(cfg):
                     loss_func = scheduler.training_losses
                     model_kwargs.pop("loss_mask",None)
                 
-                if (alpha:=cfg.scheduler.progressive_alpha) > 0:
+                if (alpha:=cfg.scheduler.progressive_alpha) > 0 and segment_lens is not None:
+                    # progressive noise restarts at each segment
+                    custom_noise = torch.cat([
+                        build_progressive_noise(alpha,_noise) for _noise in torch.randn_like(x).split(segment_lens,dim=2)
+                    ],dim=2)
+                elif alpha > 0:
                     _noise = torch.randn_like(x) # (bsz,c,f,h,w)
                     prev_noise = _noise[:,:,0:1,:,:] # (bsz,c,1,h,w)
                     progressive_noises = [prev_noise]
@@ -371,7 +442,7 @@ def main(cfg):
                     optimizer.zero_grad()
 
                     # Update EMA
-                    update_ema(ema, model.module, optimizer=optimizer)
+                    ema_updater.step()
 
                     global_step += 1
                     pbar.update(1)
@@ -406,6 +477,7 @@ def main(cfg):
                         coordinator,
                         exp_dir,
                         ema_shape_dict,
+                        async_checkpointer=async_checkpointer,
                     )
                     logger.info(
                         f"Saved checkpoint at epoch {epoch} step {step + 1} global_step {global_step + 1} to {exp_dir}"
@@ -413,9 +485,7 @@ def main(cfg):
                 
                 if (cfg.validation_every_step > 0) and (global_step % cfg.validation_every_step==0) and is_update:
                     if coordinator.is_master():
-                        model.eval()
-                        validation_visualize(model.module,vae,text_encoder,val_examples,val_cfgs,exp_dir,writer,global_step)
-                        model.train()
+                        validate()
                         assert not envs.DEBUG_WITHOUT_LOAD_PRETRAINED # incase we forgot to turn this off
 
                     dist.barrier()
@@ -424,6 +494,9 @@ def main(cfg):
         dataloader.sampler.set_start_index(0)
         start_step = 0
 
+    if async_checkpointer is not None:
+        async_checkpointer.close() # wait for the last checkpoint
+
 def build_validate_examples(examples_or_path,sample_cfgs,print_fn):
     if isinstance(examples_or_path,str):
         examples = load_jsonl(examples_or_path)
@@ -517,6 +590,16 @@ def merge_args(cfg,args):
         prefix_min_len = 1,
         ar_size = 4,
         prefix_sampling_strategy = None, # TODO: e.g., sample short prefix at early training epochs and longer prefix later
+        packed_training = False, # pack clips of different lengths along the temporal axis, instead of truncating the batch to the shortest clip
+
+        ### ema cfgs:
+        ema_decay = 0.9999,
+        ema_update_every = 1, # update EMA every N optimizer steps, with decay**N
+        ema_on_cpu = False, # keep the EMA model in CPU memory to save GPU memory
+
+        ### checkpoint cfgs:
+        async_ckpt = True, # write the checkpoint files in a background thread (model & optimizer w/ zero plugins only)
+        async_ckpt_max_pending = 1, # max number of checkpoints being written at the same time
 
         ### dataloader cfgs:
         sampler_seed = None,
@@ -0,0 +1,92 @@
+import argparse
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from opensora.acceleration.communications import _all_to_all
+from opensora.acceleration.parallel_states import set_sequence_parallel_group
+from opensora.models.causal_stdit2.attention import AttentionWithContext, SeqParallelAttentionWithContext
+
+'''
+micro-benchmark of the all_to_all in seq parallel attention on CPU (gloo):
+    legacy: tensor_split + per-chunk .contiguous() + dist.all_to_all + torch.cat (the previous `_all_to_all`)
+    single: one all_to_all_single into a contiguous buffer (`_all_to_all`)
+    attn:   SeqParallelAttentionWithContext forward w/ comm_overlap_chunks=1,2,... (qkv projection of head groups overlapped with all_to_all)
+python tests/benchmark_all_to_all.py
+python tests/benchmark_all_to_all.py --world_size 4 --batch_size 16 --seq_len 1024 --hidden_size 1152 --num_heads 16
+'''
+
+def legacy_all_to_all(input_, world_size, group, scatter_dim, gather_dim):
+    input_list = [t.contiguous() for t in torch.tensor_split(input_, world_size, scatter_dim)]
+    output_list = [torch.empty_like(input_list[0]) for _ in range(world_size)]
+    dist.all_to_all(output_list, input_list, group=group)
+    return torch.cat(output_list, dim=gather_dim).contiguous()
+
+
+def timeit(fn, iters, warmup=2):
+    for _ in range(warmup):
+        fn()
+    dist.barrier()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    dist.barrier()
+    return (time.perf_counter() - t0) / iters * 1e3  # ms
+
+
+@torch.no_grad()
+def run(rank, world_size, init_file, args):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    set_sequence_parallel_group(dist.group.WORLD)
+    torch.set_num_threads(args.num_threads)
+    group = dist.group.WORLD
+    head_dim = args.hidden_size // args.num_heads
+    sub_n = args.seq_len // world_size
+
+    results = dict()
+    # qkv: [B, SUB_N, 3, NUM_HEAD, HEAD_DIM] -> [B, N, 3, NUM_HEAD_PER_DEVICE, HEAD_DIM]
+    # out: [B, N, NUM_HEAD_PER_DEVICE, HEAD_DIM] -> [B, SUB_N, NUM_HEAD, HEAD_DIM]
+    torch.manual_seed(rank)
+    qkv = torch.randn(args.batch_size, sub_n, 3, args.num_heads, head_dim)
+    out = torch.randn(args.batch_size, args.seq_len, args.num_heads // world_size, head_dim)
+    for name, x, scatter_dim, gather_dim in [("qkv", qkv, 3, 1), ("out", out, 1, 2)]:
+        ref = legacy_all_to_all(x, world_size, group, scatter_dim, gather_dim)
+        assert torch.equal(ref, _all_to_all(x, world_size, group, scatter_dim, gather_dim))
+        results[f"{name}/legacy"] = timeit(lambda: legacy_all_to_all(x, world_size, group, scatter_dim, gather_dim), args.iters)
+        results[f"{name}/single"] = timeit(lambda: _all_to_all(x, world_size, group, scatter_dim, gather_dim), args.iters)
+
+    torch.manual_seed(0)
+    attn = AttentionWithContext(args.hidden_size, num_heads=args.num_heads, qkv_bias=True)
+    x = torch.randn(args.batch_size, sub_n, args.hidden_size, generator=torch.Generator().manual_seed(rank))
+    ref = SeqParallelAttentionWithContext.forward(attn, x)
+    num_heads_local = args.num_heads // world_size
+    for chunks in [c for c in [1, 2, 4, 8] if num_heads_local % c == 0]:
+        y = SeqParallelAttentionWithContext.forward(attn, x, comm_overlap_chunks=chunks)
+        assert torch.allclose(ref, y, atol=1e-5), (chunks, (ref - y).abs().max())
+        results[f"attn/comm_overlap_chunks={chunks}"] = timeit(
+            lambda: SeqParallelAttentionWithContext.forward(attn, x, comm_overlap_chunks=chunks), args.iters
+        )
+
+    if rank == 0:
+        print(f"world_size={world_size}, batch_size={args.batch_size}, seq_len={args.seq_len}, hidden_size={args.hidden_size}, num_heads={args.num_heads}")
+        for k, v in results.items():
+            print(f"{k:32s}: {v:8.3f} ms")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=256)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_heads", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--num_threads", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(run, args=(args.world_size, f"{tmp_dir}/dist_init", args), nprocs=args.world_size)
@@ -0,0 +1,112 @@
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+from tools.scoring.optical_flow.engine import UNIMATCH_KWARGS, FlowScoringEngine, build_unimatch, get_bucket, resize_to_bucket
+from tools.scoring.optical_flow.unimatch import UniMatch
+
+'''
+throughput (clips/sec) of the optical-flow scoring on synthetic clips of mixed resolutions:
+    legacy:   each clip stretched to 320x576, `--legacy_bs` clips (3 pairs each) per forward (the previous `optical_flow/inference.py`)
+    bucketed: `FlowScoringEngine`, resolution buckets, `--max_pairs` pairs per forward
+    fast:     `FlowScoringEngine(fast=True)`, half resolution & one refinement step
+the ckpt is not needed (random init), the scores of legacy & bucketed are the same for the 16:9 clips
+python tests/benchmark_flow_scoring.py --num_clips 64
+python tests/benchmark_flow_scoring.py --num_clips 6 --tiny --downscale 4 --legacy_bs 1 --max_pairs 2  # smoke test on CPU
+'''
+
+RESOLUTIONS = [(720, 1280), (1080, 1920), (480, 640), (1280, 720), (512, 512), (1080, 2560)]  # (H, W)
+
+
+def legacy_score(model, clips, device, bs):
+    scores = []
+    for i in range(0, len(clips), bs):
+        images = torch.stack([
+            F.interpolate(
+                rearrange(x.float(), "N C H W -> N C W H") if x.shape[-2] > x.shape[-1] else x.float(),
+                size=(320, 576), mode="bilinear", align_corners=True,
+            )
+            for x in clips[i : i + bs]
+        ]).to(device)
+        B = images.shape[0]
+        batch_0 = rearrange(images[:, :-1], "B N C H W -> (B N) C H W").contiguous()
+        batch_1 = rearrange(images[:, 1:], "B N C H W -> (B N) C H W").contiguous()
+        flow_maps = model(batch_0, batch_1, **UNIMATCH_KWARGS)["flow_preds"][-1].cpu()
+        flow_maps = rearrange(flow_maps, "(B N) C H W -> B N H W C", B=B)
+        scores.extend(flow_maps.abs().mean(dim=[1, 2, 3, 4]).tolist())
+    return scores
+
+
+def timeit(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    out = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - t0
+
+
+@torch.inference_mode()
+def main(args):
+    device = torch.device(args.device)
+    if args.tiny:
+        model = UniMatch(feature_channels=128, num_scales=2, upsample_factor=4, num_transformer_layers=1, reg_refine=True, task="flow")
+        model = model.eval().to(device)
+    else:
+        model = build_unimatch(ckpt_path=args.ckpt, device=device)
+
+    g = torch.Generator().manual_seed(0)
+    raw_clips = []
+    for i in range(args.num_clips):
+        H, W = RESOLUTIONS[i % len(RESOLUTIONS)]
+        H, W = H // args.downscale, W // args.downscale
+        x = torch.randint(0, 256, (1, 3, H // 8, W // 8), generator=g, dtype=torch.uint8).float()
+        # 4 frames of a translating pattern
+        frames = torch.cat([torch.roll(F.interpolate(x, size=(H, W)), shifts=4 * t, dims=-1) for t in range(4)])
+        raw_clips.append(frames.to(torch.uint8))
+    print(f"buckets: { {r: get_bucket(r[0] // args.downscale, r[1] // args.downscale) for r in RESOLUTIONS} }")
+
+    results = dict()
+    legacy_clips = raw_clips
+    bucketed_clips = [resize_to_bucket(x) for x in raw_clips]  # done by the dataloader workers in practice
+    fast_clips = [resize_to_bucket(x, fast=True) for x in raw_clips]
+
+    legacy_score(model, legacy_clips[: args.legacy_bs], device, args.legacy_bs)  # warmup
+    legacy, t = timeit(lambda: legacy_score(model, legacy_clips, device, args.legacy_bs), device)
+    results["legacy"] = t
+
+    engine = FlowScoringEngine(model, device, max_pairs=args.max_pairs)
+    engine.score(bucketed_clips[:1])
+    bucketed, t = timeit(lambda: engine.score(bucketed_clips), device)
+    results["bucketed"] = t
+
+    fast_engine = FlowScoringEngine(model, device, max_pairs=args.max_pairs * 4, fast=True)
+    fast_engine.score(fast_clips[:1])
+    fast, t = timeit(lambda: fast_engine.score(fast_clips), device)
+    results["fast"] = t
+
+    for i, (H, W) in enumerate(RESOLUTIONS[: args.num_clips]):
+        if get_bucket(H // args.downscale, W // args.downscale) == (320, 576):
+            assert abs(legacy[i] - bucketed[i]) < 1e-3 * max(1.0, abs(legacy[i])), (legacy[i], bucketed[i])
+    print("scores (legacy / bucketed / fast):")
+    for i, (H, W) in enumerate(RESOLUTIONS[: args.num_clips]):
+        print(f"    {H}x{W}: {legacy[i]:.3f} / {bucketed[i]:.3f} / {fast[i]:.3f}")
+    for k, t in results.items():
+        print(f"{k:10s}: {args.num_clips / t:8.2f} clips/sec ({t:.2f} s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_clips", type=int, default=64)
+    parser.add_argument("--legacy_bs", type=int, default=4)
+    parser.add_argument("--max_pairs", type=int, default=24)
+    parser.add_argument("--ckpt", type=str, default=None, help="default: random init")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--downscale", type=int, default=1, help="downscale the synthetic clips, for a quick run")
+    parser.add_argument("--tiny", action="store_true", help="a tiny UniMatch, for a smoke test on CPU")
+    args = parser.parse_args()
+    main(args)
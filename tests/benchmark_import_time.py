@@ -0,0 +1,65 @@
+import argparse
+import os
+import subprocess
+import sys
+
+'''
+measure the import time of the light entry modules with `python -X importtime`, and check that they do not import
+the heavy (optional) dependencies, which should only be imported when a model/dataset is built, refer to `opensora.registry`
+python tests/benchmark_import_time.py
+python tests/benchmark_import_time.py --modules opensora.registry scripts.eval_fvd --max_ms 3000
+'''
+
+# entry module: heavy packages that must not be imported by it
+ENTRY_MODULES = {
+    "opensora.registry": ["opensora.models", "opensora.datasets.datasets", "diffusers", "transformers", "colossalai", "decord"],
+    "opensora.utils.ckpt_utils": ["opensora.models", "diffusers", "transformers", "colossalai", "decord"],
+    "opensora.utils.train_utils": ["colossalai", "diffusers"],
+    "opensora.datasets.video_transforms": ["opensora.models", "diffusers", "transformers", "colossalai", "decord"],
+}
+
+
+def import_time(module, cwd):
+    '''
+    Returns:
+        cumulative import time of `module` (ms), and {imported module name: cumulative time (ms)}
+    '''
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, capture_output=True, text=True,
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    imported = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imported[name.strip()] = int(cumulative) / 1000
+    return imported[module], imported
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", nargs="+", default=list(ENTRY_MODULES.keys()))
+    parser.add_argument("--max_ms", type=float, default=None, help="fail if any entry module takes longer than this")
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    failures = []
+    for module in args.modules:
+        total_ms, imported = import_time(module, repo_root)
+        top = sorted(((t, name) for name, t in imported.items() if "." not in name and name not in (module, "site", "sitecustomize")), reverse=True)[:5]
+        print(f"{module:40s} {total_ms:9.1f} ms, top-level: " + ", ".join(f"{name}={t:.0f}ms" for t, name in top))
+
+        heavy = [name for name in ENTRY_MODULES.get(module, []) if name in imported]
+        if heavy:
+            failures.append(f"{module} imports {heavy}")
+        if args.max_ms is not None and total_ms > args.max_ms:
+            failures.append(f"{module} takes {total_ms:.1f} ms > {args.max_ms} ms")
+
+    assert not failures, "\n".join(failures)
+    print("import time OK")
+
+
+if __name__ == "__main__":
+    main()
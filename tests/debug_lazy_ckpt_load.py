@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+import torch
+
+from opensora.models.causal_stdit2.causal_stdit2 import CausalSTDiT2_Tiny
+from opensora.utils.ckpt_utils import convert_to_safetensors
+
+'''
+check that `load_checkpoint_lazy` (meta-device init + memory-mapped .pt/.safetensors) gives the same model as `load_checkpoint`
+python tests/debug_lazy_ckpt_load.py
+'''
+
+@torch.no_grad()
+def demo():
+    model_kwargs = dict(input_size=(16,8,8),caption_channels=0,temp_extra_in_channels=1)
+    torch.manual_seed(0)
+    model = CausalSTDiT2_Tiny(**model_kwargs)
+    for p in model.parameters():
+        torch.nn.init.normal_(p,std=0.05)
+
+    with tempfile.TemporaryDirectory() as ckpt_dir:
+        torch.save(model.state_dict(),os.path.join(ckpt_dir,"model_ckpt.pt"))
+        ref = CausalSTDiT2_Tiny(from_pretrained=ckpt_dir,**model_kwargs)
+        lazy_pt = CausalSTDiT2_Tiny(from_pretrained=ckpt_dir,load_device="cpu",**model_kwargs)
+        convert_to_safetensors(ckpt_dir)
+        lazy_st = CausalSTDiT2_Tiny(from_pretrained=ckpt_dir,load_device="cpu",load_dtype=torch.bfloat16,**model_kwargs)
+
+        ref_sd = ref.state_dict()
+        for name, lazy in [("pt",lazy_pt),("safetensors",lazy_st)]:
+            lazy_sd = lazy.state_dict()
+            assert ref_sd.keys() == lazy_sd.keys()
+            assert not any(v.is_meta for v in lazy_sd.values())
+            max_diff = max((ref_sd[k].float() - lazy_sd[k].float()).abs().max().item() for k in ref_sd.keys())
+            print(f"{name}: max_diff={max_diff}")
+        assert all(torch.equal(ref_sd[k],v) for k,v in lazy_pt.state_dict().items())
+        assert all(v.dtype == torch.bfloat16 for v in lazy_st.parameters())
+
+
+if __name__ == "__main__":
+    demo()
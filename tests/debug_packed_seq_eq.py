@@ -0,0 +1,59 @@
+import torch
+
+from opensora.models.causal_stdit2.causal_stdit2 import CausalSTDiT2
+
+'''
+check that packed training (`segment_lens`) gives the same output as forwarding each clip separately
+python tests/debug_packed_seq_eq.py
+'''
+
+def build_inputs(segment_lens,prefix_lens):
+    xs = [torch.randn(1,4,L,8,8) for L in segment_lens]
+    ts = [torch.randint(0,1000,(1,)) for _ in segment_lens]
+    mask_channels,t_inputs = [],[]
+    for t,pL,L in zip(ts,prefix_lens,segment_lens):
+        mask_channel = torch.zeros(1,1,L,1,1)
+        mask_channel[:,:,:pL] = 1
+        t_input = t[:,None].repeat(1,L)
+        t_input[:,:pL] = 0
+        mask_channels.append(mask_channel)
+        t_inputs.append(t_input)
+    return xs,t_inputs,mask_channels
+
+
+@torch.no_grad()
+def demo():
+    segment_lens = [5,7,3]
+    prefix_lens = [2,3,1]
+    for relative_tpe_mode, spatial_attn_enhance in [(None,None),("cyclic","prev_frames_2"),(None,"first_frame")]:
+        model = CausalSTDiT2(
+            input_size=(16,8,8),
+            hidden_size=64,
+            depth=2,
+            num_heads=4,
+            caption_channels=0,
+            temp_extra_in_channels=1,
+            relative_tpe_mode=relative_tpe_mode,
+            spatial_attn_enhance=spatial_attn_enhance,
+        ).train()
+        for p in model.parameters():
+            torch.nn.init.normal_(p,std=0.05)
+
+        xs,t_inputs,mask_channels = build_inputs(segment_lens,prefix_lens)
+        out = torch.cat([
+            model(x,t_input,None,mask_channel=mask_channel) for x,t_input,mask_channel in zip(xs,t_inputs,mask_channels)
+        ],dim=2)
+        out_packed = model(
+            torch.cat(xs,dim=2),
+            torch.cat(t_inputs,dim=1),
+            None,
+            mask_channel=torch.cat(mask_channels,dim=2),
+            segment_lens=segment_lens
+        )
+        max_diff = (out - out_packed).abs().max().item()
+        print(f"relative_tpe_mode={relative_tpe_mode}, spatial_attn_enhance={spatial_attn_enhance}, max_diff={max_diff}")
+        assert torch.allclose(out,out_packed,atol=1e-5)
+
+
+if __name__ == "__main__":
+    demo()
@@ -0,0 +1,203 @@
+import copy
+import json
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from opensora.utils.ckpt_utils import (
+    AsyncCheckpointer,
+    load,
+    model_sharding,
+    record_model_param_shape,
+    save,
+    shard_state_dict,
+)
+
+'''
+save a checkpoint with `AsyncCheckpointer` on CPU (gloo), the booster is replaced by local filesystem stand-ins:
+    `LocalBooster` saves the model & optimizer by itself (synchronously)
+    `LocalZeroBooster` has a (stand-in) LowLevelZeroPlugin, so the model & optimizer shards are written by the checkpointer,
+        and they are loaded back from colossalai's sharded layout
+python tests/test_async_ckpt.py
+'''
+
+class LocalBooster:
+    plugin = None  # not a LowLevelZeroPlugin, the model & optimizer are saved by the booster
+
+    def save_model(self, model, path, shard=True):
+        torch.save(model.state_dict(), os.path.join(path, f"rank{dist.get_rank()}.pt"))
+
+    def save_optimizer(self, optimizer, path, shard=True, size_per_shard=1024):
+        os.makedirs(path, exist_ok=True)
+        torch.save(optimizer.state_dict(), os.path.join(path, f"rank{dist.get_rank()}.pt"))
+
+    def load_model(self, model, path):
+        model.load_state_dict(torch.load(os.path.join(path, f"rank{dist.get_rank()}.pt")))
+
+    def load_optimizer(self, optimizer, path):
+        optimizer.load_state_dict(torch.load(os.path.join(path, f"rank{dist.get_rank()}.pt")))
+
+
+class LowLevelZeroPlugin:
+    '''stand-in w/ the class name of colossalai's plugin'''
+
+
+class LocalModelWrapper(torch.nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def unwrap(self):
+        return self.module
+
+
+class LocalZeroOptimizer:
+    '''the states are replicated here, `state_dict_shard` runs a collective like the all-gather of the zero optimizer'''
+    def __init__(self, optim):
+        self.optim = optim
+
+    def state_dict_shard(self, max_shard_size=1024):
+        states = copy.deepcopy(self.optim.state_dict()["state"])
+        for state in states.values():
+            for k, v in state.items():
+                if k != "step":
+                    gathered = [torch.empty_like(v) for _ in range(dist.get_world_size())]
+                    dist.all_gather(gathered, v)
+                    state[k] = gathered[0]
+        yield from shard_state_dict(states.items(), max_shard_size)
+
+
+def load_sharded(path, index_name):
+    with open(os.path.join(path, index_name)) as f:
+        index = json.load(f)
+    state_dict = dict()
+    for shard_file in sorted(set(index["weight_map"].values())):
+        state_dict.update(torch.load(os.path.join(path, shard_file)))
+    assert set(map(str, state_dict.keys())) == set(index["weight_map"].keys())
+    return index, state_dict
+
+
+class LocalZeroBooster:
+    '''reads colossalai's sharded layout, like `booster.load_model/load_optimizer` of the LowLevelZeroPlugin'''
+    plugin = LowLevelZeroPlugin()
+
+    def load_model(self, model, path):
+        _, state_dict = load_sharded(path, "pytorch_model.bin.index.json")
+        model.unwrap().load_state_dict(state_dict)
+
+    def load_optimizer(self, optimizer, path):
+        index, states = load_sharded(path, "pytorch_optim.bin.index.json")
+        param_groups = torch.load(os.path.join(path, index["metadata"]["param_groups"]))
+        optimizer.optim.load_state_dict(dict(state=states, param_groups=param_groups))
+
+    def load_lr_scheduler(self, lr_scheduler, path):
+        lr_scheduler.load_state_dict(torch.load(path))
+
+
+class LocalCoordinator:
+    def is_master(self):
+        return dist.get_rank() == 0
+
+
+def build_model():
+    return torch.nn.Sequential(torch.nn.Linear(7, 5), torch.nn.Linear(5, 3))
+
+
+def save_twice(save_dir, booster, model, optimizer, lr_scheduler=None):
+    torch.manual_seed(0)
+    ema = build_model()
+    ema_full = {k: v.clone() for k, v in ema.state_dict().items()}
+    shape_dict = record_model_param_shape(ema)
+    model_sharding(ema)
+    ema_shard = {k: v.clone() for k, v in ema.state_dict().items()}
+
+    async_checkpointer = AsyncCheckpointer(max_pending=1)
+    for global_step in [1, 2]:
+        save(
+            booster, model, ema, optimizer, lr_scheduler, 0, global_step, global_step, 4,
+            LocalCoordinator(), save_dir, shape_dict, async_checkpointer=async_checkpointer,
+        )
+        # the EMA is re-sharded right after the snapshot, the training can go on
+        for k, v in ema.state_dict().items():
+            assert torch.equal(v, ema_shard[k])
+            v.add_(1.0)  # modify the EMA in-place, this should not affect the checkpoint being written
+        for k, v in ema.state_dict().items():
+            v.copy_(ema_shard[k])
+    return async_checkpointer, ema_full
+
+
+def run_booster(rank, save_dir):
+    model = build_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+    async_checkpointer, ema_full = save_twice(save_dir, LocalBooster(), model, optimizer)
+    async_checkpointer.close()
+    dist.barrier()
+
+    ckpt_dir = os.path.join(save_dir, "epoch0-global_step2")
+    if rank == 0:
+        saved = torch.load(os.path.join(ckpt_dir, "ema.pt"))
+        for k, v in ema_full.items():
+            assert torch.equal(saved[k], v), k
+        assert not any(".tmp." in fn for fn in os.listdir(ckpt_dir))
+
+    epoch, step, sample_start_index = load(LocalBooster(), model, build_model(), optimizer, None, ckpt_dir)
+    assert (epoch, step, sample_start_index) == (0, 2, 8)
+
+
+def run_zero(rank, save_dir):
+    torch.manual_seed(1)
+    module = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Linear(64, 64), torch.nn.Linear(64, 3))
+    model = LocalModelWrapper(module)
+    optimizer = LocalZeroOptimizer(torch.optim.AdamW(module.parameters(), lr=0.1))
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer.optim, step_size=1, gamma=0.5)
+    module(torch.randn(2, 64)).sum().backward()
+    optimizer.optim.step()
+    lr_scheduler.step()
+
+    model_ref = {k: v.clone() for k, v in module.state_dict().items()}
+    optim_ref = copy.deepcopy(optimizer.optim.state_dict())
+    async_checkpointer, _ = save_twice(save_dir, LocalZeroBooster(), model, optimizer, lr_scheduler)
+    with torch.no_grad():
+        for p in module.parameters():
+            p.add_(1.0)  # after `save` returns, the training can modify the model & optimizer
+    optimizer.optim.step()
+    async_checkpointer.close()
+    dist.barrier()
+
+    ckpt_dir = os.path.join(save_dir, "epoch0-global_step2")
+    if rank == 0:
+        assert sorted(os.listdir(os.path.join(ckpt_dir, "model"))) == ["pytorch_model-00001.bin", "pytorch_model.bin.index.json"]
+        assert [len(shard) for shard, _ in shard_state_dict(model_ref.items(), 0.01)] == [1, 1, 1, 3]  # 0.016 MB per 64x64 weight
+    new_module = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Linear(64, 64), torch.nn.Linear(64, 3))
+    new_optimizer = LocalZeroOptimizer(torch.optim.AdamW(new_module.parameters()))
+    new_lr_scheduler = torch.optim.lr_scheduler.StepLR(new_optimizer.optim, step_size=1, gamma=0.5)
+    epoch, step, _ = load(LocalZeroBooster(), LocalModelWrapper(new_module), build_model(), new_optimizer, new_lr_scheduler, ckpt_dir)
+    assert (epoch, step) == (0, 2)
+    for k, v in new_module.state_dict().items():
+        assert torch.equal(v, model_ref[k]), k
+    loaded = new_optimizer.optim.state_dict()
+    assert loaded["param_groups"] == optim_ref["param_groups"]
+    for param_id, state in optim_ref["state"].items():
+        for k, v in state.items():
+            assert torch.equal(loaded["state"][param_id][k], v), (param_id, k)
+    assert new_lr_scheduler.state_dict() == lr_scheduler.state_dict()
+
+
+def run(rank, world_size, save_dir):
+    dist.init_process_group("gloo", init_method=f"file://{save_dir}/dist_init", rank=rank, world_size=world_size)
+    run_booster(rank, os.path.join(save_dir, "booster"))
+    if rank == 0:
+        print("async checkpoint OK (booster)")
+    run_zero(rank, os.path.join(save_dir, "zero"))
+    if rank == 0:
+        print("async checkpoint OK (sharded model & optimizer)")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    world_size = 2
+    with tempfile.TemporaryDirectory() as save_dir:
+        mp.spawn(run, args=(world_size, save_dir), nprocs=world_size)
@@ -0,0 +1,74 @@
+import random
+import time
+
+import pandas as pd
+
+import tools.datasets.datautil as datautil
+from opensora.utils.text_clean import clean_caption, text_preprocessing
+from tools.datasets.datautil import LLAVA_PREFIX, apply_unique, remove_caption_prefix
+from tools.datasets.filter_panda10m import clean_caption as clean_caption_ref
+
+'''
+check the caption cleaning of `opensora/utils/text_clean.py` & datautil:
+    `clean_caption` is the same as the original row-by-row version (the copy in `filter_panda10m.py`) on random captions
+    `remove_caption_prefix` is the same as checking the prefixes one by one
+    `apply_unique` cleans each unique caption once
+python tests/test_caption_clean.py
+'''
+
+PIECES = [
+    "The video shows", " a cat", "<b>bold</b>", "&amp;", "&quot", "&lt;", "&copy", "http://x.com/a", "www.test.org",
+    "@user1", "中文", "あ", "—", "–", "“q”", "‘s’", "192.168.0.1", "3:45  ", "\\n", "#12", "#123456", "1234567",
+    "img.png", " jc6640 ", "ab12cd", "12ab34", "free shipping", "download free", "click on here", " jpg images",
+    "page 12", "a1b2c3d", "1920x1080", " : ", "a,b", "a.b", "...", "''", '"""', "***", " . ", "a-b-c-d-e", "x_y",
+    "\r\n", "\t", "\x00", "\x1b[31m", "é", "ﬁ", "Ã©", "%20", "+", "'", "-", ":", ";", '"', ".x", "<person>", "<",
+    ">", "&", "<!--c-->", "a<b", " ",
+]
+
+
+def remove_caption_prefix_ref(caption):
+    for prefix in LLAVA_PREFIX:
+        if caption.startswith(prefix) or caption.startswith(prefix.lower()):
+            caption = caption[len(prefix) :].strip()
+            if caption[0].islower():
+                caption = caption[0].upper() + caption[1:]
+            return caption
+    return caption
+
+
+def demo(num_samples=5000):
+    rng = random.Random(0)
+    captions = ["".join(rng.choice(PIECES) for _ in range(rng.randint(1, 12))) for _ in range(num_samples)]
+    for caption in captions:
+        assert clean_caption(caption) == clean_caption_ref(caption), repr(caption)
+        try:
+            ref = remove_caption_prefix_ref(caption)
+        except IndexError:  # nothing after the prefix, the original version fails
+            continue
+        assert remove_caption_prefix(caption) == ref, repr(caption)
+
+    plain = ["The video shows a cat playing with a ball of yarn on a wooden floor, in a sunny room."] * 1000
+    t0 = time.perf_counter()
+    [clean_caption_ref(x) for x in plain]
+    t1 = time.perf_counter()
+    [clean_caption(x) for x in plain]
+    t2 = time.perf_counter()
+    print(f"clean_caption of plain captions: {(t1 - t0) * 1e3:.1f} ms (row-by-row), {(t2 - t1) * 1e3:.1f} ms (shared)")
+
+    num_calls = []
+
+    def counted_text_preprocessing(text):
+        num_calls.append(text)
+        return text_preprocessing(text)
+
+    datautil.PANDA_USE_PARALLEL = False  # to count the calls
+    ser = pd.Series(captions[:100] * 5 + [float("nan")] * 3, index=range(1000, 1503))
+    cleaned = apply_unique(ser, counted_text_preprocessing)
+    assert len(num_calls) == len(set(captions[:100])) + 1  # nan is cleaned once
+    assert cleaned.index.equals(ser.index)
+    assert cleaned.tolist() == [text_preprocessing(x) for x in ser]
+    print("caption clean OK")
+
+
+if __name__ == "__main__":
+    demo()
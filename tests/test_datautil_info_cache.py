@@ -0,0 +1,76 @@
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import tools.datasets.datautil as datautil
+from tools.datasets.datautil import get_info, get_info_cached
+
+'''
+check the info cache of datautil (`--info`):
+    the cached info is the same as `get_info`, the size of images follows the EXIF orientation
+    re-running probes nothing, and only the modified files are probed again
+python tests/test_datautil_info_cache.py
+'''
+
+
+def write_video(path, num_frames, size=(64, 48), fps=8):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+    for i in range(num_frames):
+        writer.write(np.full((size[1], size[0], 3), i * 8 % 256, dtype=np.uint8))
+    writer.release()
+
+
+def demo():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i, num_frames in enumerate([10, 20, 30]):
+            paths.append(os.path.join(tmp_dir, f"video{i}.mp4"))
+            write_video(paths[-1], num_frames)
+        paths.append(os.path.join(tmp_dir, "image.png"))
+        Image.fromarray(np.zeros((32, 40, 3), dtype=np.uint8)).save(paths[-1])
+        paths.append(os.path.join(tmp_dir, "image_rotated.jpg"))
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotated by 90 degrees, shown as 40x32 (h x w)
+        Image.fromarray(np.zeros((32, 40, 3), dtype=np.uint8)).save(paths[-1], exif=exif)
+        paths.append(os.path.join(tmp_dir, "missing.mp4"))
+        paths = pd.Series(paths)
+        cache_path = os.path.join(tmp_dir, "cache", "info.parquet")
+
+        probed = []
+
+        def counted_get_info(path):
+            probed.append(path)
+            return get_info(path)
+
+        counted_get_info.__name__ = "get_info"
+
+        datautil.PANDA_USE_PARALLEL = False  # to count the calls
+        info = get_info_cached(paths, counted_get_info, cache_path)
+        pd.testing.assert_frame_equal(pd.DataFrame(info), pd.DataFrame([get_info(x) for x in paths]), check_dtype=False)
+        assert info[0][:3] == (10, 48, 64) and info[3][:3] == (1, 32, 40) and info[4][:3] == (1, 40, 32), info
+        assert len(probed) == len(paths)
+
+        # re-run, the missing file (not cached) is probed again
+        probed.clear()
+        pd.testing.assert_frame_equal(pd.DataFrame(get_info_cached(paths, counted_get_info, cache_path)), pd.DataFrame(info))
+        assert probed == [paths.iloc[-1]], probed
+
+        # modify a video
+        time.sleep(0.01)
+        write_video(paths[1], 5)
+        probed.clear()
+        info_new = get_info_cached(paths, counted_get_info, cache_path)
+        assert probed == [paths.iloc[1], paths.iloc[-1]], probed
+        assert info_new[1][0] == 5 and info_new[0] == info[0]
+        for path, x in zip(paths, info_new):
+            print(os.path.basename(path), x)
+    print("info cache OK")
+
+
+if __name__ == "__main__":
+    demo()
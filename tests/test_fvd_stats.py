@@ -0,0 +1,162 @@
+import os
+import sys
+import tempfile
+from argparse import Namespace
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from eval_fvd import compute_fvd_stats
+from evaluation.fvd.feature_cache import I3DFeatureCache
+from evaluation.fvd.stats import FrechetStats, frechet_distance_from_stats
+from evaluation.fvd.styleganv.fvd import frechet_distance
+
+'''
+check the streaming FrechetStats against `frechet_distance` on all feats, the I3D feature cache,
+the data-parallel (gloo) evaluation (w/ a fake I3D), and the decoded video store
+python tests/test_fvd_stats.py
+'''
+
+class FakeVideoDataset:
+    def __init__(self, num_videos, num_frames=16):
+        self.videos = torch.rand(num_videos, 3, num_frames, 8, 8) * 2 - 1
+        self.transforms = "fake"
+
+    def __len__(self):
+        return len(self.videos)
+
+    def clip_key(self, idx):
+        return [f"video_{idx}"]
+
+    def __getitem__(self, idx):
+        return {"video_name": f"video_{idx}", "video": self.videos[idx]}
+
+
+def fake_i3d(videos):
+    # (B,C,T,H,W) --> (B,d), the feat of each clip does not depend on the batch
+    proj = torch.from_numpy(np.random.RandomState(0).randn(videos[0].numel(), 12))
+    return (videos.flatten(1).double() @ proj).numpy()
+
+
+def fake_window_feats(videos, windows):
+    return {name: fake_i3d(videos if fids is None else videos[:, :, fids]) for name, fids in windows.items()}
+
+
+class FakeI3D(torch.nn.Module):
+    def forward(self, x, **kwargs):
+        # (B,C,T,224,224) --> (B,d), depends on the frame order
+        return x.mean(dim=(-1, -2)).flatten(1)[:, :8] * torch.arange(1, 9)
+
+
+def demo_batched_windows():
+    # all windows of a batch in one (chunked) I3D forward == each window separately
+    import eval_fvd
+    import evaluation.fvd.styleganv.fvd as styleganv_fvd
+    styleganv_fvd.load_i3d_pretrained = lambda weights_path, device: FakeI3D()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.makedirs(os.path.join(tmp_dir, "styleganv"))
+        open(os.path.join(tmp_dir, "styleganv", "i3d_torchscript.pt"), "w").close()
+        eval_fvd.I3D_WEIGHTS_DIR = tmp_dir
+        get_window_feats, _ = eval_fvd.build_i3d_feat_fn(Namespace(method="styleganv", i3d_batch_size=3), "cpu")
+
+    videos = torch.rand(2, 3, 25, 32, 40)
+    windows = eval_fvd.get_ar_step_windows(8, num_frames=25)
+    windows.update({"all": None, "first_16": torch.arange(16)})
+    assert len(windows) == 5 and windows[3][-1] == 24
+    batched = get_window_feats(videos, windows)
+    for name, fids in windows.items():
+        ref = get_window_feats(videos if fids is None else videos[:, :, fids], {name: None})[name]
+        assert np.allclose(batched[name], ref, atol=1e-6), name
+    print("batched windows OK")
+
+
+def demo():
+    feats1 = np.random.randn(1000, 32) * 3 + 1
+    feats2 = np.random.randn(700, 32) @ np.random.randn(32, 32) * 0.1
+    stats1, stats2 = FrechetStats(), FrechetStats()
+    for chunk in np.array_split(feats1, 7):
+        stats1.update(chunk)
+    stats2.update(feats2[:1]).merge(FrechetStats().update(feats2[1:]))
+    assert np.allclose(stats1.mean, feats1.mean(0)) and np.allclose(stats1.cov, np.cov(feats1, rowvar=False))
+    fvd_ref = frechet_distance(feats2, feats1)
+    fvd = frechet_distance_from_stats(stats2, stats1)
+    print(f"fvd_ref={fvd_ref}, fvd={fvd}")
+    assert abs(fvd - fvd_ref) < 1e-6 * max(1, fvd_ref)
+
+    args = Namespace(batch_size=3, num_workers=0)
+    dataset = FakeVideoDataset(10)
+    windows = {"all": None, "1": torch.as_tensor(range(0, 8)).repeat_interleave(2)}
+    calls = []
+    def get_window_feats(videos, windows):
+        calls.append(len(videos))
+        return fake_window_feats(videos, windows)
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = I3DFeatureCache(cache_dir, preprocess_tag="fake", i3d_tag="fake")
+        stats_no_cache = compute_fvd_stats(dataset, windows, get_window_feats, None, args, "no cache")
+        stats_first = compute_fvd_stats(dataset, windows, get_window_feats, cache, args, "first")
+        num_calls = len(calls)
+        stats_cached = compute_fvd_stats(dataset, windows, get_window_feats, cache, args, "cached")
+        assert len(calls) == num_calls, "all feats should be read from the cache"
+        for name in windows:
+            for stats in [stats_first[name], stats_cached[name]]:
+                assert stats.n == len(dataset)
+                assert np.allclose(stats.mean, stats_no_cache[name].mean) and np.allclose(stats.cov, stats_no_cache[name].cov)
+    print("fvd stats & feat cache OK")
+
+
+def run_distributed(rank, world_size, init_file, ref_stats):
+    # each rank extracts the feats of its shard, the merged stats should be the same as a single process
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    stats = compute_fvd_stats(FakeVideoDataset(11), {"all": None}, fake_window_feats, None, Namespace(batch_size=2, num_workers=0), "dist")["all"]
+    assert stats.n == ref_stats.n
+    assert np.allclose(stats.mean, ref_stats.mean) and np.allclose(stats.cov, ref_stats.cov)
+    dist.destroy_process_group()
+
+
+def demo_distributed(world_size=3):
+    torch.manual_seed(0)
+    ref_stats = compute_fvd_stats(FakeVideoDataset(11), {"all": None}, fake_window_feats, None, Namespace(batch_size=2, num_workers=0), "ref")["all"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(run_distributed, args=(world_size, os.path.join(tmp_dir, "dist_init"), ref_stats), nprocs=world_size)
+    print("distributed fvd stats OK")
+
+
+def demo_decoded_store():
+    # the "videos" are .npy files here, decoded by a patched reader
+    import evaluation.fvd.decoded_store as decoded_store
+    from evaluation.fvd.decoded_store import DecodedVideoStore
+    from eval_fvd import GenVideoDataset
+    decoded_store.read_video_uint8 = lambda path: torch.from_numpy(np.load(path))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_dir = os.path.join(tmp_dir, "videos")
+        os.makedirs(video_dir)
+        videos = [np.random.randint(0, 256, (t, 6, 5, 3), dtype=np.uint8) for t in [4, 7, 7, 3, 5]]
+        for i, video in enumerate(videos):
+            np.save(os.path.join(video_dir, f"{i}.npy"), video)
+        np.save(os.path.join(video_dir, "dup.npy"), videos[0]) # the same content as 0.npy
+
+        store = DecodedVideoStore(os.path.join(tmp_dir, "store"), shard_bytes=300) # small shards to test multiple shards
+        dataset = GenVideoDataset(video_dir, seed=0, decoded_store=store)
+        store.build(dataset.video_paths, num_workers=0)
+        store = DecodedVideoStore(os.path.join(tmp_dir, "store")) # reload from disk
+        assert len(store.index) == len(videos)
+        assert len([fn for fn in os.listdir(store.store_dir) if fn.endswith(".npy")]) > 1
+        dataset.decoded_store = store
+        for i in range(len(dataset)):
+            name = dataset[i]["video_name"]
+            ref = videos[0] if name == "dup.npy" else videos[int(name.split(".")[0])]
+            assert torch.equal(dataset[i]["video"], torch.from_numpy(ref).permute(3, 0, 1, 2))
+    print("decoded video store OK")
+
+
+if __name__ == "__main__":
+    demo()
+    demo_distributed()
+    demo_decoded_store()
+    demo_batched_windows()
@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+
+import torch
+
+from opensora.models.causal_stdit2.causal_stdit2 import CausalSTDiT2
+from opensora.utils.profiling import enable_profiling, disable_profiling
+from opensora.utils.video_gen import autoregressive_sample_kv_cache
+
+'''
+run the kv-cache sampler with a tiny CausalSTDiT2 on CPU w/ and w/o profiling,
+check the samples are the same and the report/trace contain each phase & the kv-cache info of each AR step
+python tests/test_kv_cache_profiler.py
+'''
+
+class FakeScheduler:
+    # 2 denoise steps, each calls the model once (as `forward_with_cfg_v2` w/o cls-free guidance)
+    cfg_scale = 1.0
+    num_steps = 2
+
+    def sample_v2(self, model, z, prompts, device, model_kwargs=None, progress_bar=False):
+        for i in range(self.num_steps):
+            t = torch.zeros(size=(z.shape[0],), dtype=torch.long) + (self.num_steps - i) * 100
+            out = model(z, t, **model_kwargs)
+            z = z - 0.1 * out[:, :z.shape[1]]
+        return z
+
+
+def sample(model, profile, save_dir=None):
+    if profile:
+        profiler = enable_profiling(sync_cuda=False)
+    samples, _, _ = autoregressive_sample_kv_cache(
+        FakeScheduler(), model, None,
+        z_size=(4, 2, 8, 8),
+        prompts=[None],
+        cond_frame_latents=torch.randn(1, 4, 1, 8, 8, generator=torch.Generator().manual_seed(0)),
+        ar_steps=3,
+        kv_cache_dequeue=True,
+        kv_cache_max_seqlen=4,
+        seed=123,
+        verbose=False,
+    )
+    if profile:
+        paths = profiler.save(save_dir)
+        disable_profiling()
+        return samples, paths
+    return samples, None
+
+
+@torch.no_grad()
+def demo():
+    torch.manual_seed(0)
+    model = CausalSTDiT2(
+        input_size=(16, 8, 8),
+        hidden_size=64,
+        depth=2,
+        num_heads=4,
+        caption_channels=0,
+        temp_extra_in_channels=1,
+        relative_tpe_mode="cyclic",
+        spatial_attn_enhance="prev_frames_2",
+    ).eval()
+
+    samples_ref, _ = sample(model, profile=False)
+    model.empty_kv_cache()
+    with tempfile.TemporaryDirectory() as save_dir:
+        samples, (report_path, trace_path) = sample(model, profile=True, save_dir=save_dir)
+        assert torch.equal(samples, samples_ref)
+
+        with open(report_path) as f:
+            report = json.load(f)
+        with open(trace_path) as f:
+            trace = json.load(f)
+        phases = report["phases"]
+        for k, v in phases.items():
+            print(f"{k}: {v}")
+        for name in ["spatial_attn", "cross_frame_attn", "temporal_attn", "cross_attn", "mlp"]:
+            assert phases[f"denoise/denoise_step/block/{name}"]["count"] == 3 * FakeScheduler.num_steps * 2  # ar_steps * steps * depth
+        assert phases["denoise/denoise_step"]["count"] == 3 * FakeScheduler.num_steps
+        assert phases["prefix_cache_write"]["count"] == 1
+        assert phases["kv_cache_write"]["count"] == 3
+        assert phases["kv_cache_write/cache_copy"]["count"] == 3
+
+        ar_steps = report["ar_steps"]
+        print(ar_steps)
+        assert [info["cache_len"] for info in ar_steps] == [1, 3, 4]  # dequeue at kv_cache_max_seqlen=4
+        assert all(info["temporal_kv_bytes"] == model.cache_kv.numel() * 4 for info in ar_steps)
+        assert all(info["spatial_ctx_len"] == 2 * 16 for info in ar_steps)
+        assert any(e["ph"] == "C" for e in trace["traceEvents"])
+        assert os.path.exists(trace_path)
+    print("profiler OK")
+
+
+if __name__ == "__main__":
+    demo()
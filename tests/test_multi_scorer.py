@@ -0,0 +1,121 @@
+import argparse
+import os
+import tempfile
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+import tools.scoring.multi_scorer as multi_scorer
+from tools.scoring.multi_scorer import BaseScorer, register_scorer
+from tools.datasets.utils import extract_frames
+
+'''
+run the multi-scorer w/ 2 toy CPU scorers on small videos, check:
+    the scores are the same as extracting the frames of each scorer separately (`extract_frames`)
+    each video is decoded once, and re-running resumes from the saved parts
+python tests/test_multi_scorer.py
+'''
+
+@register_scorer("toy_bright")
+class BrightnessScorer(BaseScorer):
+    points = (0.1, 0.5, 0.9)
+
+    def build(self):
+        pass
+
+    def preprocess(self, frames, row):
+        return torch.stack([torch.from_numpy(np.array(x)).float() for x in frames])
+
+    def score(self, batch):
+        return batch.mean(dim=[1, 2, 3, 4]).tolist()
+
+
+@register_scorer("toy_diff")
+class FrameDiffScorer(BaseScorer):
+    frame_inds = (0, 10, 20, 30)
+    micro_batch_size = 2
+
+    def build(self):
+        pass
+
+    def preprocess(self, frames, row):
+        return torch.stack([torch.from_numpy(np.array(x)).float() for x in frames])
+
+    def score(self, batch):
+        return (batch[:, 1:] - batch[:, :-1]).abs().mean(dim=[1, 2, 3, 4]).tolist()
+
+
+def write_video(path, num_frames, seed):
+    rng = np.random.RandomState(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 8, (64, 48))
+    for i in range(num_frames):
+        writer.write((rng.rand(48, 64, 3) * 255).astype(np.uint8))
+    writer.release()
+
+
+def reference_scores(path):
+    if path.endswith(".png"):
+        img = np.array(Image.open(path).convert("RGB")).astype(np.float32)
+        return img.mean(), 0.0
+    bright = np.stack([np.array(x) for x in extract_frames(path, points=BrightnessScorer.points)]).astype(np.float32)
+    diff = np.stack([np.array(x) for x in extract_frames(path, frame_inds=FrameDiffScorer.frame_inds)]).astype(np.float32)
+    return bright.mean(), np.abs(diff[1:] - diff[:-1]).mean()
+
+
+def run(meta_path, bs=2):
+    args = argparse.Namespace(
+        meta_path=meta_path, scorers=["toy_bright", "toy_diff"], cpu_scorers=[], output=None,
+        bs=bs, num_workers=0, prefetch_factor=2, save_interval=1,
+    )
+    num_decoded = []
+    decode_frames = multi_scorer.decode_frames
+
+    def counted_decode_frames(path, **kwargs):
+        num_decoded.append(path)
+        return decode_frames(path, **kwargs)
+
+    multi_scorer.decode_frames = counted_decode_frames
+    multi_scorer.main(args)
+    multi_scorer.decode_frames = decode_frames
+    return pd.read_parquet(meta_path.replace(".csv", "_scores.parquet")), num_decoded
+
+
+def demo():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i, num_frames in enumerate([40, 25, 12]):  # 25 & 12: some frame_inds are clamped to the last frame
+            paths.append(os.path.join(tmp_dir, f"video{i}.mp4"))
+            write_video(paths[-1], num_frames, seed=i)
+        paths.append(os.path.join(tmp_dir, "image.png"))
+        Image.fromarray((np.random.rand(48, 64, 3) * 255).astype(np.uint8)).save(paths[-1])
+        meta_path = os.path.join(tmp_dir, "meta.csv")
+        pd.DataFrame(dict(path=paths, text=["a video"] * len(paths))).to_csv(meta_path, index=False)
+
+        scores, num_decoded = run(meta_path)
+        assert sorted(num_decoded) == sorted(p for p in paths if p.endswith(".mp4")), num_decoded  # decoded once
+        for path, bright, diff in zip(scores["path"], scores["toy_bright"], scores["toy_diff"]):
+            ref_bright, ref_diff = reference_scores(path)
+            print(f"{os.path.basename(path)}: toy_bright={bright:.3f} ({ref_bright:.3f}), toy_diff={diff:.3f} ({ref_diff:.3f})")
+            assert abs(bright - ref_bright) < 1e-3 and abs(diff - ref_diff) < 1e-3
+
+        # resume: all rows are scored, nothing is decoded
+        scores_resumed, num_decoded = run(meta_path)
+        assert len(num_decoded) == 0
+        pd.testing.assert_frame_equal(scores, scores_resumed)
+
+        # resume after losing the part of the 2nd batch (rows 2,3)
+        parts_dir = meta_path.replace(".csv", "_scores.parquet.parts")
+        for f in sorted(os.listdir(parts_dir)):
+            if set(pd.read_parquet(os.path.join(parts_dir, f))["index"]) == {2, 3}:
+                os.remove(os.path.join(parts_dir, f))
+        scores_resumed, num_decoded = run(meta_path)
+        assert num_decoded == [paths[2]], num_decoded
+        pd.testing.assert_frame_equal(scores, scores_resumed)
+    print("multi scorer OK")
+
+
+if __name__ == "__main__":
+    demo()
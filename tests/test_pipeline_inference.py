@@ -0,0 +1,90 @@
+import tempfile
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from opensora.acceleration.parallel_states import set_pipeline_parallel_group
+from opensora.models.causal_stdit2.causal_stdit2 import CausalSTDiT2
+from opensora.models.causal_stdit2.pipeline import PipelineCausalSTDiT2, partition_blocks
+from opensora.utils.video_gen import build_init_noise, get_val_batch_size, group_val_examples
+
+'''
+depth-pipelined inference w/ kv-cache on CPU (gloo), compare with the complete model on each rank
+python tests/test_pipeline_inference.py
+'''
+
+def run(rank, world_size, init_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    set_pipeline_parallel_group(dist.group.WORLD)
+
+    for spatial_attn_enhance, num_micro_batches in [("prev_frames_2", 2), ("first_frame", 3), (None, 4), (None, None)]:
+        model_kwargs = dict(
+            input_size=(16, 8, 8),
+            hidden_size=64,
+            depth=5,
+            num_heads=4,
+            caption_channels=0,
+            temp_extra_in_channels=1,
+            relative_tpe_mode="cyclic",
+            spatial_attn_enhance=spatial_attn_enhance,
+        )
+        torch.manual_seed(1024)
+        model = CausalSTDiT2(**model_kwargs).eval()
+        stage_model = CausalSTDiT2(**model_kwargs).eval()
+        stage_model.load_state_dict(model.state_dict())
+        stage_model = PipelineCausalSTDiT2(stage_model, num_micro_batches=num_micro_batches)
+        assert len(stage_model.model.blocks) == (lambda r: r[1] - r[0])(partition_blocks(5, world_size)[rank])
+
+        bsz = 4
+        model.register_kv_cache(bsz, max_seq_len=4, kv_cache_dequeue=True)
+        stage_model.register_kv_cache(bsz, max_seq_len=4, kv_cache_dequeue=True)
+        assert stage_model.model.cache_kv.shape[0] == len(stage_model.model.blocks)
+
+        torch.manual_seed(0)  # same inputs on all ranks
+        x_clean = torch.randn(bsz, 4, 1, 8, 8)
+        with torch.no_grad():
+            for ar_step in range(3):
+                model.write_latents_to_cache(x_clean, None, None)
+                stage_model.write_latents_to_cache(x_clean, None, None)
+                z = torch.randn(bsz, 4, 2, 8, 8)
+                t = torch.randint(0, 1000, (bsz,))
+                out = model(z, t, None, None)
+                stage_out = stage_model(z, t, None, None)
+                assert torch.allclose(out, stage_out, atol=1e-5), (spatial_attn_enhance, ar_step, (out - stage_out).abs().max())
+                x_clean = out[:, :4]
+        if rank == 0:
+            print(f"pipeline inference OK, num_stages={world_size}, spatial_attn_enhance={spatial_attn_enhance}, num_micro_batches={num_micro_batches}")
+    dist.destroy_process_group()
+
+
+def check_val_batching():
+    # compatible consecutive examples are sampled in one batch, each w/ the same init noise as sampled alone
+    def example(chunk_len=8, first_image=0):
+        return SimpleNamespace(auto_regre_chunk_len=chunk_len, height=64, width=64, auto_regre_steps=2, first_image=first_image)
+    examples = [example(), example(), example(), example(chunk_len=4), example(first_image=None), example(first_image=None)]
+    batches = [[idx for idx, _ in batch] for batch in group_val_examples(examples, 2)]
+    assert batches == [[0, 1], [2], [3], [4, 5]], batches
+    assert [len(batch) for batch in group_val_examples(examples, 1)] == [1] * 6
+
+    cfg_scale = lambda s: SimpleNamespace(cfg_scale=s)
+    assert get_val_batch_size(SimpleNamespace(), {}, cfg_scale(7.5)) == 1
+    assert get_val_batch_size(SimpleNamespace(num_stages=3), {}, cfg_scale(7.5)) == 2
+    assert get_val_batch_size(SimpleNamespace(num_stages=3), {}, cfg_scale(1.0)) == 3
+    assert get_val_batch_size(SimpleNamespace(num_stages=3), {"pipeline_batch_size": 4}, cfg_scale(7.5)) == 4
+
+    size = (3, 4, 5, 8, 8)
+    noise = build_init_noise(size, [11, 22, 33], device="cpu", dtype=torch.float32)
+    for i, seed in enumerate([11, 22, 33]):
+        assert torch.equal(noise[i : i + 1], build_init_noise((1, *size[1:]), seed, device="cpu", dtype=torch.float32))
+    assert build_init_noise(size, 11, device="cpu", dtype=torch.float32).shape == size
+    print("val example batching OK")
+
+
+if __name__ == "__main__":
+    assert partition_blocks(28, 3) == [(0, 10), (10, 19), (19, 28)]
+    check_val_batching()
+    for world_size in [2, 3]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mp.spawn(run, args=(world_size, f"{tmp_dir}/dist_init"), nprocs=world_size)
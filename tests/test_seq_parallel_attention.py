@@ -1,6 +1,9 @@
+import tempfile
+
 import colossalai
 import torch
 import torch.distributed as dist
+import torch.multiprocessing as mp
 from colossalai.testing import spawn
 
 from opensora.acceleration.communications import gather_forward_split_backward, split_forward_gather_backward
@@ -145,6 +148,55 @@ def run_cross_attention(rank, world_size):
     assert torch.allclose(y.grad, seq_y.grad, atol=1e-7), f"{y.grad}\nvs\n{seq_y.grad}"
 
 
+def run_kv_cache_seq_parallel(rank, world_size, init_file):
+    # spatial-token seq parallel for inference w/ kv-cache, on CPU w/ gloo
+    from opensora.models.causal_stdit2.causal_stdit2 import CausalSTDiT2
+
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    set_sequence_parallel_group(dist.group.WORLD)
+
+    for spatial_attn_enhance, comm_chunks in [("prev_frames_2", 1), ("prev_frames_2", 2), ("first_frame", 2), (None, 1)]:
+        model_kwargs = dict(
+            input_size=(16, 8, 8),
+            hidden_size=64,
+            depth=2,
+            num_heads=4,
+            caption_channels=0,
+            temp_extra_in_channels=1,
+            relative_tpe_mode="cyclic",
+            spatial_attn_enhance=spatial_attn_enhance,
+        )
+        torch.manual_seed(1024)
+        model = CausalSTDiT2(**model_kwargs).eval()
+        sp_model = CausalSTDiT2(kv_cache_sequence_parallel=True, kv_cache_sp_comm_chunks=comm_chunks, **model_kwargs).eval()
+        sp_model.load_state_dict(model.state_dict())
+
+        for m in [model, sp_model]:
+            m.register_kv_cache(2, max_seq_len=4, kv_cache_dequeue=True)
+        assert sp_model.cache_kv.shape[3] * world_size == model.cache_kv.shape[3]
+
+        torch.manual_seed(0)  # same inputs on all ranks
+        x_clean = torch.randn(2, 4, 1, 8, 8)
+        with torch.no_grad():
+            for ar_step in range(3):
+                model.write_latents_to_cache(x_clean, None, None)
+                sp_model.write_latents_to_cache(x_clean, None, None)
+                z = torch.randn(2, 4, 2, 8, 8)
+                t = torch.randint(0, 1000, (2,))
+                out = model.forward_kv_cache(z, t, None, None)
+                sp_out = sp_model.forward_kv_cache(z, t, None, None)
+                assert torch.allclose(out, sp_out, atol=1e-5), (spatial_attn_enhance, ar_step, (out - sp_out).abs().max())
+                x_clean = out[:, :4]
+        if rank == 0:
+            print(f"kv-cache seq parallel OK, spatial_attn_enhance={spatial_attn_enhance}, comm_chunks={comm_chunks}")
+    dist.destroy_process_group()
+
+
+def test_kv_cache_seq_parallel(world_size=2):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(run_kv_cache_seq_parallel, args=(world_size, f"{tmp_dir}/dist_init"), nprocs=world_size)
+
+
 def run_dist(rank, world_size, port):
     colossalai.launch({}, rank=rank, world_size=world_size, host="localhost", port=port)
     # run_attention(rank, world_size)
@@ -156,4 +208,6 @@ def test_seq_parallel_attention():
 
 
 if __name__ == "__main__":
-    test_seq_parallel_attention()
+    if torch.cuda.is_available():
+        test_seq_parallel_attention()
+    test_kv_cache_seq_parallel()
@@ -1,5 +1,4 @@
 import argparse
-import html
 import json
 import os
 import random
@@ -11,8 +10,12 @@ import cv2
 import numpy as np
 import pandas as pd
 import torchvision
+from PIL import Image
 from tqdm import tqdm
 
+from opensora.utils.file_utils import atomic_write, file_stat_key
+from opensora.utils.text_clean import text_preprocessing
+
 from .utils import IMG_EXTENSIONS
 
 tqdm.pandas()
@@ -31,7 +34,20 @@ def apply(df, func, **kwargs):
     return df.progress_apply(func, **kwargs)
 
 
+def apply_unique(ser, func, parallel=True):
+    """
+    `apply(ser, func)` on the unique values only (e.g., the duplicated captions), the results are mapped back
+    """
+    codes, uniques = pd.factorize(ser, use_na_sentinel=False)
+    uniques = pd.Series(uniques)
+    print(f"{len(uniques)} unique values of {len(ser)}.")
+    ret = apply(uniques, func) if parallel else uniques.progress_apply(func)
+    return pd.Series(ret.to_numpy()[codes], index=ser.index, name=ser.name)
+
+
 TRAIN_COLUMNS = ["path", "text", "num_frames", "fps", "height", "width", "aspect_ratio", "resolution", "text_len"]
+INFO_COLUMNS = ["num_frames", "height", "width", "aspect_ratio", "fps", "resolution"]
+INFO_CACHE_PATH = os.path.expanduser("~/.cache/opensora/datautil_info.parquet")
 
 # ======================================================
 # --info
@@ -48,23 +64,50 @@ def get_video_length(cap, method="header"):
     return length
 
 
+def probe_video_header(path):
+    """
+    num_frames, height, width, fps from the container header by PyAV, no frame is decoded
+    """
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate) if stream.average_rate else np.nan
+        num_frames = stream.frames
+        if num_frames == 0 and fps > 0:  # not in the header (e.g., mkv, webm), estimate by the duration
+            if stream.duration is not None:
+                num_frames = round(float(stream.duration * stream.time_base) * fps)
+            elif container.duration is not None:
+                num_frames = round(container.duration / av.time_base * fps)
+        return num_frames, stream.codec_context.height, stream.codec_context.width, fps
+
+
+def probe_video_cv2(path):
+    cap = cv2.VideoCapture(path)
+    info = (
+        get_video_length(cap, method="header"),
+        int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        float(cap.get(cv2.CAP_PROP_FPS)),
+    )
+    cap.release()
+    return info
+
+
 def get_info(path):
     try:
         ext = os.path.splitext(path)[1].lower()
         if ext in IMG_EXTENSIONS:
-            im = cv2.imread(path)
-            if im is None:
-                return 0, 0, 0, np.nan, np.nan
-            height, width = im.shape[:2]
+            with Image.open(path) as im:  # lazy, only the header is read
+                width, height = im.size
+                if im.getexif().get(0x0112) in (5, 6, 7, 8):  # EXIF orientation, rotated by 90 degrees when loaded
+                    width, height = height, width
             num_frames, fps = 1, np.nan
         else:
-            cap = cv2.VideoCapture(path)
-            num_frames, height, width, fps = (
-                get_video_length(cap, method="header"),
-                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                float(cap.get(cv2.CAP_PROP_FPS)),
-            )
+            try:
+                num_frames, height, width, fps = probe_video_header(path)
+            except Exception:  # no PyAV, or a container it cannot read
+                num_frames, height, width, fps = probe_video_cv2(path)
         hw = height * width
         aspect_ratio = height / width if width > 0 else np.nan
         return num_frames, height, width, aspect_ratio, fps, hw
@@ -84,6 +127,58 @@ def get_video_info(path):
         return 0, 0, 0, np.nan, np.nan, np.nan
 
 
+def get_file_key(path):
+    """`file_stat_key` of the index caches, w/ size = mtime = -1 if the file does not exist"""
+    try:
+        return file_stat_key(path)
+    except OSError:
+        return [os.path.realpath(path), -1, -1]
+
+
+def get_info_cached(paths, info_func, cache_path=INFO_CACHE_PATH):
+    """
+    `apply(paths, info_func)` w/ an on-disk cache keyed by (realpath, size, mtime) and the name of info_func,
+    only the new or modified files are probed, the failed ones (height == 0) are not cached
+
+    Args:
+        paths (pd.Series)
+        info_func: `get_info` or `get_video_info`
+        cache_path (str | None): parquet file, None to disable the cache
+    Return:
+        List[tuple]: INFO_COLUMNS of each path
+    """
+    if cache_path is None:
+        return list(apply(paths, info_func))
+
+    keys = pd.DataFrame([get_file_key(x) for x in paths], columns=["path", "size", "mtime"])
+    keys["method"] = info_func.__name__
+    cache_columns = list(keys.columns) + INFO_COLUMNS
+    if os.path.exists(cache_path):
+        cache = pd.read_parquet(cache_path)
+        data = keys.merge(cache, on=list(keys.columns), how="left")
+    else:
+        cache = None
+        data = keys.reindex(columns=cache_columns)
+
+    miss = data["num_frames"].isna().to_numpy()
+    print(f"Info cache '{cache_path}': {len(data) - miss.sum()} hit, {miss.sum()} to probe.")
+    if miss.any():
+        info = apply(paths[miss], info_func)
+        data.loc[miss, INFO_COLUMNS] = pd.DataFrame(list(info), index=data.index[miss], columns=INFO_COLUMNS)
+        new = data[miss & (data["height"] > 0).to_numpy() & (data["size"] >= 0).to_numpy()]
+        if len(new) > 0:
+            cache = new[cache_columns] if cache is None else pd.concat([cache, new[cache_columns]])
+            cache = cache.drop_duplicates(subset=["path", "method"], keep="last")
+            # a killed run never corrupts the cache
+            atomic_write(cache_path, lambda tmp_path: cache.to_parquet(tmp_path, index=False))
+
+    data = data[INFO_COLUMNS]
+    for col in ["num_frames", "height", "width", "resolution"]:
+        if not data[col].isna().any():
+            data[col] = data[col].astype(int)
+    return list(data.itertuples(index=False, name=None))
+
+
 # ======================================================
 # --refine-llm-caption
 # ======================================================
@@ -109,13 +204,16 @@ LLAVA_PREFIX = [
 ]
 
 
+# the same order as checking each prefix and its lower case one by one
+LLAVA_PREFIX_REGEX = re.compile("|".join(re.escape(x) for prefix in LLAVA_PREFIX for x in (prefix, prefix.lower())))
+
+
 def remove_caption_prefix(caption):
-    for prefix in LLAVA_PREFIX:
-        if caption.startswith(prefix) or caption.startswith(prefix.lower()):
-            caption = caption[len(prefix) :].strip()
-            if caption[0].islower():
-                caption = caption[0].upper() + caption[1:]
-            return caption
+    match = LLAVA_PREFIX_REGEX.match(caption)
+    if match is not None:
+        caption = caption[match.end() :].strip()
+        if caption and caption[0].islower():
+            caption = caption[0].upper() + caption[1:]
     return caption
 
 
@@ -185,147 +283,7 @@ def build_lang_detector(lang_to_detect):
 # --clean-caption
 # ======================================================
 
-
-def basic_clean(text):
-    import ftfy
-
-    text = ftfy.fix_text(text)
-    text = html.unescape(html.unescape(text))
-    return text.strip()
-
-
-BAD_PUNCT_REGEX = re.compile(
-    r"[" + "#®•©™&@·º½¾¿¡§~" + "\)" + "\(" + "\]" + "\[" + "\}" + "\{" + "\|" + "\\" + "\/" + "\*" + r"]{1,}"
-)  # noqa
-
-
-def clean_caption(caption):
-    import urllib.parse as ul
-
-    from bs4 import BeautifulSoup
-
-    caption = str(caption)
-    caption = ul.unquote_plus(caption)
-    caption = caption.strip().lower()
-    caption = re.sub("<person>", "person", caption)
-    # urls:
-    caption = re.sub(
-        r"\b((?:https?:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))",  # noqa
-        "",
-        caption,
-    )  # regex for urls
-    caption = re.sub(
-        r"\b((?:www:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))",  # noqa
-        "",
-        caption,
-    )  # regex for urls
-    # html:
-    caption = BeautifulSoup(caption, features="html.parser").text
-
-    # @<nickname>
-    caption = re.sub(r"@[\w\d]+\b", "", caption)
-
-    # 31C0—31EF CJK Strokes
-    # 31F0—31FF Katakana Phonetic Extensions
-    # 3200—32FF Enclosed CJK Letters and Months
-    # 3300—33FF CJK Compatibility
-    # 3400—4DBF CJK Unified Ideographs Extension A
-    # 4DC0—4DFF Yijing Hexagram Symbols
-    # 4E00—9FFF CJK Unified Ideographs
-    caption = re.sub(r"[\u31c0-\u31ef]+", "", caption)
-    caption = re.sub(r"[\u31f0-\u31ff]+", "", caption)
-    caption = re.sub(r"[\u3200-\u32ff]+", "", caption)
-    caption = re.sub(r"[\u3300-\u33ff]+", "", caption)
-    caption = re.sub(r"[\u3400-\u4dbf]+", "", caption)
-    caption = re.sub(r"[\u4dc0-\u4dff]+", "", caption)
-    caption = re.sub(r"[\u4e00-\u9fff]+", "", caption)
-    #######################################################
-
-    # все виды тире / all types of dash --> "-"
-    caption = re.sub(
-        r"[\u002D\u058A\u05BE\u1400\u1806\u2010-\u2015\u2E17\u2E1A\u2E3A\u2E3B\u2E40\u301C\u3030\u30A0\uFE31\uFE32\uFE58\uFE63\uFF0D]+",  # noqa
-        "-",
-        caption,
-    )
-
-    # кавычки к одному стандарту
-    caption = re.sub(r"[`´«»“”¨]", '"', caption)
-    caption = re.sub(r"[‘’]", "'", caption)
-
-    # &quot;
-    caption = re.sub(r"&quot;?", "", caption)
-    # &amp
-    caption = re.sub(r"&amp", "", caption)
-
-    # ip adresses:
-    caption = re.sub(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}", " ", caption)
-
-    # article ids:
-    caption = re.sub(r"\d:\d\d\s+$", "", caption)
-
-    # \n
-    caption = re.sub(r"\\n", " ", caption)
-
-    # "#123"
-    caption = re.sub(r"#\d{1,3}\b", "", caption)
-    # "#12345.."
-    caption = re.sub(r"#\d{5,}\b", "", caption)
-    # "123456.."
-    caption = re.sub(r"\b\d{6,}\b", "", caption)
-    # filenames:
-    caption = re.sub(r"[\S]+\.(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)", "", caption)
-
-    #
-    caption = re.sub(r"[\"\']{2,}", r'"', caption)  # """AUSVERKAUFT"""
-    caption = re.sub(r"[\.]{2,}", r" ", caption)  # """AUSVERKAUFT"""
-
-    caption = re.sub(BAD_PUNCT_REGEX, r" ", caption)  # ***AUSVERKAUFT***, #AUSVERKAUFT
-    caption = re.sub(r"\s+\.\s+", r" ", caption)  # " . "
-
-    # this-is-my-cute-cat / this_is_my_cute_cat
-    regex2 = re.compile(r"(?:\-|\_)")
-    if len(re.findall(regex2, caption)) > 3:
-        caption = re.sub(regex2, " ", caption)
-
-    caption = basic_clean(caption)
-
-    caption = re.sub(r"\b[a-zA-Z]{1,3}\d{3,15}\b", "", caption)  # jc6640
-    caption = re.sub(r"\b[a-zA-Z]+\d+[a-zA-Z]+\b", "", caption)  # jc6640vc
-    caption = re.sub(r"\b\d+[a-zA-Z]+\d+\b", "", caption)  # 6640vc231
-
-    caption = re.sub(r"(worldwide\s+)?(free\s+)?shipping", "", caption)
-    caption = re.sub(r"(free\s)?download(\sfree)?", "", caption)
-    caption = re.sub(r"\bclick\b\s(?:for|on)\s\w+", "", caption)
-    caption = re.sub(r"\b(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)(\simage[s]?)?", "", caption)
-    caption = re.sub(r"\bpage\s+\d+\b", "", caption)
-
-    caption = re.sub(r"\b\d*[a-zA-Z]+\d+[a-zA-Z]+\d+[a-zA-Z\d]*\b", r" ", caption)  # j2d1a2a...
-
-    caption = re.sub(r"\b\d+\.?\d*[xх×]\d+\.?\d*\b", "", caption)
-
-    caption = re.sub(r"\b\s+\:\s+", r": ", caption)
-    caption = re.sub(r"(\D[,\./])\b", r"\1 ", caption)
-    caption = re.sub(r"\s+", " ", caption)
-
-    caption.strip()
-
-    caption = re.sub(r"^[\"\']([\w\W]+)[\"\']$", r"\1", caption)
-    caption = re.sub(r"^[\'\_,\-\:;]", r"", caption)
-    caption = re.sub(r"[\'\_,\-\:\-\+]$", r"", caption)
-    caption = re.sub(r"^\.\S+$", "", caption)
-
-    return caption.strip()
-
-
-def text_preprocessing(text, use_text_preprocessing: bool = True):
-    if use_text_preprocessing:
-        # The exact text cleaning as was in the training stage:
-        text = clean_caption(text)
-        text = clean_caption(text)
-        return text
-    else:
-        return text.lower().strip()
-
+# `text_preprocessing` (`clean_caption` twice) is shared with the T5 text encoder, see `opensora/utils/text_clean.py`
 
 # ======================================================
 # load caption
@@ -437,8 +395,9 @@ def main(args):
     if args.load_caption is not None:
         assert "path" in data.columns
         data["text"] = apply(data["path"], load_caption, ext=args.load_caption)
+    info_cache = None if args.no_info_cache else args.info_cache
     if args.info:
-        info = apply(data["path"], get_info)
+        info = get_info_cached(data["path"], get_info, info_cache)
         (
             data["num_frames"],
             data["height"],
@@ -448,7 +407,7 @@ def main(args):
             data["resolution"],
         ) = zip(*info)
     if args.video_info:
-        info = apply(data["path"], get_video_info)
+        info = get_info_cached(data["path"], get_video_info, info_cache)
         (
             data["num_frames"],
             data["height"],
@@ -467,7 +426,7 @@ def main(args):
         data = data[~data["text"].str.contains(r"(?P<url>https?://[^\s]+)", regex=True)]
     if args.lang is not None:
         assert "text" in data.columns
-        data = data[data["text"].progress_apply(detect_lang)]  # cannot parallelize
+        data = data[apply_unique(data["text"], detect_lang, parallel=False)]  # cannot parallelize
     if args.remove_empty_caption:
         assert "text" in data.columns
         data = data[data["text"].str.len() > 0]
@@ -485,10 +444,10 @@ def main(args):
         data["text"] = apply(data, lambda x: merge_cmotion(x["text"], x["cmotion"]), axis=1)
     if args.refine_llm_caption:
         assert "text" in data.columns
-        data["text"] = apply(data["text"], remove_caption_prefix)
+        data["text"] = apply_unique(data["text"], remove_caption_prefix)
     if args.clean_caption:
         assert "text" in data.columns
-        data["text"] = apply(
+        data["text"] = apply_unique(
             data["text"],
             partial(text_preprocessing, use_text_preprocessing=True),
         )
@@ -568,6 +527,10 @@ def parse_args():
     # IO-related
     parser.add_argument("--info", action="store_true", help="get the basic information of each video and image")
     parser.add_argument("--video-info", action="store_true", help="get the basic information of each video")
+    parser.add_argument(
+        "--info-cache", type=str, default=INFO_CACHE_PATH, help="cache of --info and --video-info (parquet)"
+    )
+    parser.add_argument("--no-info-cache", action="store_true", help="probe all the files w/o the cache")
     parser.add_argument("--ext", action="store_true", help="check if the file exists")
     parser.add_argument(
         "--load-caption", type=str, default=None, choices=["json", "txt"], help="load the caption from json or txt"
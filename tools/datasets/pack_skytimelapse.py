@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from opensora.datasets import video_transforms
+from opensora.datasets.skytimelapse_dataset import PACKED_INDEX_FILE, pil_loader, scan_short_videos
+
+
+def load_resized_frames(args):
+    frame_paths, image_size = args
+    video = torch.stack([torch.from_numpy(np.array(pil_loader(path))) for path in frame_paths], dim=0)  # (T, H, W, C)
+    video = video.permute(0, 3, 1, 2).float()  # TCHW
+    video = video_transforms.ResizeCenterCropVideo(image_size)(video)
+    video = video.round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1)  # (T, H, W, C)
+    return video.numpy()
+
+
+def main(args):
+    image_size = tuple(args.image_size)
+    classes, videos, _ = scan_short_videos(args.root)
+    videos = [v for v in videos if len(v[2]) > 0]
+    print(f"number of long videos: {len(classes)}, number of short videos: {len(videos)}")
+
+    # assign short videos to shards, a short video is never split across shards
+    shard_ranges = []
+    for vid_id, (_, _, frames) in enumerate(videos):
+        if len(shard_ranges) == 0 or shard_ranges[-1][2] + len(frames) > args.shard_max_frames:
+            shard_ranges.append([vid_id, vid_id, 0])
+        shard_ranges[-1][1] = vid_id + 1
+        shard_ranges[-1][2] += len(frames)
+
+    os.makedirs(args.output, exist_ok=True)
+    shard_names, index_videos = [], []
+    with Pool(args.num_workers) as pool:
+        for shard_id, (vid_begin, vid_end, num_frames) in enumerate(shard_ranges):
+            shard_name = f"frames_{shard_id:04d}.npy"
+            shard = np.lib.format.open_memmap(
+                os.path.join(args.output, shard_name), mode="w+", dtype=np.uint8, shape=(num_frames, *image_size, 3)
+            )
+            tasks = [
+                ([os.path.join(args.root, long_vid, short_vid, fn) for fn in frames], image_size)
+                for long_vid, short_vid, frames in videos[vid_begin:vid_end]
+            ]
+            start = 0
+            for (long_vid, short_vid, frames), video in zip(
+                videos[vid_begin:vid_end],
+                tqdm(pool.imap(load_resized_frames, tasks), total=len(tasks), desc=shard_name),
+            ):
+                shard[start : start + len(video)] = video
+                index_videos.append(
+                    dict(long_vid=long_vid, short_vid=short_vid, shard=shard_id, start=start, length=len(video), frames=frames)
+                )
+                start += len(video)
+            shard.flush()
+            del shard
+            shard_names.append(shard_name)
+
+    index = dict(
+        source_root=args.root,
+        split=args.root.rstrip("/").split("/")[-1].split("_")[-1],
+        image_size=list(image_size),
+        classes=classes,
+        shards=shard_names,
+        videos=index_videos,
+    )
+    with open(os.path.join(args.output, PACKED_INDEX_FILE), "w") as f:
+        json.dump(index, f)
+    print(f"Packed {sum(v['length'] for v in index_videos)} frames into {len(shard_names)} shards at {args.output}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", type=str, help="e.g., /data/SkyTimelapse/sky_timelapse/sky_train")
+    parser.add_argument("--output", type=str, required=True, help="output dir of the packed frame store")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[256, 256], help="(h, w) of the stored frames")
+    parser.add_argument("--shard-max-frames", type=int, default=8192)
+    parser.add_argument("--num-workers", type=int, default=8)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -2,6 +2,7 @@ import argparse
 import os
 import subprocess
 import time
+from bisect import bisect_left
 from functools import partial
 
 import pandas as pd
@@ -11,6 +12,8 @@ from pandarallel import pandarallel
 from scenedetect import FrameTimecode
 from tqdm import tqdm
 
+from opensora.utils.file_utils import atomic_write
+
 tqdm.pandas()
 
 
@@ -38,10 +41,47 @@ def process_single_row(row, args, log_name=None):
         max_seconds=args.max_seconds,
         target_fps=args.target_fps,
         shorter_size=args.shorter_size,
+        stream_copy=args.stream_copy,
+        snap_seconds=args.snap_seconds,
         logger=logger,
     )
 
 
+def probe_video(video_path):
+    """
+    fps, size and keyframe timestamps (in seconds, relative to the start of the file, as `-ss` of ffmpeg)
+    of the first video stream, by demuxing the packets w/o decoding
+    """
+    import av
+
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        start_time = stream.start_time or 0
+        keyframes = sorted(
+            float((packet.pts - start_time) * stream.time_base)
+            for packet in container.demux(stream)
+            if packet.is_keyframe and packet.pts is not None
+        )
+        return dict(
+            fps=float(stream.average_rate),
+            width=stream.codec_context.width,
+            height=stream.codec_context.height,
+            keyframes=keyframes,
+        )
+
+
+def find_copy_start(keyframes, start, fps, snap_seconds=0.0):
+    """
+    the first keyframe within [start - 0.5 frame, start + snap_seconds + 0.5 frame], or None
+    stream copy (`-c copy`) can only start at a keyframe, a later keyframe drops the first frames of the scene
+    """
+    half_frame = 0.5 / fps
+    i = bisect_left(keyframes, start - half_frame)
+    if i < len(keyframes) and keyframes[i] <= start + snap_seconds + half_frame:
+        return keyframes[i]
+    return None
+
+
 def split_video(
     video_path,
     scene_list,
@@ -50,6 +90,9 @@ def split_video(
     max_seconds=15.0,
     target_fps=30,
     shorter_size=720,
+    stream_copy=False,
+    snap_seconds=0.0,
+    ffmpeg_threads=None,
     verbose=False,
     logger=None,
 ):
@@ -58,16 +101,33 @@ def split_video(
     scenes longer than max_seconds will be cut to save the beginning max_seconds.
     Currently, the saved file name pattern is f'{fname}_scene-{idx}'.mp4
 
+    w/ stream_copy, a scene is cut w/o re-encoding (`-c copy`) if it starts at a keyframe (up to snap_seconds later)
+    and the video already has the target fps & shorter size, otherwise it is re-encoded.
+    Each clip is written to a temporary file and renamed when finished, so an interrupted run leaves no broken clips.
+
     Args:
         scene_list (List[Tuple[FrameTimecode, FrameTimecode]]): each element is (s, t): start and end of a scene.
         min_seconds (float | None)
         max_seconds (float | None)
         target_fps (int | None)
         shorter_size (int | None)
+        stream_copy (bool)
+        snap_seconds (float): max shift of the scene start to the next keyframe for stream copy
+        ffmpeg_threads (int | None): threads of each re-encoding, set it when running many processes
+    Return:
+        List[dict]: path, start, end (in seconds) and mode ("copy" or "encode") of each saved clip
     """
     FFMPEG_PATH = get_ffmpeg_exe()
 
-    save_path_list = []
+    video_info = None
+    if stream_copy:
+        video_info = probe_video(video_path)
+        fps_ok = target_fps is None or abs(video_info["fps"] - target_fps) < 1e-3
+        size_ok = shorter_size is None or min(video_info["width"], video_info["height"]) == shorter_size
+        if not (fps_ok and size_ok):
+            video_info = None  # needs resampling, re-encode all the scenes
+
+    clip_list = []
     for idx, scene in enumerate(scene_list):
         s, t = scene  # FrameTimecode
         if min_seconds is not None:
@@ -80,6 +140,17 @@ def split_video(
             max_duration = FrameTimecode(timecode="00:00:00", fps=fps)
             max_duration.frame_num = round(fps * max_seconds)
             duration = min(max_duration, duration)
+        start, duration = s.get_seconds(), duration.get_seconds()
+
+        copy_start = None
+        if video_info is not None:
+            copy_start = find_copy_start(video_info["keyframes"], start, video_info["fps"], snap_seconds)
+            # snapping to a later keyframe must not make the clip too short, re-encode it instead
+            if copy_start is not None and min_seconds is not None and t.get_seconds() - copy_start < min_seconds:
+                copy_start = None
+        if copy_start is not None:
+            duration = min(duration, t.get_seconds() - copy_start)
+            start = copy_start
 
         # save path
         fname = os.path.basename(video_path)
@@ -97,29 +168,42 @@ def split_video(
 
         # clip to cut
         # -ss after -i is very slow; put -ss before -i
-        cmd += ["-nostdin", "-y", "-ss", str(s.get_seconds()), "-i", video_path, "-t", str(duration.get_seconds())]
-
-        # target fps
-        if target_fps is not None:
-            cmd += ["-r", f"{target_fps}"]
-
-        # aspect ratio
-        if shorter_size is not None:
-            cmd += ["-vf", f"scale='if(gt(iw,ih),-2,{shorter_size})':'if(gt(iw,ih),{shorter_size},-2)'"]
-            # cmd += ['-vf', f"scale='if(gt(iw,ih),{shorter_size},trunc(ow/a/2)*2)':-2"]
-
-        cmd += ["-map", "0", save_path]
-
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        stdout, stderr = proc.communicate()
-        # stdout = stdout.decode("utf-8")
-        # print_log(stdout, logger=logger)
-
-        save_path_list.append(video_path)
+        cmd += ["-nostdin", "-y", "-ss", str(start), "-i", video_path, "-t", str(duration)]
+
+        if copy_start is not None:
+            cmd += ["-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero"]
+        else:
+            # target fps
+            if target_fps is not None:
+                cmd += ["-r", f"{target_fps}"]
+
+            # aspect ratio
+            if shorter_size is not None:
+                cmd += ["-vf", f"scale='if(gt(iw,ih),-2,{shorter_size})':'if(gt(iw,ih),{shorter_size},-2)'"]
+                # cmd += ['-vf', f"scale='if(gt(iw,ih),{shorter_size},trunc(ow/a/2)*2)':-2"]
+
+            if ffmpeg_threads is not None:
+                cmd += ["-threads", f"{ffmpeg_threads}"]
+            cmd += ["-map", "0"]
+
+        # written to a temporary file and renamed, an interrupted run never leaves a truncated clip
+        try:
+            atomic_write(
+                save_path,
+                lambda tmp_path: subprocess.run(cmd + [tmp_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True),
+                ignore_errors=False,
+            )
+        except subprocess.CalledProcessError as e:
+            print_log(f"Failed to cut '{video_path}' scene-{idx}: {e.stdout.decode('utf-8')[-500:]}", logger=logger)
+            continue
+
+        clip_list.append(
+            dict(path=save_path, start=start, end=start + duration, mode="copy" if copy_start is not None else "encode")
+        )
         if verbose:
             print_log(f"Video clip saved to '{save_path}'", logger=logger)
 
-    return save_path_list
+    return clip_list
 
 
 def parse_args():
@@ -132,6 +216,10 @@ def parse_args():
                         help='if not None, clip longer than max_seconds is truncated')
     parser.add_argument("--target_fps", type=int, default=30, help='target fps of clips')
     parser.add_argument("--shorter_size", type=int, default=720, help='resize the shorter size by keeping ratio')
+    parser.add_argument("--stream_copy", action="store_true",
+                        help='cut w/o re-encoding if the scene starts at a keyframe and no resampling is needed')
+    parser.add_argument("--snap_seconds", type=float, default=0.0,
+                        help='w/ stream_copy, max shift of the scene start to the next keyframe')
 
     args = parser.parse_args()
     return args
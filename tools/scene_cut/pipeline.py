@@ -0,0 +1,157 @@
+"""
+Scene detection and cutting in one pass over the videos, with a process pool.
+
+Each worker detects the scenes of a video (on downscaled frames) and cuts it right away,
+stream-copying the scenes that start at a keyframe (w/ `--stream_copy`) and re-encoding the others.
+At most `2 * num_workers` videos are in flight, and the finished videos are appended to a JSONL manifest,
+so that memory stays bounded on large meta files and an interrupted run resumes from the manifest.
+
+Usage:
+    python -m tools.scene_cut.pipeline /path/to/meta.csv --save_dir /path/to/clips --num_workers 32 --stream_copy
+"""
+import argparse
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+from scenedetect import FrameTimecode
+from tqdm import tqdm
+
+from .cut import split_video
+from .scene_detect import detect_scenes
+
+
+def process_video(video_path, timestamp, args):
+    """
+    runs in the workers, detects the scenes if `timestamp` is None
+    Return:
+        dict: a record of the manifest
+    """
+    record = dict(path=video_path)
+    try:
+        if timestamp is None:
+            scene_list = detect_scenes(video_path, detect_width=args.detect_width)
+        else:
+            scene_list = [(FrameTimecode(s, fps=1), FrameTimecode(t, fps=1)) for s, t in eval(timestamp)]
+        record["timestamp"] = str([(s.get_timecode(), t.get_timecode()) for s, t in scene_list])
+        record["clips"] = split_video(
+            video_path,
+            scene_list,
+            save_dir=args.save_dir,
+            min_seconds=args.min_seconds,
+            max_seconds=args.max_seconds,
+            target_fps=args.target_fps or None,
+            shorter_size=args.shorter_size or None,
+            stream_copy=args.stream_copy,
+            snap_seconds=args.snap_seconds,
+            ffmpeg_threads=args.ffmpeg_threads,
+        )
+        record["status"] = "ok"
+    except Exception as e:
+        record.update(status="error", error=repr(e))
+    return record
+
+
+def read_manifest(manifest_path):
+    """
+    Return:
+        dict: video path -> the last record of each finished video
+    """
+    records = dict()
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # the last line of a killed run
+                    continue
+                if record["status"] == "ok":
+                    records[record["path"]] = record
+    return records
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("meta_path", type=str)
+    parser.add_argument("--save_dir", type=str)
+    parser.add_argument("--manifest", type=str, default=None, help='default: {save_dir}/manifest.jsonl')
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--redetect", action="store_true",
+                        help='detect the scenes even if the meta file has column timestamp')
+    parser.add_argument("--detect_width", type=int, default=256,
+                        help='downscale the frames to about this width for detection')
+    parser.add_argument("--min_seconds", type=float, default=None,
+                        help='if not None, clip shorter than min_seconds is ignored')
+    parser.add_argument("--max_seconds", type=float, default=None,
+                        help='if not None, clip longer than max_seconds is truncated')
+    parser.add_argument("--target_fps", type=int, default=30, help='target fps of clips, 0 to keep the fps')
+    parser.add_argument("--shorter_size", type=int, default=720,
+                        help='resize the shorter size by keeping ratio, 0 to keep the size')
+    parser.add_argument("--stream_copy", action="store_true",
+                        help='cut w/o re-encoding if the scene starts at a keyframe and no resampling is needed')
+    parser.add_argument("--snap_seconds", type=float, default=0.0,
+                        help='w/ stream_copy, max shift of the scene start to the next keyframe')
+    parser.add_argument("--ffmpeg_threads", type=int, default=2, help='threads of each re-encoding')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.save_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.save_dir, "manifest.jsonl")
+
+    meta = pd.read_csv(args.meta_path)
+    use_timestamp = "timestamp" in meta.columns and not args.redetect
+    done = read_manifest(manifest_path)
+    todo = meta[~meta["path"].isin(done)]
+    print(f"{len(done)} videos done in '{manifest_path}', {len(todo)} to process.")
+
+    tasks = zip(todo["path"], todo["timestamp"] if use_timestamp else [None] * len(todo))
+    max_in_flight = 2 * args.num_workers
+    num_errors = 0
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor, open(manifest_path, "a") as f:
+        pending = set()
+        pbar = tqdm(total=len(todo))
+        while True:
+            # submit lazily to bound the memory of the pending tasks & results
+            for video_path, timestamp in tasks:
+                pending.add(executor.submit(process_video, video_path, timestamp, args))
+                if len(pending) >= max_in_flight:
+                    break
+            if len(pending) == 0:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                record = future.result()
+                if record["status"] != "ok":
+                    num_errors += 1
+                    print(f"Video '{record['path']}' with error {record['error']}")
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                pbar.update()
+        pbar.close()
+
+    # outputs of all the finished videos, including the previous runs
+    done = read_manifest(manifest_path)
+    meta = meta[meta["path"].isin(done)].copy()
+    meta["timestamp"] = meta["path"].map(lambda x: done[x]["timestamp"])
+    wo_ext, ext = os.path.splitext(args.meta_path)
+    out_path = f"{wo_ext}_timestamp{ext}"
+    meta.to_csv(out_path, index=False)
+    print(f"New meta (shape={meta.shape}) with timestamp saved to '{out_path}'.")
+
+    clips = pd.DataFrame(
+        [dict(clip, video_path=record["path"]) for record in done.values() for clip in record["clips"]],
+        columns=["path", "video_path", "start", "end", "mode"],
+    )
+    out_path = f"{wo_ext}_clips{ext}"
+    clips.to_csv(out_path, index=False)
+    num_copy = (clips["mode"] == "copy").sum()
+    print(f"Meta of {len(clips)} clips ({num_copy} stream-copied) saved to '{out_path}', {num_errors} videos failed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+Run several scorers (aes, ocr, flow, match) in one pass: each video is opened & decoded once for the union of the frames
+requested by the scorers, the frames are fanned out to the scorers, and the scores are merged into one parquet.
+
+Usage:
+    torchrun --standalone --nproc_per_node 8 -m tools.scoring.multi_scorer /path/to/meta.csv --scorers aes flow ocr match
+    python -m tools.scoring.multi_scorer /path/to/meta.csv --scorers aes ocr --cpu-scorers ocr  # w/o torchrun: single process
+
+The scores of each rank are flushed to `<output>.parts/` every `--save-interval` batches,
+re-running the same command resumes from them (only the rows w/o all the requested scores are processed).
+"""
+import argparse
+import functools
+import os
+import time
+from datetime import timedelta
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from einops import rearrange
+from PIL import Image
+from torchvision.datasets.folder import pil_loader
+from torchvision.transforms.functional import pil_to_tensor
+from tqdm import tqdm
+
+from tools.datasets.utils import is_video
+
+SCORERS = dict()
+
+
+def register_scorer(name):
+    def _register(cls):
+        cls.name = name
+        SCORERS[name] = cls
+        return cls
+
+    return _register
+
+
+# ============================
+# Shared decoding
+# ============================
+def decode_frames(video_path, frame_inds=None, points_list=None, num_frames=None, max_grab_gap=16):
+    """
+    Open the video once and decode the union of the requested frames.
+    Args:
+        frame_inds (List[List[int]]): frame indices requested by each scorer
+        points_list (List[List[float]]): points within [0, 1) requested by each scorer, multiplied by #frames
+        max_grab_gap (int): frames closer than this are reached by `grab` (decode w/o conversion) instead of seeking
+    Return:
+        Dict[int, PIL.Image], total_frames
+    """
+    cap = cv2.VideoCapture(video_path)
+    if num_frames is not None and not pd.isna(num_frames):
+        total_frames = int(num_frames)
+    else:
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    total_frames = max(total_frames, 1)
+
+    inds = set()
+    for x in frame_inds or []:
+        inds.update(x)
+    for x in points_list or []:
+        inds.update(int(p * total_frames) for p in x)
+    inds = sorted(set(min(idx, total_frames - 1) for idx in inds))
+
+    frames = dict()
+    pos = None  # index of the next frame returned by `read`
+    for idx in inds:
+        if pos is None or idx < pos or idx - pos > max_grab_gap:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        else:
+            while pos < idx:
+                cap.grab()
+                pos += 1
+        pos = idx + 1
+        # HACK: sometimes OpenCV fails to read frames, return a black frame instead, the same as `extract_frames`
+        try:
+            ret, frame = cap.read()
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            frame = Image.fromarray(frame)
+        except Exception as e:
+            print(f"Error reading frame {video_path}: {e}")
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            frame = Image.new("RGB", (width, height), (0, 0, 0))
+        if frame.height == 0 or frame.width == 0:
+            frame = Image.new("RGB", (256, 256), (0, 0, 0))
+        frames[idx] = frame
+    cap.release()
+    return frames, total_frames
+
+
+# ============================
+# Scorers
+# ============================
+class BaseScorer:
+    """
+    A scorer outputs one score (column `name`) for each sample.
+        frame_inds / points: the frames it needs, the same as its standalone script in `tools/scoring/*/inference.py`
+        preprocess: runs in the dataloader workers, frames of one sample -> model input
+        collate & score: run in the main process on `device`, `micro_batch_size` samples per forward
+    """
+
+    name = None
+    frame_inds = None
+    points = None
+    micro_batch_size = 16
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.model = None
+
+    def get_frame_inds(self, total_frames):
+        if self.points is not None:
+            inds = [int(p * total_frames) for p in self.points]
+        else:
+            inds = list(self.frame_inds)
+        return [min(idx, total_frames - 1) for idx in inds]
+
+    def build(self):
+        raise NotImplementedError
+
+    def preprocess(self, frames, row):
+        raise NotImplementedError
+
+    def collate(self, samples):
+        return torch.utils.data.default_collate(samples)
+
+    def score(self, batch):
+        raise NotImplementedError
+
+    @torch.inference_mode()
+    def __call__(self, samples):
+        scores = []
+        for i in range(0, len(samples), self.micro_batch_size):
+            scores.extend(self.score(self.collate(samples[i : i + self.micro_batch_size])))
+        return scores
+
+
+@functools.lru_cache()
+def load_clip(device):
+    # shared by aes & match
+    import clip
+
+    return clip.load("ViT-L/14", device=device)
+
+
+def clip_transform():
+    from clip.clip import _transform
+
+    return _transform(224)  # the preprocess of ViT-L/14
+
+
+@register_scorer("aes")
+class AestheticScorer(BaseScorer):
+    points = (0.1, 0.5, 0.9)
+    micro_batch_size = 256
+
+    def __init__(self, device):
+        super().__init__(device)
+        self.transform = clip_transform()
+
+    def build(self):
+        from tools.scoring.aesthetic.inference import MLP
+
+        self.clip, _ = load_clip(self.device)
+        self.mlp = MLP(768)
+        self.mlp.load_state_dict(torch.load("pretrained_models/aesthetic.pth"))
+        self.mlp = self.mlp.eval().to(self.device)
+
+    def preprocess(self, frames, row):
+        return torch.stack([self.transform(img) for img in frames])  # (P, C, H, W)
+
+    def score(self, batch):
+        B = batch.shape[0]
+        images = rearrange(batch.to(self.device), "B P C H W -> (B P) C H W")
+        image_features = F.normalize(self.clip.encode_image(images), p=2, dim=-1).float()
+        scores = rearrange(self.mlp(image_features), "(B P) 1 -> B P", B=B).mean(dim=1)
+        return scores.float().cpu().tolist()
+
+
+@register_scorer("match")
+class MatchingScorer(BaseScorer):
+    points = (0.5,)
+    micro_batch_size = 64
+
+    def __init__(self, device):
+        super().__init__(device)
+        self.transform = clip_transform()
+
+    def build(self):
+        self.clip, _ = load_clip(self.device)
+        self.logit_scale = self.clip.logit_scale.exp().item()
+
+    def preprocess(self, frames, row):
+        import clip
+
+        return self.transform(frames[0]), clip.tokenize(row["text"], truncate=True).squeeze()
+
+    def score(self, batch):
+        imgs, text = batch
+        feat_img = F.normalize(self.clip.encode_image(imgs.to(self.device)), dim=1)
+        feat_text = F.normalize(self.clip.encode_text(text.to(self.device)), dim=1)
+        return (self.logit_scale * (feat_img * feat_text).sum(dim=1)).float().cpu().tolist()
+
+
+@register_scorer("ocr")
+class OCRScorer(BaseScorer):
+    frame_inds = (10,)
+    micro_batch_size = 16
+
+    def __init__(self, device):
+        super().__init__(device)
+        from torchvision.transforms import CenterCrop, Compose, Resize
+
+        self.transform = Compose([Resize(1024), CenterCrop(1024)])
+
+    def build(self):
+        from mmengine import Config
+        from mmengine.registry import DefaultScope
+        from mmocr.registry import MODELS
+
+        cfg = Config.fromfile("./tools/scoring/ocr/dbnetpp.py")
+        DefaultScope.get_instance("ocr", scope_name="mmocr")  # use mmocr Registry as default
+        self.model = MODELS.build(cfg.model)
+        self.model.init_weights()
+        self.model.to(self.device)  # set data_preprocessor._device
+        self.model.eval()
+
+    @functools.cached_property
+    def formatting(self):
+        from mmocr.datasets import PackTextDetInputs
+
+        return PackTextDetInputs(meta_keys=["scale_factor"])
+
+    def preprocess(self, frames, row):
+        img_array = np.array(self.transform(frames[0]))[:, :, ::-1].copy()  # bgr
+        return self.formatting({"img": img_array, "scale_factor": 1.0})
+
+    def collate(self, samples):
+        from mmengine.dataset import default_collate
+
+        return default_collate(samples)
+
+    def score(self, batch):
+        pred = self.model.test_step(batch)  # this line will cast data to device
+        return [(x.pred_instances.scores > 0.3).sum().item() for x in pred]
+
+
+@register_scorer("flow")
+class OpticalFlowScorer(BaseScorer):
+    frame_inds = (0, 10, 20, 30)
+    micro_batch_size = 64  # clips, the engine batches their frame pairs by resolution bucket, refer to `optical_flow/engine.py`
+
+    def build(self):
+        from tools.scoring.optical_flow.engine import FlowScoringEngine, build_unimatch
+
+        self.model = build_unimatch(device=self.device)
+        self.engine = FlowScoringEngine(self.model, self.device)
+
+    def preprocess(self, frames, row):
+        from tools.scoring.optical_flow.engine import resize_to_bucket
+
+        return resize_to_bucket(torch.stack([pil_to_tensor(x) for x in frames]))  # [N, C, H_b, W_b]
+
+    def collate(self, samples):
+        return samples
+
+    def score(self, batch):
+        return self.engine.score(batch)
+
+
+# ============================
+# Dataset & driver
+# ============================
+class MultiScoreDataset(torch.utils.data.Dataset):
+    def __init__(self, meta, indices, scorers):
+        self.meta = meta
+        self.indices = indices
+        self.scorers = scorers
+
+    def __getitem__(self, i):
+        index = self.indices[i]
+        row = self.meta.iloc[index]
+        path = row["path"]
+
+        if is_video(path):
+            frames, total_frames = decode_frames(
+                path,
+                frame_inds=[s.frame_inds for s in self.scorers if s.points is None],
+                points_list=[s.points for s in self.scorers if s.points is not None],
+                num_frames=row["num_frames"] if "num_frames" in row else None,
+            )
+            inputs = {s.name: s.preprocess([frames[idx] for idx in s.get_frame_inds(total_frames)], row) for s in self.scorers}
+        else:
+            img = pil_loader(path)
+            inputs = {s.name: s.preprocess([img] * len(s.get_frame_inds(1)), row) for s in self.scorers}
+        inputs["index"] = index
+        return inputs
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def read_meta(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def read_parts(parts_dir, columns):
+    """return the scores of the finished rows (w/ all the `columns`), indexed by the row index of the meta"""
+    files = sorted(f for f in os.listdir(parts_dir) if f.endswith(".parquet"))
+    if len(files) == 0:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name="index"))
+    parts = pd.concat([pd.read_parquet(os.path.join(parts_dir, f)) for f in files])
+    parts = parts.groupby("index").last()  # a row may be scored by several runs (w/ different scorers)
+    if any(c not in parts.columns for c in columns):
+        return parts.iloc[:0]
+    return parts.dropna(subset=columns)
+
+
+def flush(parts_dir, rank, records, columns):
+    if len(records) == 0:
+        return
+    part = pd.DataFrame(records, columns=["index"] + columns)
+    part.to_parquet(os.path.join(parts_dir, f"{time.time_ns()}_rank{rank}.parquet"), index=False)
+    records.clear()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("meta_path", type=str, help="Path to the input CSV/parquet file")
+    parser.add_argument("--scorers", type=str, nargs="+", default=["aes", "flow", "ocr", "match"], choices=list(SCORERS))
+    parser.add_argument("--cpu-scorers", type=str, nargs="*", default=[], help="scorers that run on CPU")
+    parser.add_argument("--output", type=str, default=None, help="default: /path/to/meta_scores.parquet")
+    parser.add_argument("--bs", type=int, default=64, help="number of samples decoded per batch")
+    parser.add_argument("--num_workers", type=int, default=16, help="Number of workers")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="Prefetch factor")
+    parser.add_argument("--save-interval", type=int, default=100, help="flush the scores every N batches")
+    return parser.parse_args()
+
+
+@torch.inference_mode()
+def main(args):
+    if "RANK" in os.environ:  # launched by torchrun
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo", timeout=timedelta(hours=24))
+        if torch.cuda.is_available():
+            torch.cuda.set_device(dist.get_rank() % torch.cuda.device_count())
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    else:
+        rank, world_size = 0, 1
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    meta = read_meta(args.meta_path).reset_index(drop=True)
+    out_path = args.output or f"{os.path.splitext(args.meta_path)[0]}_scores.parquet"
+    parts_dir = f"{out_path}.parts"
+    os.makedirs(parts_dir, exist_ok=True)
+    columns = list(args.scorers)
+
+    # resume: skip the rows already scored by all the requested scorers
+    finished = read_parts(parts_dir, columns).index
+    todo = np.setdiff1d(np.arange(len(meta)), np.asarray(finished, dtype=np.int64))
+    todo = todo[rank::world_size].tolist()
+    if rank == 0:
+        print(f"{len(finished)} rows already scored, {len(meta) - len(finished)} rows to score w/ {columns}")
+
+    scorers = [SCORERS[name]("cpu" if name in args.cpu_scorers else device) for name in columns]
+    dataset = MultiScoreDataset(meta, todo, scorers)
+    dataloader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=args.bs,
+        shuffle=False,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
+        collate_fn=list,  # each scorer collates its own inputs
+    )
+
+    # start the workers (decoding) before building the models, so that the workers do not hold a copy of the models
+    loader_iter = iter(dataloader)
+    for scorer in scorers:
+        scorer.build()
+
+    records = []
+    for step, samples in enumerate(tqdm(loader_iter, total=len(dataloader), disable=rank != 0)):
+        scores = [scorer([x[scorer.name] for x in samples]) for scorer in scorers]
+        records.extend(zip([x["index"] for x in samples], *scores))
+        if (step + 1) % args.save_interval == 0:
+            flush(parts_dir, rank, records, columns)
+    flush(parts_dir, rank, records, columns)
+
+    if world_size > 1:
+        dist.barrier()
+    if rank == 0:
+        scores = read_parts(parts_dir, columns)
+        meta = meta.copy()
+        for c in columns:
+            meta[c] = np.nan
+            meta.loc[scores.index, c] = scores[c].values
+        meta.to_parquet(out_path, index=False)
+        print(f"New meta (shape={meta.shape}) with {columns} saved to '{out_path}'.")
+
+
+if __name__ == "__main__":
+    main(parse_args())
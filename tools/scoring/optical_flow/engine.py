@@ -0,0 +1,117 @@
+"""
+Batched, resolution-bucketed optical-flow scoring with UniMatch.
+
+Instead of stretching every clip to 320x576, each clip is resized to the bucket in `FLOW_BUCKETS` with the nearest aspect ratio,
+and the frame pairs of all the clips in the same bucket are batched, up to `max_pairs` pairs per forward.
+The flow is rescaled to the 320x576 reference, so that the scores stay comparable with the previous ones (e.g., `--flowmin` of datautil).
+The fast mode halves the resolution (1/4 pixels) and runs one refinement step, for coarse motion filtering.
+"""
+import math
+from collections import defaultdict
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+from .unimatch import UniMatch
+
+UNIMATCH_CKPT = "./pretrained_models/unimatch/gmflow-scale2-regrefine6-mixdata-train320x576-4e7b215d.pth"
+REF_SIZE = (320, 576)  # the training resolution of the ckpt, and the resolution of the previous scores
+# (H, W) of landscape clips (portrait clips are transposed), divisible by 64 (32 in the fast mode) as required by the swin attn splits
+FLOW_BUCKETS = [(256, 640), (320, 576), (384, 576), (384, 512), (448, 448)]
+UNIMATCH_KWARGS = dict(
+    attn_type="swin",
+    attn_splits_list=[2, 8],
+    corr_radius_list=[-1, 4],
+    prop_radius_list=[-1, 1],
+    num_reg_refine=6,
+    task="flow",
+    pred_bidir_flow=False,
+)
+
+
+def build_unimatch(ckpt_path=UNIMATCH_CKPT, device="cuda"):
+    model = UniMatch(
+        feature_channels=128,
+        num_scales=2,
+        upsample_factor=4,
+        num_head=1,
+        ffn_dim_expansion=4,
+        num_transformer_layers=6,
+        reg_refine=True,
+        task="flow",
+    ).eval()
+    if ckpt_path is not None:
+        ckpt = torch.load(ckpt_path, map_location="cpu")
+        model.load_state_dict(ckpt["model"])
+    return model.to(device)
+
+
+def get_bucket(H, W, fast=False):
+    if H > W:
+        H, W = W, H
+    bucket = min(FLOW_BUCKETS, key=lambda hw: abs(math.log(hw[1] / hw[0] * H / W)))
+    if fast:
+        bucket = (bucket[0] // 2, bucket[1] // 2)
+    return bucket
+
+
+def resize_to_bucket(images, fast=False):
+    """
+    Args:
+        images (Tensor): uint8 [N, C, H, W], the frames of one clip
+    Return:
+        float [N, C, H_b, W_b], portrait clips are transposed (the same as the previous script)
+    """
+    images = images.float()
+    H, W = images.shape[-2:]
+    if H > W:
+        images = rearrange(images, "N C H W -> N C W H")
+    return F.interpolate(images, size=get_bucket(H, W, fast), mode="bilinear", align_corners=True)
+
+
+class FlowScoringEngine:
+    """
+    Args:
+        model: UniMatch, refer to `build_unimatch`
+        max_pairs (int): max number of frame pairs per forward
+        fast (bool): one refinement step instead of 6, use it with the clips from `resize_to_bucket(..., fast=True)`
+    """
+
+    def __init__(self, model, device, max_pairs=32, fast=False):
+        self.model = model
+        self.device = torch.device(device)
+        self.max_pairs = max_pairs
+        self.fast = fast
+        self.unimatch_kwargs = dict(UNIMATCH_KWARGS, num_reg_refine=1) if fast else UNIMATCH_KWARGS
+
+    @torch.inference_mode()
+    def score(self, clips):
+        """
+        Args:
+            clips (List[Tensor]): [N, C, H_b, W_b] of each clip, from `resize_to_bucket`
+        Return:
+            List[float], the mean |flow| (in pixels of the 320x576 reference) over the N-1 consecutive pairs of each clip
+        """
+        scores = [float("nan")] * len(clips)
+        buckets = defaultdict(list)
+        for i, clip in enumerate(clips):
+            if clip.shape[0] > 1:
+                buckets[tuple(clip.shape)].append(i)
+
+        for (N, _, H, W), ids in buckets.items():
+            img0 = torch.cat([clips[i][:-1] for i in ids])  # [n * (N-1), C, H, W]
+            img1 = torch.cat([clips[i][1:] for i in ids])
+            flow_abs = []
+            for s in range(0, img0.shape[0], self.max_pairs):
+                flow = self.model(
+                    img0[s : s + self.max_pairs].to(self.device, non_blocking=True),
+                    img1[s : s + self.max_pairs].to(self.device, non_blocking=True),
+                    **self.unimatch_kwargs,
+                )["flow_preds"][-1]  # [b, 2, H, W]
+                flow_abs.append(flow.abs().mean(dim=[2, 3]).float().cpu())  # mean |u|, |v| of each pair
+            flow_abs = torch.cat(flow_abs) * torch.tensor([REF_SIZE[1] / W, REF_SIZE[0] / H])  # rescale to the reference
+            flow_abs = flow_abs.view(len(ids), N - 1, 2).mean(dim=[1, 2])
+            for i, score in zip(ids, flow_abs.tolist()):
+                scores[i] = score
+        return scores
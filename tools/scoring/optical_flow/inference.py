@@ -6,15 +6,13 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.distributed as dist
-import torch.nn.functional as F
-from einops import rearrange
 from torch.utils.data import DataLoader, DistributedSampler
 from torchvision.transforms.functional import pil_to_tensor
 from tqdm import tqdm
 
 from tools.datasets.utils import extract_frames
 
-from .unimatch import UniMatch
+from .engine import FlowScoringEngine, build_unimatch, resize_to_bucket
 
 
 def merge_scores(gathered_list: list, meta: pd.DataFrame):
@@ -35,22 +33,19 @@ def merge_scores(gathered_list: list, meta: pd.DataFrame):
 
 
 class VideoTextDataset(torch.utils.data.Dataset):
-    def __init__(self, meta_path, frame_inds=[0, 10, 20, 30]):
+    def __init__(self, meta_path, frame_inds=[0, 10, 20, 30], fast=False):
         self.meta_path = meta_path
         self.meta = pd.read_csv(meta_path)
         self.frame_inds = frame_inds
+        self.fast = fast
 
     def __getitem__(self, index):
         row = self.meta.iloc[index]
         images = extract_frames(row["path"], frame_inds=self.frame_inds, backend="opencv")
 
-        # transform
+        # transform, resize to the resolution bucket of the clip, refer to `engine.py`
         images = torch.stack([pil_to_tensor(x) for x in images])  # shape: [N, C, H, W]; dtype: torch.uint8
-        images = images.float()
-        H, W = images.shape[-2:]
-        if H > W:
-            images = rearrange(images, "N C H W -> N C W H")
-        images = F.interpolate(images, size=(320, 576), mode="bilinear", align_corners=True)
+        images = resize_to_bucket(images, fast=self.fast)
 
         return images, index
 
@@ -58,10 +53,19 @@ class VideoTextDataset(torch.utils.data.Dataset):
         return len(self.meta)
 
 
+def collate_clips(batch):
+    # clips of different buckets are not stacked
+    images, indices = zip(*batch)
+    return list(images), list(indices)
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("meta_path", type=str, help="Path to the input CSV file")
-    parser.add_argument("--bs", type=int, default=4, help="Batch size")
+    parser.add_argument("--bs", type=int, default=32, help="Number of clips loaded per batch, bucketed by resolution")
+    parser.add_argument("--max-pairs", type=int, default=24, help="Max number of frame pairs per forward")
+    parser.add_argument("--frame-inds", type=int, nargs="+", default=[0, 10, 20, 30], help="Frames to compute the flow of consecutive pairs")
+    parser.add_argument("--fast", action="store_true", help="Half resolution & one refinement step, for coarse motion filtering")
     parser.add_argument("--num_workers", type=int, default=16, help="Number of workers")
     args = parser.parse_args()
     return args
@@ -79,27 +83,16 @@ def main():
 
     # build model
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    model = UniMatch(
-        feature_channels=128,
-        num_scales=2,
-        upsample_factor=4,
-        num_head=1,
-        ffn_dim_expansion=4,
-        num_transformer_layers=6,
-        reg_refine=True,
-        task="flow",
-    ).eval()
-    ckpt = torch.load("./pretrained_models/unimatch/gmflow-scale2-regrefine6-mixdata-train320x576-4e7b215d.pth")
-    model.load_state_dict(ckpt["model"])
-    model = model.to(device)
-    # model = torch.nn.DataParallel(model)
+    model = build_unimatch(device=device)
+    engine = FlowScoringEngine(model, device, max_pairs=args.max_pairs, fast=args.fast)
 
     # build dataset
-    dataset = VideoTextDataset(meta_path=meta_path, frame_inds=[0, 10, 20, 30])
+    dataset = VideoTextDataset(meta_path=meta_path, frame_inds=args.frame_inds, fast=args.fast)
     dataloader = DataLoader(
         dataset,
         batch_size=args.bs,
         num_workers=args.num_workers,
+        collate_fn=collate_clips,
         sampler=DistributedSampler(
             dataset,
             num_replicas=dist.get_world_size(),
@@ -114,28 +107,8 @@ def main():
     indices_list = []
     flow_scores_list = []
     for images, indices in tqdm(dataloader, disable=dist.get_rank() != 0):
-        images = images.to(device)
-        B = images.shape[0]
-
-        batch_0 = rearrange(images[:, :-1], "B N C H W -> (B N) C H W").contiguous()
-        batch_1 = rearrange(images[:, 1:], "B N C H W -> (B N) C H W").contiguous()
-
-        with torch.no_grad():
-            res = model(
-                batch_0,
-                batch_1,
-                attn_type="swin",
-                attn_splits_list=[2, 8],
-                corr_radius_list=[-1, 4],
-                prop_radius_list=[-1, 1],
-                num_reg_refine=6,
-                task="flow",
-                pred_bidir_flow=False,
-            )
-            flow_maps = res["flow_preds"][-1].cpu()  # [B * (N-1), 2, H, W]
-            flow_maps = rearrange(flow_maps, "(B N) C H W -> B N H W C", B=B)
-            flow_scores = flow_maps.abs().mean(dim=[1, 2, 3, 4])
-            flow_scores = flow_scores.tolist()
+        # the frame pairs of the clips in the same bucket are batched, `max_pairs` per forward
+        flow_scores = engine.score(images)
 
         indices_list.extend(indices)
         flow_scores_list.extend(flow_scores)